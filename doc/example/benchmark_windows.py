@@ -0,0 +1,58 @@
+"""
+Times the visit window matching against the stub server with one worker and with many.
+
+The stub server answers from the bundles in a directory with a fixed latency per request, so the run is
+offline and reproducible; the speedup from the concurrent fetching should approach the number of workers
+for the requests that are independent (the counts for each visit window).
+"""
+import argparse
+import contextlib
+import io
+import threading
+import time
+
+from cache import ResponseCache
+from stub_server import make_server
+from windows import StudyWindow
+
+
+def evaluate(baseurl: str, study_id: str, subject_ids, workers: int):
+    # a cold cache each time
+    window = StudyWindow(baseurl, study_id, max_workers=workers, cache=ResponseCache())
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        protocol = window.process_protocol(window.get_protocol())
+        rows = [window.get_subject_scheme(subject_id, protocol, verbose=False) for subject_id in subject_ids]
+    return time.perf_counter() - started, rows, window.cache.stats()["lookups"]
+
+
+def run(dirname: str, study_id: str, subject_ids, workers, latency: float):
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = make_server(dirname, port=0, latency=latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    baseurl = f"http://localhost:{server.server_address[1]}/"
+    print(f"{'workers':>8} {'requests':>9} {'time (s)':>9} {'speedup':>8}")
+    baseline = None
+    expected = None
+    try:
+        for count in workers:
+            elapsed, rows, requests = evaluate(baseurl, study_id, subject_ids, count)
+            if expected is None:
+                baseline, expected = elapsed, rows
+            elif rows != expected:
+                raise AssertionError(f"The results with {count} workers differ from those with {workers[0]}")
+            print(f"{count:>8} {requests:>9} {elapsed:>9.2f} {baseline / elapsed:>8.2f}")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the visit window matching with one worker and with many")
+    parser.add_argument("dirname", help="Directory of Bundle files to serve (eg upstream/subjects)")
+    parser.add_argument("subject_ids", nargs="*", default=["01-701-1015"], help="The subjects to evaluate")
+    parser.add_argument("--study-id", default="H2Q-MC-LZZT", help="The study identifier")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8], help="The numbers of workers to time")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds the stub waits before each response")
+    opts = parser.parse_args()
+    run(opts.dirname, opts.study_id, opts.subject_ids, opts.workers, opts.latency)
@@ -0,0 +1,141 @@
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, NamedTuple, Optional
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    stored_at: float
+    # the parsed response, only kept in memory
+    value: Any = None
+
+
+class ResponseCache:
+    """
+    Cache of GET responses keyed by URL, held in memory with an optional SQLite file behind it
+
+    A response is fresh for `ttl` seconds after it was stored (or last revalidated); a stale response
+    with an ETag or Last-Modified can be revalidated with a conditional GET.  The least recently used
+    responses are evicted once the bodies exceed `max_bytes` in memory, or `max_disk_bytes` on disk.
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: float = 300,
+                 max_bytes: int = 64 * 1024 ** 2, max_disk_bytes: int = 512 * 1024 ** 2):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.RLock()
+        self._stats = Counter()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                             "url TEXT PRIMARY KEY, body BLOB, etag TEXT, last_modified TEXT, "
+                             "stored_at REAL, accessed_at REAL)")
+            self._db.commit()
+
+    def is_fresh(self, cached: CachedResponse) -> bool:
+        return time.time() - cached.stored_at < self.ttl
+
+    def get(self, url: str) -> Optional[CachedResponse]:
+        """
+        Get the cached response for the URL, fresh or stale
+        """
+        with self._lock:
+            if url in self._items:
+                self._items.move_to_end(url)
+                return self._items[url]
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT body, etag, last_modified, stored_at FROM responses WHERE url = ?",
+                                   (url,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE responses SET accessed_at = ? WHERE url = ?", (time.time(), url))
+            self._db.commit()
+            cached = CachedResponse(*row)
+            self._remember(url, cached)
+            return cached
+
+    def put(self, url: str, body: bytes, etag: Optional[str] = None, last_modified: Optional[str] = None,
+            value: Any = None) -> CachedResponse:
+        """
+        Store a response
+        """
+        cached = CachedResponse(body, etag, last_modified, time.time(), value)
+        with self._lock:
+            self._remember(url, cached)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                                 (url, body, etag, last_modified, cached.stored_at, cached.stored_at))
+                self._evict_disk()
+                self._db.commit()
+        return cached
+
+    def revalidated(self, url: str) -> Optional[CachedResponse]:
+        """
+        Mark a stale response as fresh again (the server answered 304 Not Modified)
+        """
+        with self._lock:
+            cached = self.get(url)
+            if cached is None:
+                return None
+            cached = cached._replace(stored_at=time.time())
+            self._remember(url, cached)
+            if self._db is not None:
+                self._db.execute("UPDATE responses SET stored_at = ? WHERE url = ?", (cached.stored_at, url))
+                self._db.commit()
+            return cached
+
+    def attach(self, url: str, value: Any) -> None:
+        """
+        Keep the parsed response alongside the body (in memory)
+        """
+        with self._lock:
+            if url in self._items:
+                self._items[url] = self._items[url]._replace(value=value)
+
+    def record(self, outcome: str) -> None:
+        """
+        Count a lookup outcome; hit, revalidated, miss or stale
+        """
+        with self._lock:
+            self._stats[outcome] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = sum(self._stats.values())
+            served = self._stats["hit"] + self._stats["revalidated"]
+            return dict(self._stats,
+                        lookups=lookups,
+                        hit_rate=served / lookups if lookups else 0.0,
+                        entries=len(self._items),
+                        size=self._size)
+
+    def _remember(self, url: str, cached: CachedResponse) -> None:
+        # caller holds the lock
+        if url in self._items:
+            self._size -= len(self._items.pop(url).body)
+        self._items[url] = cached
+        self._size += len(cached.body)
+        while self._size > self.max_bytes and len(self._items) > 1:
+            _, evicted = self._items.popitem(last=False)
+            self._size -= len(evicted.body)
+
+    def _evict_disk(self) -> None:
+        # caller holds the lock
+        total, = self._db.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses").fetchone()
+        if total <= self.max_disk_bytes:
+            return
+        for url, size in self._db.execute("SELECT url, LENGTH(body) FROM responses "
+                                          "ORDER BY accessed_at").fetchall():
+            self._db.execute("DELETE FROM responses WHERE url = ?", (url,))
+            total -= size
+            if total <= self.max_disk_bytes:
+                break
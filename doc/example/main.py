@@ -1,21 +1,63 @@
+import argparse
+import glob
+import os
 import sys
 
-from windows import StudyWindow
+from soa_bridge_match.query import LocalSession, QueryEngine
+
+from cache import ResponseCache
+from windows import StudyWindow, write_table
 
 BASEURL = "https://api.logicahealth.org/soaconnectathon30/open"
+# responses are kept between runs and revalidated with the server once stale
+CACHE_FILE = "soa_responses.sqlite"
+
+
+def make_window(study_id, bundles=None) -> StudyWindow:
+    """
+    A StudyWindow on the server, or on the bundles in a directory when given
+    """
+    if bundles:
+        engine = QueryEngine.from_files(sorted(glob.glob(os.path.join(bundles, "*.json"))))
+        print(f"Loaded {len(engine)} resources from {bundles}")
+        return StudyWindow(BASEURL, study_id, session=LocalSession(engine))
+    return StudyWindow(BASEURL, study_id, cache=ResponseCache(CACHE_FILE))
+
+
+def run(subject_id, study_id="H2Q-MC-LZZT", output=None, bundles=None):
+    window = make_window(study_id, bundles)
+    protocol = window.get_protocol()
+    processed = window.process_protocol(protocol)
+    rows = window.get_subject_scheme(subject_id, processed)
+    if output and rows:
+        write_table(rows, output)
+    print("Response cache:", window.cache.stats())
 
 
-def run(subject_id, study_id="H2Q-MC-LZZT"):
-    window = StudyWindow(BASEURL, study_id)
+def run_cohort(study_id="H2Q-MC-LZZT", workers=8, output=None, bundles=None):
+    window = make_window(study_id, bundles)
     protocol = window.get_protocol()
     processed = window.process_protocol(protocol)
-    window.get_subject_scheme(subject_id, processed)
+    rows, failures = window.get_cohort_scheme(processed, workers=workers)
+    if output:
+        write_table(rows, output)
+        if failures:
+            print(f"{output} is partial, {len(failures)} subjects failed: {', '.join(sorted(failures))}")
+    print("Response cache:", window.cache.stats())
+    return failures
 
 
 if __name__ == '__main__':
-    STUDY_ID = "H2Q-MC-LZZT"
-    if len(sys.argv) > 1:
-        SUBJECT_ID = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Evaluate the visit windows for the subjects of a study")
+    parser.add_argument("subject_id", nargs="?", default="01-701-1047", help="The subject to evaluate")
+    parser.add_argument("--study-id", default="H2Q-MC-LZZT", help="The study identifier")
+    parser.add_argument("--cohort", action="store_true", help="Evaluate all the subjects of the study")
+    parser.add_argument("-j", "--workers", type=int, default=8, help="Number of subjects evaluated at once")
+    parser.add_argument("-o", "--output", help="Write the results to a CSV (or .parquet) file")
+    parser.add_argument("--bundles", help="Match against the Bundle files in this directory rather than the server")
+    opts = parser.parse_args()
+    if opts.cohort:
+        if run_cohort(opts.study_id, opts.workers, opts.output, opts.bundles):
+            sys.exit(1)
     else:
-        SUBJECT_ID = "01-701-1047"
-    run(SUBJECT_ID, STUDY_ID)
+        run(opts.subject_id, opts.study_id, opts.output, opts.bundles)
@@ -0,0 +1,131 @@
+import argparse
+import contextlib
+import glob
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from soa_bridge_match.query import QueryEngine
+from soa_bridge_match.uploader import references
+
+
+class FHIRHandler(BaseHTTPRequestHandler):
+    """
+    Answers FHIR reads and searches from the QueryEngine of the server and, when the server is writable,
+    adds the resources of posted transactions (or batches) to it; a transaction referencing a resource that
+    is neither in it nor on the server is rejected (the entries of a batch are rejected on their own)
+    """
+    # keep the connections alive
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        # a read-only engine doesn't change while serving, the reads only need the lock alongside posts
+        with self.server.lock or contextlib.nullcontext():
+            status, body = self.server.engine.get(self.path.lstrip("/"))
+        self._respond(status, body)
+
+    def do_POST(self):
+        content = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.lock is None:
+            self._respond(405, dict(resourceType="OperationOutcome",
+                                    issue=[dict(severity="error", code="not-supported")]))
+            return
+        if random.random() < self.server.fail_rate:
+            self._respond(503, dict(resourceType="OperationOutcome",
+                                    issue=[dict(severity="error", code="transient")]))
+            return
+        try:
+            bundle = json.loads(content)
+        except ValueError:
+            self._respond(400, dict(resourceType="OperationOutcome", issue=[dict(severity="error", code="invalid")]))
+            return
+        if bundle.get("resourceType") != "Bundle" or bundle.get("type") not in ("transaction", "batch"):
+            self._respond(400, dict(resourceType="OperationOutcome", issue=[dict(severity="error", code="invalid")]))
+            return
+        resources = [entry.get("resource") or {} for entry in bundle.get("entry") or []]
+        posted = {f"{x.get('resourceType')}/{x.get('id')}" for x in resources}
+        entries = []
+        with self.server.lock:
+            # the references must resolve in the bundle or on the server
+            unresolved = [sorted(x for x in references(resource) if x not in posted and
+                                 self.server.engine.read(*x.split("/", 1)) is None)
+                          for resource in resources]
+            if bundle["type"] == "transaction" and any(unresolved):
+                missing = sorted({x for refs in unresolved for x in refs})
+                self._respond(400, dict(resourceType="OperationOutcome", issue=[
+                    dict(severity="error", code="not-found", diagnostics=f"Unresolved reference {x}")
+                    for x in missing]))
+                return
+            for resource, missing in zip(resources, unresolved):
+                location = f"{resource['resourceType']}/{resource['id']}"
+                if missing:
+                    # a batch fails the entry alone
+                    entries.append(dict(response=dict(status="400 Bad Request", outcome=dict(
+                        resourceType="OperationOutcome", issue=[
+                            dict(severity="error", code="not-found", diagnostics=f"Unresolved reference {x}")
+                            for x in missing]))))
+                    continue
+                added = self.server.engine.add_resource(resource)
+                entries.append(dict(response=dict(status="201 Created" if added else "200 OK", location=location)))
+        self._respond(200, dict(resourceType="Bundle", type=f"{bundle['type']}-response", entry=entries))
+
+    def _respond(self, status: int, body: dict):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(dirname: str, host: str = "localhost", port: int = 8080, latency: float = 0.0,
+                writable: bool = False, fail_rate: float = 0.0) -> ThreadingHTTPServer:
+    """
+    A server for the bundles in the directory (port 0 picks a free port)
+    """
+    server = ThreadingHTTPServer((host, port), FHIRHandler)
+    server.daemon_threads = True
+    port = server.server_address[1]
+    filenames = sorted(glob.glob(os.path.join(dirname, "*.json")))
+    server.engine = QueryEngine.from_files(filenames, baseurl=f"http://{host}:{port}/")
+    print(f"Loaded {len(server.engine)} resources from {len(filenames)} files")
+    # the seconds added to each response, as for a remote server
+    server.latency = latency
+    # posts are accepted (and serialised with the reads) only when writable
+    server.lock = threading.Lock() if writable else None
+    # the fraction of posts answered with a 503, to try out the retries
+    server.fail_rate = fail_rate
+    return server
+
+
+def serve(dirname: str, host: str = "localhost", port: int = 8080, latency: float = 0.0,
+          writable: bool = False, fail_rate: float = 0.0):
+    server = make_server(dirname, host, port, latency, writable, fail_rate)
+    print(f"Serving on http://{host}:{server.server_address[1]}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the bundles in a directory as a FHIR server")
+    parser.add_argument("dirname", help="Directory of Bundle files")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before each response")
+    parser.add_argument("--writable", action="store_true", help="Accept posted transactions and batches")
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="The fraction of posts to fail with a 503")
+    opts = parser.parse_args()
+    serve(opts.dirname, opts.host, opts.port, opts.latency, opts.writable, opts.fail_rate)
@@ -1,8 +1,13 @@
 import re
+import csv
+import copy
 import datetime
-from typing import Optional, List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Optional, List, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 from fhir.resources.bundle import Bundle
 from fhir.resources.patient import Patient
 from fhir.resources.observation import Observation
@@ -17,6 +22,8 @@ from fhir.resources.careplan import CarePlan
 from fhir.resources.resource import Resource
 from fhir.resources.servicerequest import ServiceRequest
 
+from cache import CachedResponse, ResponseCache
+
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -53,15 +60,34 @@ logger = logging.getLogger("soa-bridge-match.example")
 """
 
 
+# resources counted for each visit window
+WINDOW_RESOURCES = ("Observation", "Procedure", "AdverseEvent", "MedicationStatement")
+
+
 class StudyWindow:
 
-    def __init__(self, baseurl: str, study_id: str):
+    def __init__(self, baseurl: str, study_id: str, max_workers: int = 8, cache: Optional[ResponseCache] = None,
+                 session=None):
         self._baseurl = baseurl if baseurl.endswith('/') else baseurl + '/'
         self.study_id = study_id
         self._visits = []
-        self._session = None
+        # anything with a requests-like get, e.g. a LocalSession answering from bundles on disk
+        self._session = session
         self._encounter_cache = {}
         self._subject_cache = {}
+        # subjects whose visit encounters have been resolved
+        self._resolved = set()
+        self._resolve_lock = threading.Lock()
+        # a lock per subject, so different subjects can be resolved concurrently
+        self._subject_locks = {}
+        # the ResearchStudy and the PlanDefinitions for the index events are shared by the subjects
+        self._study = None
+        self._definitions = {}
+        # bounds the number of concurrent requests (and the size of the connection pool)
+        self.max_workers = max_workers
+        self._executor = None
+        # responses by URL, in memory unless a cache with a file is passed
+        self.cache = cache if cache is not None else ResponseCache()
 
     @property
     def client(self):
@@ -69,45 +95,125 @@ class StudyWindow:
             self._session = requests.Session()
             self._session.headers.update({'Accept': 'application/json'})
             self._session.headers.update({'Content-Type': 'application/json'})
+            # keep a connection per worker alive
+            adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
         return self._session
 
-    def _get(self, url) -> Optional[Resource]:
-        all_url = self._baseurl + url
-        print(f'Fetching {all_url}')
-        response = self.client.get(all_url)
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def _map(self, func: Callable, items: Iterable) -> list:
+        """
+        Apply func to the items on the worker pool, returning the results in order
+        """
+        return list(self.executor.map(func, items))
+
+    @staticmethod
+    def _attempt(func: Callable, *args):
+        """
+        Call func, returning None rather than raising
+        """
+        try:
+            return func(*args)
+        except Exception as exc:
+            logger.debug(f"{func.__name__}{args} failed: {exc}")
+            return None
+
+    def _get_all(self, url) -> Optional[Bundle]:
+        """
+        Search, following the next links and gathering the entries of all the pages into the first Bundle
+        """
+        page = self._get(url)
+        if page is None:
+            return None
+        # the pages are shared with the response cache, gather the entries into a copy
+        bundle = page.copy()
+        bundle.entry = list(page.entry or [])
+        while page is not None:
+            next_url = next((x.url for x in page.link or [] if x.relation == 'next'), None)
+            if not next_url:
+                break
+            page = self._get(next_url)
+            if page is not None and page.entry:
+                bundle.entry.extend(page.entry)
+        return bundle
+
+    def _fetch(self, url: str) -> Optional[CachedResponse]:
+        """
+        GET the url through the response cache, revalidating stale responses with a conditional GET
+        """
+        cached = self.cache.get(url)
+        if cached is not None and self.cache.is_fresh(cached):
+            self.cache.record("hit")
+            return cached
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+        print(f'Fetching {url}')
+        response = self.client.get(url, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            self.cache.record("revalidated")
+            return self.cache.revalidated(url)
+        self.cache.record("stale" if cached is not None else "miss")
         if response.status_code == 200:
-            if '?' in all_url:
-                return Bundle.parse_obj(response.json())
-            else:
-                pattern = re.compile(r'([A-z]+)/(.*)')
-                rtype, _ = pattern.match(url).groups()
-
-                if rtype == 'Encounter':
-                    return Encounter.parse_obj(response.json())
-                elif rtype == 'ServiceRequest':
-                    return ServiceRequest.parse_obj(response.json())
-                elif rtype == 'CarePlan':
-                    return CarePlan.parse_obj(response.json())
-                elif rtype == 'ResearchSubject':
-                    return ResearchSubject.parse_obj(response.json())
-                elif rtype == 'Patient':
-                    return Patient.parse_obj(response.json())
-                elif rtype == 'PlanDefinition':
-                    return PlanDefinition.parse_obj(response.json())
-                else:
-                    print(f"No idea how to work with this type: {rtype}")
+            return self.cache.put(url, response.content,
+                                  response.headers.get('ETag'), response.headers.get('Last-Modified'))
         return None
 
+    def _get(self, url) -> Optional[Resource]:
+        # the next links for paging are absolute
+        all_url = url if url.startswith(('http://', 'https://')) else self._baseurl + url
+        cached = self._fetch(all_url)
+        if cached is None:
+            return None
+        if cached.value is not None:
+            return cached.value
+        if '?' in all_url:
+            resource = Bundle.parse_raw(cached.body)
+        else:
+            pattern = re.compile(r'([A-z]+)/(.*)')
+            rtype, _ = pattern.match(url).groups()
+
+            if rtype == 'Encounter':
+                resource = Encounter.parse_raw(cached.body)
+            elif rtype == 'ServiceRequest':
+                resource = ServiceRequest.parse_raw(cached.body)
+            elif rtype == 'CarePlan':
+                resource = CarePlan.parse_raw(cached.body)
+            elif rtype == 'ResearchSubject':
+                resource = ResearchSubject.parse_raw(cached.body)
+            elif rtype == 'Patient':
+                resource = Patient.parse_raw(cached.body)
+            elif rtype == 'PlanDefinition':
+                resource = PlanDefinition.parse_raw(cached.body)
+            else:
+                print(f"No idea how to work with this type: {rtype}")
+                return None
+        # keep the parsed resource so it isn't parsed again while the response is fresh
+        self.cache.attach(all_url, resource)
+        return resource
+
     def _get_research_study(self) -> Optional[ResearchStudy]:
-        url = f'ResearchStudy?identifier={self.study_id}'
-        bundle = self._get(url)
-        if bundle.total != 1:
-            raise Exception(f'No ResearchStudy found for {self.study_id}')
-        return bundle.entry[0].resource
+        if self._study is None:
+            url = f'ResearchStudy?identifier={self.study_id}'
+            bundle = self._get(url)
+            if bundle.total != 1:
+                raise Exception(f'No ResearchStudy found for {self.study_id}')
+            self._study = bundle.entry[0].resource
+        return self._study
 
     def _get_research_subjects(self) -> Optional[List[ResearchSubject]]:
-        url = f'ResearchSubject?study={self.study_id}'
-        bundle = self._get(url)
+        study = self._get_research_study()
+        url = f'ResearchSubject?study={study.id}'
+        bundle = self._get_all(url)
         if bundle.total == 0:
             raise Exception(f'No ResearchSubject found for {self.study_id}')
         return [x.resource for x in bundle.entry if x.resource.resource_type == 'ResearchSubject']
@@ -171,57 +277,105 @@ class StudyWindow:
 
         return encounters
 
+    def _subject_lock(self, subject_id: str) -> threading.Lock:
+        with self._resolve_lock:
+            return self._subject_locks.setdefault(subject_id, threading.Lock())
+
+    def get_encounters_for_subject(self, subject_id: str) -> dict:
+        """
+        Resolve the Encounter for each of the visits of a subject, returns PlanDefinition id -> Encounter
+
+        Gets the CarePlans for the Patient along with the ServiceRequests based on them and the Encounters
+        based on those (_revinclude), rather than following CarePlan -> ServiceRequest -> Encounter per visit;
+        if the server doesn't return the included resources they are searched for by Patient.
+        """
+        with self._subject_lock(subject_id):
+            if subject_id not in self._resolved:
+                research_subject = self._get_research_subject(subject_id)
+                if research_subject is None:
+                    # can't find subject
+                    return {}
+                patient = research_subject.individual.reference
+                bundle = self._get_all(f"CarePlan?patient={patient}"
+                                       f"&_revinclude=ServiceRequest:based-on"
+                                       f"&_revinclude:iterate=Encounter:based-on")
+                resources = {}
+                for entry in (bundle.entry or [] if bundle else []):
+                    resources.setdefault(entry.resource.resource_type, []).append(entry.resource)
+                for rtype in ("ServiceRequest", "Encounter"):
+                    if rtype not in resources:
+                        _bundle = self._get_all(f"{rtype}?patient={patient}")
+                        resources[rtype] = [x.resource for x in _bundle.entry or []] if _bundle else []
+                # index the ServiceRequests by CarePlan and the Encounters by ServiceRequest
+                based_on = {}
+                for resource in resources["ServiceRequest"] + resources["Encounter"]:
+                    for reference in resource.basedOn or []:
+                        based_on.setdefault(reference.reference, resource)
+                for care_plan in resources.get("CarePlan", []):  # type: CarePlan
+                    service_request = based_on.get(f"CarePlan/{care_plan.id}")
+                    if service_request is None:
+                        continue
+                    encounter = based_on.get(f"ServiceRequest/{service_request.id}")
+                    if encounter is None:
+                        continue
+                    for canonical in care_plan.instantiatesCanonical or []:
+                        plan_definition_id = canonical.split("/")[-1]
+                        self._encounter_cache.setdefault(f"{subject_id}_{plan_definition_id}", encounter)
+                self._resolved.add(subject_id)
+        prefix = f"{subject_id}_"
+        return {key[len(prefix):]: encounter for key, encounter in self._encounter_cache.items()
+                if key.startswith(prefix)}
+
     def get_encounter_for_subject(self, subject_id: str, plan_definition_id: str) -> Optional[Encounter]:
-        _idx = f"{subject_id}_{plan_definition_id}"
         if plan_definition_id.startswith("PlanDefinition"):
             plan_definition_id = plan_definition_id.split("/")[1]
+        _idx = f"{subject_id}_{plan_definition_id}"
         if _idx not in self._encounter_cache:
-            research_subject = self._get_research_subject(subject_id)
-            if research_subject is None:
-                # can't find subject
-                return None
-            # get the careplan
-            cp_bnd = self._get(
-                "CarePlan?patient={}&"
-                "instantiates-canonical=PlanDefinition/{}".format(research_subject.individual.reference,
-                                                                  plan_definition_id))
-            if cp_bnd.total != 1:
-                raise Exception(f'No CarePlan found for {plan_definition_id}')
-            cp = cp_bnd.entry[0].resource  # type: CarePlan
-            # get the service request
-            sr_bnd = self._get("ServiceRequest?patient={}&"
-                               "based-on=CarePlan/{}".format(research_subject.individual.reference,
-                                                             cp.id))
-            if sr_bnd.total == 0:
-                raise Exception(f'No ServiceRequest found for {cp.id}')
-            sd = sr_bnd.entry[0].resource  # type: ServiceRequest
-            # get the encounter
-            enc_bnd = self._get("Encounter?patient={}&based-on=ServiceRequest/{}".format(
-                research_subject.individual.reference, sd.id))
-            self._encounter_cache[_idx] = enc_bnd.entry[0].resource  # type: Encounter
+            self.get_encounters_for_subject(subject_id)
+            if _idx not in self._encounter_cache:
+                raise Exception(f'No Encounter found for {plan_definition_id}')
         return self._encounter_cache.get(_idx)
 
-    def get_subject_scheme(self, subject_id: str, protocol: dict):
+    def _get_definition(self, definition: str) -> PlanDefinition:
+        """
+        Get the PlanDefinition for an action of the protocol, once
         """
-        Returns the index date for a subject
+        if definition not in self._definitions:
+            plan_definition = self._get(definition)
+            if plan_definition is None:
+                raise Exception(f'No PlanDefinition found for {definition}')
+            self._definitions[definition] = plan_definition
+        return self._definitions[definition]
+
+    def get_subject_scheme(self, subject_id: str, protocol: dict, verbose: bool = True) -> Optional[List[dict]]:
+        """
+        Evaluates the visit windows for a subject, returns a row per visit with the status and resource counts
+
+        The status is `index` for the index visit, `in_window` or `out_of_window` for a visit with an
+        Encounter and `missing` for a visit without one.
         """
         research_subject = self._get_research_subject(subject_id)
         if research_subject is None:
             print(f"Subject {subject_id} not found")
-            return
+            return None
+        # the processed protocol is shared between subjects
+        protocol = copy.deepcopy(protocol)
         trigger_events = [x for x in protocol.values() if x['is_index']]
-        print("Trigger events:", trigger_events)
+        if verbose:
+            print("Trigger events:", trigger_events)
         assert len(trigger_events) == 1, "Unable to id index event"
-        idx_pd = self._get(trigger_events[0]['definition'])
-        if idx_pd is None:
-            raise Exception(f'No PlanDefinition found for {trigger_events[0]["definition"]}')
+        idx_pd = self._get_definition(trigger_events[0]['definition'])
+        # resolve the encounters for all the visits at once
+        self.get_encounters_for_subject(subject_id)
         enc = self.get_encounter_for_subject(subject_id, idx_pd.id)
         # Identify the visit date for the epoch
         index_date = enc.period.start   # type: datetime.date
+        encounters = {visit: self._attempt(self.get_encounter_for_subject, subject_id, visit)
+                      for visit in protocol.keys()}
         for visit, offsets in protocol.items():
             qtext = []
             try:
-                _enc = self.get_encounter_for_subject(subject_id, visit)
+                _enc = encounters[visit]
                 if _enc.period:
                     if _enc.period.start == _enc.period.end:
                         offsets["encounter_date"] = _enc.period.start.date()
@@ -235,11 +389,13 @@ class StudyWindow:
                             offsets["encounter_date"] = _enc.period.start.date()
                             offsets["datematch"] = f"eq{_enc.period.start.date().isoformat()}"
             except Exception as exc:
-                print(f"Unable to find visit {visit}")
+                if verbose:
+                    print(f"Unable to find visit {visit}")
                 offsets["skip"] = True
 
             if offsets["is_index"] is True:
                 qtext = [f"eq{index_date.date().isoformat()}"]
+                offsets["window_low"] = offsets["window_high"] = index_date.date()
             else:
                 if offsets.get("offset_high"):
                     _offset = offsets.get("offset_high")
@@ -249,11 +405,13 @@ class StudyWindow:
                         # TODO: units, dummy
                         delta = datetime.timedelta(days=_offset.get('value'))
                     if offsets.get("relationship") == "after":
-                        _tgt = (index_date + delta).date().isoformat()
-                        qtext.append(f"le{_tgt}")
+                        _tgt = (index_date + delta).date()
+                        qtext.append(f"le{_tgt.isoformat()}")
+                        offsets["window_high"] = _tgt
                     else:
-                        _tgt = (index_date - delta).date().isoformat()
-                        qtext.append(f"ge{_tgt}")
+                        _tgt = (index_date - delta).date()
+                        qtext.append(f"ge{_tgt.isoformat()}")
+                        offsets["window_low"] = _tgt
                 if offsets.get("offset_low"):
                     _offset = offsets.get("offset_low")
                     if _offset.get('unit', 'd') == 'd':
@@ -262,25 +420,126 @@ class StudyWindow:
                         # TODO: units, dummy
                         delta = datetime.timedelta(days=_offset.get('value'))
                     if offsets.get("relationship") == "after":
-                        _tgt = (index_date + delta).date().isoformat()
-                        qtext.append(f"ge{_tgt}")
+                        _tgt = (index_date + delta).date()
+                        qtext.append(f"ge{_tgt.isoformat()}")
+                        offsets["window_low"] = _tgt
                     else:
-                        _tgt = (index_date - delta).date().isoformat()
-                        qtext.append(f"le{_tgt}")
+                        _tgt = (index_date - delta).date()
+                        qtext.append(f"le{_tgt.isoformat()}")
+                        offsets["window_high"] = _tgt
             offsets["datequery"] = "&date=".join(qtext) if qtext else ""
-            print(f"{visit} Query: {offsets['datequery']}",)
+            if verbose:
+                print(f"{visit} Query: {offsets['datequery']}",)
+        windows = {}
         for visit, offset in protocol.items():
             if offset.get('skip', False):
-                print(f"Skipping {visit}")
+                if verbose:
+                    print(f"Skipping {visit}")
                 continue
-            state = {}
-            for resource in ("Observation", "Procedure", "AdverseEvent", "MedicationStatement"):
-                if offset["datequery"]:
-                    _dq = offset["datequery"]
-                else:
-                    _dq = offset["datematch"]
-                res = self._get(f"{resource}?patient={research_subject.individual.reference}&date={_dq}")  # type: Bundle
+            if offset["datequery"]:
+                windows[visit] = offset["datequery"]
+            else:
+                windows[visit] = offset["datematch"]
+        patient = research_subject.individual.reference
+        engine = getattr(self._session, 'engine', None)
+        if engine is not None:
+            # a local engine counts all the windows of the subject at once from its date index
+            counts = engine.count_windows(patient, WINDOW_RESOURCES,
+                                          [_dq.split("&date=") for _dq in windows.values()])
+            states = dict(zip(windows.keys(), counts))
+        else:
+            # count the resources in each visit window in parallel, only the totals are needed
+            queries = []
+            for visit, _dq in windows.items():
+                for resource in WINDOW_RESOURCES:
+                    queries.append((visit, resource, f"{resource}?patient={patient}&date={_dq}&_summary=count"))
+            results = self._map(lambda query: self._get(query[2]), queries)
+            states = {}
+            for (visit, resource, _), res in zip(queries, results):  # type: tuple, Bundle
+                state = states.setdefault(visit, {})
                 if res:
                     state[resource] = res.total
-            print(f"Visit: {visit} ({offset['encounter_date']})")
-            print("\t".join(f"{x}: {y}" for x, y in state.items()))
+        if verbose:
+            for visit, state in states.items():
+                print(f"Visit: {visit} ({protocol[visit]['encounter_date']})")
+                print("\t".join(f"{x}: {y}" for x, y in state.items()))
+        rows = []
+        for visit, offsets in protocol.items():
+            row = dict(subject=subject_id,
+                       visit=visit,
+                       status=visit_status(offsets),
+                       encounter_date=offsets.get("encounter_date"),
+                       window_low=offsets.get("window_low"),
+                       window_high=offsets.get("window_high"))
+            row.update({resource: states.get(visit, {}).get(resource) for resource in WINDOW_RESOURCES})
+            rows.append(row)
+        return rows
+
+    def get_cohort_scheme(self, protocol: dict, subjects: Optional[List[str]] = None,
+                          workers: Optional[int] = None) -> Tuple[List[dict], Dict[str, Exception]]:
+        """
+        Evaluates the visit windows for all the subjects of the study (or the given subjects), returns the rows
+        and the subjects that couldn't be evaluated (with the error)
+
+        The ResearchStudy, ResearchSubjects and index PlanDefinition are fetched once for the cohort.
+        """
+        research_subjects = self._get_research_subjects()
+        for research_subject in research_subjects:
+            self._subject_cache.setdefault(research_subject.id, research_subject)
+        if subjects is None:
+            subjects = [x.id for x in research_subjects]
+
+        def evaluate(subject_id):
+            try:
+                return self.get_subject_scheme(subject_id, protocol, False), None
+            except Exception as exc:
+                return None, exc
+
+        # subjects run on their own pool, their count queries go through the request pool
+        with ThreadPoolExecutor(max_workers=workers or self.max_workers) as pool:
+            results = list(pool.map(evaluate, subjects))
+        rows = []
+        failures = {}
+        for subject_id, (result, error) in zip(subjects, results):
+            if error is not None:
+                logger.warning(f"Unable to evaluate subject {subject_id}: {type(error).__name__}: {error}")
+                failures[subject_id] = error
+                continue
+            rows.extend(result or [])
+        print(f"Evaluated {len(subjects) - len(failures)} subjects, {len(rows)} visits"
+              + (f" ({len(failures)} subjects failed)" if failures else ""))
+        return rows, failures
+
+
+def visit_status(offsets: dict) -> str:
+    """
+    Status of a visit, from the processed protocol entry for a subject
+    """
+    if offsets.get("skip"):
+        return "missing"
+    if offsets["is_index"]:
+        return "index"
+    encounter_date = offsets.get("encounter_date")
+    if encounter_date is None:
+        return "missing"
+    if offsets.get("window_low") and encounter_date < offsets["window_low"]:
+        return "out_of_window"
+    if offsets.get("window_high") and encounter_date > offsets["window_high"]:
+        return "out_of_window"
+    return "in_window"
+
+
+def write_table(rows: List[dict], filename: str) -> None:
+    """
+    Write the rows out as CSV, or as Parquet when the filename ends with .parquet
+    """
+    if filename.endswith(".parquet"):
+        import pandas as pd
+        pd.DataFrame(rows).to_parquet(filename, index=False)
+    else:
+        columns = list(rows[0].keys()) if rows else []
+        with open(filename, "w", newline="") as fh:
+            writer = csv.DictWriter(fh, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+    print(f"Wrote {len(rows)} rows to {filename}")
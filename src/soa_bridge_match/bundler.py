@@ -1,32 +1,194 @@
 from __future__ import annotations
-import hashlib
+import contextlib
+import gzip
+import io
+import json
 import os
 import random
 import datetime
-from typing import Optional, List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Optional, List, Dict, Tuple
+from fhir.resources import get_fhir_model_class
 from fhir.resources.bundle import Bundle, BundleEntry, BundleEntryRequest
 
 import uuid
 
-from fhir.resources.patient import Patient, PatientLink
+from fhir.resources.observation import Observation
+from fhir.resources.patient import Patient
 from fhir.resources.plandefinition import PlanDefinition
 from fhir.resources.reference import Reference
 from fhir.resources.researchstudy import ResearchStudy
 from fhir.resources.researchsubject import ResearchSubject
 from fhir.resources.resource import Resource
 
+from .ids import MINTER, hashed_id, patient_id
+from .jsonstream import dump_entry, dumps
+from .query import PATIENT_ELEMENTS, is_common_type
 from .synthea import SyntheaPicker
 
+# the kinds of random observation, Synthea Observation categories
+OBSERVATION_KINDS = ("laboratory", "vital-signs")
 
-def randomise_date(date: datetime.date) -> datetime.date:
+
+def randomise_date(date: datetime.date, rng: Optional[random.Random] = None) -> datetime.date:
+    rng = rng if rng else random
     _date = None
-    if random.random() > 0.5:
-        _date = date + datetime.timedelta(random.randint(10, 2000))
+    if rng.random() > 0.5:
+        _date = date + datetime.timedelta(rng.randint(10, 2000))
     else:
-        _date = date - datetime.timedelta(random.randint(10, 2000))
+        _date = date - datetime.timedelta(rng.randint(10, 2000))
     return _date
 
 
+def _paths(value: Any, path: tuple = ()) -> Iterator[Tuple[tuple, str, str]]:
+    """
+    Walk a resource (as JSON), yielding (path to the container, key, value) for each string
+    """
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, str):
+                yield path, key, item
+            else:
+                yield from _paths(item, path + (key,))
+    elif isinstance(value, list):
+        for idx, item in enumerate(value):
+            if isinstance(item, str):
+                yield path, idx, item
+            else:
+                yield from _paths(item, path + (idx,))
+
+
+def _container(value: Any, path: tuple) -> Any:
+    for key in path:
+        value = value[key]
+    return value
+
+
+class ClonePlan:
+    """
+    Works out how to clone the resources of a subject once, to be applied to any number of new subjects
+
+    The common resources are shared, the resources of the subject are kept as JSON text along with
+    where their references (to the patient and each other) and the strings mentioning the subject
+    or patient are; a clone gets ids hashed from the new patient id so clones don't collide.
+    """
+
+    def __init__(self, entries: List[dict], subject_id: str, filename: str):
+        self.subject_id = subject_id
+        self.filename = filename
+        self.common = []  # type: List[dict]
+        self.patient_id = None
+        # (resourceType, id, JSON, reference paths, text paths) for each resource of the subject
+        self.templates = []  # type: List[Tuple[str, str, str, list, list]]
+        resources = [entry.get("resource") or {} for entry in entries]
+        for resource in resources:
+            if resource.get("resourceType") == "ResearchSubject" and resource.get("id") == subject_id:
+                self.patient_id = resource["individual"]["reference"].split("/")[-1]
+        if self.patient_id is None:
+            raise ValueError(f"Subject {subject_id} does not exist")
+        patient = f"Patient/{self.patient_id}"
+        owned = []
+        for entry, resource in zip(entries, resources):
+            rtype = resource.get("resourceType")
+            if is_common_type(rtype):
+                # shared by all the subjects, copied as-is
+                self.common.append(entry)
+            elif rtype == "Patient" and resource.get("id") == self.patient_id:
+                owned.append(resource)
+            elif rtype == "ResearchSubject":
+                if resource.get("id") == subject_id:
+                    owned.append(resource)
+            elif any(isinstance(resource.get(x), dict) and resource[x].get("reference") == patient
+                     for x in PATIENT_ELEMENTS):
+                owned.append(resource)
+        targets = {f"{x['resourceType']}/{x['id']}" for x in owned}
+        for resource in owned:
+            references, texts = [], []
+            for path, key, value in _paths(resource):
+                if key == "reference" and value in targets:
+                    references.append((path, key))
+                elif key not in ("id", "reference") and (subject_id in value or self.patient_id in value):
+                    texts.append((path, key))
+            self.templates.append((resource["resourceType"], resource["id"], json.dumps(resource),
+                                   references, texts))
+
+    @staticmethod
+    def new_id(new_subject_id: str, new_patient_id: str, resource_type: str, resource_id: str) -> str:
+        """
+        The id of a cloned resource
+        """
+        if resource_type == "ResearchSubject":
+            return new_subject_id
+        if resource_type == "Patient":
+            return new_patient_id
+        return hashed_id(new_patient_id, resource_type, resource_id)
+
+    def clone(self, new_subject_id: str, seed: Optional[int] = None) -> SourcedBundle:
+        """
+        Clone the subject as new_subject_id; with a seed the random changes are seeded by it and the new subject id
+        """
+        rng = random.Random(f"{seed}-{new_subject_id}") if seed is not None else random.Random()
+        new_patient_id = patient_id(new_subject_id)
+        ids = {}
+        for rtype, rid, _, _, _ in self.templates:
+            ids[f"{rtype}/{rid}"] = f"{rtype}/{self.new_id(new_subject_id, new_patient_id, rtype, rid)}"
+        entries = list(self.common)
+        for rtype, rid, text, references, texts in self.templates:
+            resource = json.loads(text)
+            resource["id"] = ids[f"{rtype}/{rid}"].split("/", 1)[1]
+            for path, key in references:
+                container = _container(resource, path)
+                container[key] = ids[container[key]]
+            for path, key in texts:
+                container = _container(resource, path)
+                container[key] = container[key].replace(self.subject_id, new_subject_id) \
+                    .replace(self.patient_id, new_patient_id)
+            if rtype == "Patient":
+                # randomise the date of birth and gender
+                if len(resource.get("birthDate", "")) == 10:
+                    birth_date = datetime.date.fromisoformat(resource["birthDate"])
+                    resource["birthDate"] = randomise_date(birth_date, rng).isoformat()
+                resource["gender"] = rng.choice(["male", "female"])
+                resource.setdefault("link", []).append(dict(type="refer",
+                                                            other=dict(reference=f"Patient/{self.patient_id}")))
+                resource["fhir_comments"] = ["Cloned from Subject {}".format(self.subject_id)]
+            entries.append(dict(resource=resource,
+                                request=dict(method="PUT",
+                                             url=f"{rtype}/{resource['id']}",
+                                             ifNoneExist=f"identifier={resource['id']}")))
+        if self.subject_id in self.filename:
+            filename = self.filename.replace(self.subject_id, new_subject_id)
+        else:
+            stem, ext = os.path.splitext(self.filename)
+            filename = f"{stem}_{new_subject_id}{ext}"
+        bundle = dict(resourceType="Bundle", id=hashed_id(new_patient_id, "Bundle"), type="transaction", entry=entries)
+        return SourcedBundle.from_raw(bundle, filename)
+
+
+# the clone plan in a worker process
+_plan = None  # type: Optional[ClonePlan]
+
+
+def _init_clone_worker(plan: ClonePlan) -> None:
+    global _plan
+    _plan = plan
+
+
+def _clone_subjects(new_subject_ids: List[str], target_dir: Optional[str], seed: Optional[int]) -> List[str]:
+    """
+    Clone and dump a chunk of subjects with the plan of the worker
+    """
+    filenames = []
+    try:
+        for new_subject_id in new_subject_ids:
+            clone = _plan.clone(new_subject_id, seed)
+            filenames.append(clone.dump(target_dir=target_dir))
+    finally:
+        # a pool worker exits without the atexit handlers, write the minted ids before returning
+        MINTER.flush()
+    return filenames
+
+
 class SourcedBundle:
     """
     Wraps the bundle and generation thereof.
@@ -40,7 +202,16 @@ class SourcedBundle:
         self._filename = filename if filename else None
         self._bundle = bundle if bundle else None
         self._entities = {}
+        # (resourceType, id) -> entry and resourceType -> [entry], built on first use
+        self._index = None  # type: Optional[Dict[Tuple[str, str], BundleEntry]]
+        self._types = {}  # type: Dict[str, List[BundleEntry]]
         self._synthea = None
+        # lazy loading; the Bundle as parsed JSON until the models are needed, along with an index of
+        # the raw entries and the resources that have been materialized from them
+        self._raw = None  # type: Optional[dict]
+        self._raw_index = None  # type: Optional[Dict[Tuple[str, str], dict]]
+        self._raw_types = {}  # type: Dict[str, List[dict]]
+        self._materialized = {}  # type: Dict[Tuple[str, str], Resource]
 
     @property
     def synthea_bridge(self):
@@ -56,251 +227,466 @@ class SourcedBundle:
     def dirname(self) -> str:
         return os.path.dirname(self._filename) if self._filename else "."
 
+    @property
+    def is_lazy(self) -> bool:
+        """
+        Whether the entries are still raw JSON
+        """
+        return self._raw is not None
+
+    @property
+    def raw_index(self) -> Dict[Tuple[str, str], dict]:
+        """
+        Index of the raw entries by (resourceType, id), for a lazily loaded bundle
+        """
+        if self._raw_index is None:
+            self._raw_index = {}
+            self._raw_types = {}
+            for entry in self._raw.get("entry") or []:
+                self._index_raw_entry(entry)
+        return self._raw_index
+
+    def _index_raw_entry(self, entry: dict) -> None:
+        resource = entry.get("resource") or {}
+        key = (resource.get("resourceType"), resource.get("id"))
+        if key not in self._raw_index:
+            self._raw_index[key] = entry
+        self._raw_types.setdefault(key[0], []).append(entry)
+
+    def _materialize(self) -> None:
+        """
+        Build the Bundle from the raw JSON, keeping any resources already materialized (they may have changed)
+        """
+        raw_index = self.raw_index
+        bundle = Bundle.parse_obj({key: value for key, value in self._raw.items() if key != "entry"})
+        entries = []
+        for item in self._raw.get("entry") or []:
+            resource = item.get("resource") or {}
+            key = (resource.get("resourceType"), resource.get("id"))
+            entry = BundleEntry.parse_obj({name: value for name, value in item.items() if name != "resource"})
+            if key in self._materialized and raw_index[key] is item:
+                entry.resource = self._materialized[key]
+            else:
+                entry.resource = get_fhir_model_class(key[0]).parse_obj(resource)
+            entries.append(entry)
+        bundle.entry = entries
+        self._bundle = bundle
+        self._raw = None
+        self._raw_index = None
+        self._raw_types = {}
+        self._materialized = {}
+        self._index = None
+        self._entities = {}
+
+    @property
+    def index(self) -> Dict[Tuple[str, str], BundleEntry]:
+        """
+        Index of the bundle entries by (resourceType, id)
+        """
+        if self._index is None:
+            # (materializing a lazy bundle resets the index)
+            bundle = self.bundle
+            self._index = {}
+            self._types = {}
+            for entry in bundle.entry or []:
+                self._index_entry(entry)
+        return self._index
+
+    def _index_entry(self, entry: BundleEntry) -> None:
+        """
+        Add an entry to the indexes, the first entry for a (resourceType, id) wins
+        """
+        resource = entry.resource
+        key = (resource.resource_type, resource.id)
+        if key not in self._index:
+            self._index[key] = entry
+        self._types.setdefault(resource.resource_type, []).append(entry)
+
+    def _ids_of_type(self, resource_type: str) -> List[str]:
+        """
+        Get the (cached) list of ids for a resource type
+        """
+        if resource_type not in self._entities:
+            if self.is_lazy:
+                _ = self.raw_index
+                self._entities[resource_type] = [entry["resource"]["id"]
+                                                 for entry in self._raw_types.get(resource_type, [])]
+            else:
+                # make sure the indexes are built
+                _ = self.index
+                self._entities[resource_type] = [entry.resource.id for entry in self._types.get(resource_type, [])]
+        return self._entities[resource_type]
+
+    def get_resource(self, resource_type: str, resource_id: str) -> Optional[Resource]:
+        """
+        Get a Resource by type and id
+        """
+        if self.is_lazy:
+            key = (resource_type, resource_id)
+            if key not in self._materialized:
+                entry = self.raw_index.get(key)
+                if entry is None:
+                    return None
+                self._materialized[key] = get_fhir_model_class(resource_type).parse_obj(entry["resource"])
+            return self._materialized[key]
+        entry = self.index.get((resource_type, resource_id))
+        return entry.resource if entry else None
+
     @property
     def plan_definitions(self) -> List[str]:
-        if 'PlanDefinition' not in self._entities:
-            for entry in self._bundle.entry:
-                if entry.resource.resource_type == 'PlanDefinition':
-                    self._entities.setdefault('PlanDefinition', []).append(entry.resource.id)
-        return self._entities.get('PlanDefinition', [])
+        return self._ids_of_type('PlanDefinition')
 
     @property
     def subjects(self) -> List[str]:
         """
         Extracts the list of subjects from the bundle
         """
-        if 'ResearchSubject' not in self._entities:
-            for entry in self._bundle.entry:
-                if entry.resource.resource_type == 'ResearchSubject':
-                    self._entities.setdefault('ResearchSubject', []).append(entry.resource.id)
-        return self._entities.get('ResearchSubject', [])
+        return self._ids_of_type('ResearchSubject')
 
     @property
     def studies(self) -> List[str]:
         """
         Extracts the list of studies from the bundle
         """
-        if 'ResearchStudy' not in self._entities:
-            for entry in self._bundle.entry:
-                if entry.resource.resource_type == 'ResearchStudy':
-                    self._entities.setdefault('ResearchStudy', []).append(entry.resource.id)
-        return self._entities.get('ResearchStudy', [])
+        return self._ids_of_type('ResearchStudy')
 
     @property
-    def patients(self) -> List[Patient]:
+    def patients(self) -> List[str]:
         """
         Extracts the list of patients from the bundle
         """
-        if 'Patient' not in self._entities:
-            for entry in self._bundle.entry:
-                if entry.resource.resource_type == 'Patient':
-                    self._entities.setdefault('Patient', []).append(entry.resource.id)
-        return self._entities.get('Patient', [])
+        return self._ids_of_type('Patient')
+
+    @property
+    def encounters(self) -> List[str]:
+        """
+        Extracts the list of encounters from the bundle
+        """
+        return self._ids_of_type('Encounter')
 
     def subject(self, subject_id: str) -> Optional[ResearchSubject]:
         """
-        Get a Patient Resource
+        Get a ResearchSubject Resource
         """
-        for entry in self._bundle.entry:
-            if entry.resource.resource_type == 'ResearchSubject' and entry.resource.id == subject_id:
-                return entry.resource
-        return None
+        return self.get_resource('ResearchSubject', subject_id)
 
     def patient(self, patient_id: str) -> Optional[Patient]:
         """
         Get a Patient Resource
         """
-        for entry in self._bundle.entry:
-            if entry.resource.resource_type == 'Patient' and entry.resource.id == patient_id:
-                return entry.resource
-        return None
+        return self.get_resource('Patient', patient_id)
 
     def study(self, study_id: str) -> Optional[ResearchStudy]:
         """
         Get a Study Resource
         """
-        for entry in self._bundle.entry:
-            if entry.resource.resource_type == 'ResearchStudy' and entry.resource.id == study_id:
-                return entry.resource
-        return None
+        return self.get_resource('ResearchStudy', study_id)
 
     @property
     def bundle(self) -> Bundle:
+        if self.is_lazy:
+            self._materialize()
         if not isinstance(self._bundle, Bundle):
             # create a new bundle
-            self._bundle = Bundle(id=self._identifier, type="transaction")
+            self._bundle = Bundle(id=self._identifier, type="transaction", entry=[])
         return self._bundle
 
     def dump(self, target_dir: Optional[str] = None,
              name: Optional[str] = None,
-             bundle: Optional[Bundle] = None) -> None:
+             bundle: Optional[Bundle] = None,
+             stream: bool = False,
+             indent: Optional[int] = 2,
+             backend: str = "json",
+             compress: bool = False) -> str:
         """
-        Dumps a bundle to a directory
+        Dumps a bundle to a directory, returns the file name
+
+        The document is serialised with the json or orjson backend (indent None for compact output); with
+        stream the entries are written one at a time rather than building the whole document, and compress
+        writes gzip.  The output is the same however it is written.
         """
         if name:
             _fname = name + ".json"
         else:
             _fname = self.filename
+        if compress:
+            _fname += ".gz"
         if target_dir:
             if not os.path.exists(target_dir):
                 os.makedirs(target_dir)
             fname = os.path.join(target_dir, _fname)
         else:
             fname = os.path.join(self.dirname, _fname)
-        with open(fname, 'w') as f:
-            if bundle:
-                f.write(bundle.json(indent=2))
+        with contextlib.ExitStack() as stack:
+            if compress:
+                # no name or timestamp in the gzip header, so the output is the same each time
+                raw = stack.enter_context(open(fname, 'wb'))
+                gz = stack.enter_context(gzip.GzipFile(filename="", mode="wb", fileobj=raw, mtime=0))
+                f = stack.enter_context(io.TextIOWrapper(gz, encoding='utf-8'))
             else:
-                f.write(self._bundle.json(indent=True))
+                f = stack.enter_context(open(fname, 'w', encoding='utf-8'))
+            if self.is_lazy and not bundle:
+                # no need for the models, write the raw JSON
+                self._dump_raw(f, indent, backend)
+            elif stream:
+                self._dump_stream(f, bundle if bundle else self.bundle, indent, backend)
+            else:
+                bundle = bundle if bundle else self.bundle
+                f.write(dumps(bundle.dict(), indent, backend, bundle.__json_encoder__))
+        return fname
+
+    def _dump_raw(self, f, indent: Optional[int], backend: str) -> None:
+        """
+        Writes a lazily loaded bundle from the raw JSON, using the models for the resources materialized
+        """
+        raw_index = self.raw_index
+
+        def entries():
+            for item in self._raw.get("entry") or []:
+                resource = item.get("resource") or {}
+                key = (resource.get("resourceType"), resource.get("id"))
+                if key in self._materialized and raw_index[key] is item:
+                    item = dict(item, resource=self._materialized[key].dict())
+                yield item
+
+        members = [(key, value) for key, value in self._raw.items()]
+        if "entry" not in self._raw:
+            members.append(("entry", None))
+        self._write_bundle(f, members, entries(), indent, backend, Bundle.__json_encoder__)
+
+    @classmethod
+    def _dump_stream(cls, f, bundle: Bundle, indent: Optional[int], backend: str) -> None:
+        """
+        Writes the bundle an entry at a time, the same as serialising the bundle as a whole
+        """
+        header = bundle.copy()
+        header.entry = None
+        members = list(header.dict().items())
+        # put the entries where they belong in the element order
+        sequence = bundle.elements_sequence()
+        following = set(sequence[sequence.index("entry") + 1:])
+        position = next((idx for idx, (key, _) in enumerate(members) if key.lstrip("_") in following),
+                        len(members))
+        members.insert(position, ("entry", None))
+        cls._write_bundle(f, members, (entry.dict() for entry in bundle.entry or []), indent, backend,
+                          bundle.__json_encoder__)
+
+    @staticmethod
+    def _write_bundle(f, members: List[Tuple[str, Any]], entries: Iterable[dict],
+                      indent: Optional[int], backend: str, default: Callable) -> None:
+        """
+        Writes the members of a bundle, with the entries (in place of the `entry` member) one at a time
+        """
+        newline = "\n" if indent is not None else ""
+        prefix = " " * indent if indent is not None else ""
+        separator = ": " if indent is not None else ":"
+        f.write("{" + newline)
+        for idx, (key, value) in enumerate(members):
+            if idx:
+                f.write("," + newline)
+            f.write(f"{prefix}{json.dumps(key)}{separator}")
+            if key != "entry":
+                f.write(dumps(value, indent, backend, default).replace("\n", "\n" + prefix))
+                continue
+            number = -1
+            for number, entry in enumerate(entries):
+                f.write("," + newline if number else "[" + newline)
+                f.write(dump_entry(entry, indent, 2, backend, default))
+            f.write(newline + prefix + "]" if number >= 0 else "[]")
+        f.write(newline + "}")
 
     def add_lab_value(self, subject_id: Optional[str] = None):
-        subject_id = subject_id or random.choice(self.subjects)
-        if subject_id not in self.subjects:
-            raise ValueError(f"Subject {subject_id} does not exist")
-        # get the patient ID
-        patient_id = self.subject(subject_id).individual.reference.split('/')[-1]
-        lab_obs = self.synthea_bridge.get_lab_observation()
-        lab_obs.subject.reference = f"Patient/{patient_id}"
-        lab_obs.fhir_comments = ["This is a synthetic observation"]
-        # remove the encounter reference
-        del lab_obs.encounter
-        # sanitise the lab observation
-        self.add_resource(lab_obs)
+        self.add_observations(1, 'laboratory', [subject_id] if subject_id else None)
 
     def add_vitals_value(self, subject_id: Optional[str] = None):
-        subject_id = subject_id or random.choice(self.subjects)
-        if subject_id not in self.subjects:
-            raise ValueError(f"Subject {subject_id} does not exist")
-        # get the patient ID
-        patient_id = self.subject(subject_id).individual.reference.split('/')[-1]
-        vital_obs = self.synthea_bridge.get_vital_observation()
-        vital_obs.subject.reference = f"Patient/{patient_id}"
-        vital_obs.fhir_comments = ["This is a synthetic observation"]
-        # remove the encounter reference
-        del vital_obs.encounter
-        # sanitise the lab observation
-        self.add_resource(vital_obs)
+        self.add_observations(1, 'vital-signs', [subject_id] if subject_id else None)
+
+    def add_observations(self, count: int, kind: str,
+                         subjects: Optional[List[str]] = None,
+                         seed: Optional[int] = None) -> List[Observation]:
+        """
+        Adds `count` random Synthea Observations of a kind (laboratory or vital-signs) to random subjects
+
+        The subjects default to all the subjects in the bundle; with a seed the same Observations (and ids)
+        are generated for a given Synthea directory.
+        """
+        if kind not in OBSERVATION_KINDS:
+            raise ValueError(f"Unknown kind of observation {kind}")
+        rng = random.Random(seed)
+        subjects = list(subjects) if subjects else self.subjects
+        # get the patient IDs
+        patients = {}
+        for subject_id in subjects:
+            subject = self.subject(subject_id)
+            if subject is None:
+                raise ValueError(f"Subject {subject_id} does not exist")
+            patients[subject_id] = subject.individual.reference.split('/')[-1]
+        chosen = [rng.choice(subjects) for _ in range(count)]
+        observations = self.synthea_bridge.get_observations(kind, count, rng)
+        for subject_id, observation in zip(chosen, observations):
+            # a new id, the same Synthea Observation can be picked more than once
+            observation.id = uuid.UUID(int=rng.getrandbits(128)).hex
+            observation.subject = Reference(reference=f"Patient/{patients[subject_id]}")
+            observation.fhir_comments = ["This is a synthetic observation"]
+            # remove the encounter reference
+            observation.encounter = None
+        self.add_resources(observations)
+        return observations
 
     def add_resource(self, resource: Resource):
         """
         Adds a resource to the bundle
         """
-        for entry in self._bundle.entry:
-            if entry.resource.resource_type == resource.resource_type and entry.resource.id == resource.id:
-                print(f"Resource {resource.resource_type}/{resource.id} already exists in bundle")
-                return
-        else:
-            print("Adding resource to bundle: {}".format(resource.resource_type))
+        if (resource.resource_type, resource.id) in self.index:
+            print(f"Resource {resource.resource_type}/{resource.id} already exists in bundle")
+            return
+        print("Adding resource to bundle: {}".format(resource.resource_type))
+        entry = BundleEntry(resource=resource,
+                            request=BundleEntryRequest(method="PUT",
+                                                       url=f"{resource.resource_type}/{resource.id}",
+                                                       ifNoneExist=f"identifier={resource.id}"))
+        if self.bundle.entry is None:
+            self.bundle.entry = []
+        self.bundle.entry.append(entry)
+        self._index_entry(entry)
+        # invalidate the cached id list for the type
+        self._entities.pop(resource.resource_type, None)
+
+    def add_resources(self, resources: List[Resource]):
+        """
+        Adds a batch of resources to the bundle, skipping any already present
+        """
+        if self.is_lazy:
+            # keep a lazy bundle as JSON
+            self.add_raw_resources([json.loads(resource.json()) for resource in resources])
+            return
+        entries = []
+        skipped = 0
+        for resource in resources:
+            if (resource.resource_type, resource.id) in self.index:
+                skipped += 1
+                continue
             entry = BundleEntry(resource=resource,
                                 request=BundleEntryRequest(method="PUT",
                                                            url=f"{resource.resource_type}/{resource.id}",
                                                            ifNoneExist=f"identifier={resource.id}"))
-            self._bundle.entry.append(entry)
+            # also catches duplicates within the batch
+            self._index_entry(entry)
+            self._entities.pop(resource.resource_type, None)
+            entries.append(entry)
+        if skipped:
+            print(f"Skipped {skipped} resources already in bundle")
+        if entries:
+            print(f"Adding {len(entries)} resources to bundle")
+            if self.bundle.entry is None:
+                self.bundle.entry = []
+            self.bundle.entry.extend(entries)
+
+    def add_raw_resources(self, resources: List[dict]):
+        """
+        Adds a batch of resources as JSON, without parsing them into models while the bundle is lazy
+        """
+        if not self.is_lazy:
+            # the bundle is models already, add the resources as models
+            self.add_resources([get_fhir_model_class(resource["resourceType"]).parse_obj(resource)
+                                for resource in resources])
+            return
+        raw_index = self.raw_index
+        entries = []
+        skipped = 0
+        for resource in resources:
+            key = (resource["resourceType"], resource["id"])
+            if key in raw_index:
+                skipped += 1
+                continue
+            entry = dict(resource=resource,
+                         request=dict(method="PUT",
+                                      url=f"{resource['resourceType']}/{resource['id']}",
+                                      ifNoneExist=f"identifier={resource['id']}"))
+            self._index_raw_entry(entry)
+            self._entities.pop(key[0], None)
+            entries.append(entry)
+        if skipped:
+            print(f"Skipped {skipped} resources already in bundle")
+        if entries:
+            print(f"Adding {len(entries)} resources to bundle")
+            self._raw.setdefault("entry", []).extend(entries)
+
+    def _raw_entries(self) -> List[dict]:
+        """
+        The entries as JSON
+        """
+        if self.is_lazy:
+            return self._raw.get("entry") or []
+        return [json.loads(entry.json()) for entry in self.bundle.entry or []]
+
+    def clone_plan(self, subject_id: Optional[str] = None) -> ClonePlan:
+        """
+        The plan for cloning a subject (by default a random subject in the bundle)
+        """
+        subject_id = subject_id or random.choice(self.subjects)
+        return ClonePlan(self._raw_entries(), subject_id, os.path.join(self.dirname, self.filename))
 
     def clone_subject(self, new_subject_id: str) -> SourcedBundle:
         """
         Clones a patient by taking a random subject in the bundle and creating a new patient with the new_patient_id
         """
-        # get a random subject
-        _subject_id = random.choice(self.subjects)
-        _subject = self.subject(_subject_id)
-        # Get the old subject ID
-        _old_subject_id = _subject.id
-        # get the patient identifer
-        _patient_id = _subject.individual.reference.split('/')[-1]
-        # hashed id
-        _new_patient_id = hashlib.md5(new_subject_id.encode('utf-8')).hexdigest()
-        # create a new bundle
-        _bundle = Bundle(id=str(uuid.uuid4()), type="transaction", entry=[])
-        id_cache = {}
-        for entry in self._bundle.entry:  # type: BundleEntry
-            if entry.resource.resource_type == 'Patient' and entry.resource.id == _patient_id:
-                # remap the patient
-                patient = entry.resource.copy()  # type: Patient
-                # clone the patient
-                patient.id = _new_patient_id
-                # randomise
-                # Randomise the date of birth
-                patient.birthDate = randomise_date(patient.birthDate)
-                # randonise gender
-                _gender = random.choice(["male", "female"])
-                patient.gender = _gender
-                link = PatientLink(type='refer', other=Reference(reference=f"Patient/{_old_subject_id}"))
-                if not getattr(resource, 'link'):
-                    resource.link = []
-                patient.link.append(link)
-                patient.fhir_comments = ["Cloned from Subject {}".format(_old_subject_id)]
-                _entry = BundleEntry(resource=patient,
-                                     request=BundleEntryRequest(method="PUT",
-                                                                url=f"{resource.resource_type}/{resource.id}",
-                                                                ifNoneExist=f"identifier={resource.id}"))
-
-                # add the patient to the bundle
-                _bundle.entry.append(_entry)
-            elif entry.resource.resource_type == 'ResearchSubject' \
-                    and entry.resource.id == _subject.id:
-                resource = entry.resource.copy()
-                # clone the subject
-                resource.id = new_subject_id
-                resource.individual.reference = f"Patient/{_new_patient_id}"
-
-                _entry = BundleEntry(resource=resource,
-                                     request=BundleEntryRequest(method="PUT",
-                                                                url=f"{resource.resource_type}/{resource.id}",
-                                                                ifNoneExist=f"identifier={resource.id}"))
-
-                # add the subject to the bundle
-                _bundle.entry.append(_entry)
-            elif entry.resource.resource_type in ("ResearchStudy", "Group", "Organization",
-                                                  "Practitioner", "Medication") \
-                    or entry.resource.resource_type.endswith('Definition'):
-                # add the common entities to the bundle
-                _bundle.entry.append(entry)
-            elif entry.resource.subject.reference == f"Patient/{_patient_id}":
-                # id resources where the subject is the patient
-                resource = entry.resource.copy()
-                resource.subject.reference = f"Patient/{_new_patient_id}"
-                if getattr(resource.subject, 'display', None):
-                    resource.subject.display = new_subject_id
-                if resource.resource_type == "CarePlan":
-                    # clear this up
-                    resource.title = resource.title.replace(_subject_id, new_subject_id)
-
-                # need a deterministic id
-                hashed_id = hashlib.md5(
-                    f"{_patient_id}-{resource.resource_type}-{resource.id}".encode('utf-8')).hexdigest()
-                # need to map the IDs
-                resource.id = hashed_id
-                if getattr(resource, 'contained', None):
-                    for contained in resource.contained:
-                        # Look for contained references
-                        if hasattr(contained, 'subject'):
-                            # map to the new ID
-                            contained.subject.reference = f"Patient/{_new_patient_id}"
-                _entry = BundleEntry(resource=resource,
-                                     request=BundleEntryRequest(method="PUT",
-                                                                url=f"{resource.resource_type}/{resource.id}",
-                                                                ifNoneExist=f"identifier={resource.id}"))
-                # add the cloned entity
-                _bundle.entry.append(_entry)
-            instance = SourcedBundle(bundle=_bundle,
-                                     identifier=str(_bundle.identifier),
-                                     filename=self.filename.replace(_old_subject_id, _new_patient_id))
-        return instance
+        return self.clone_plan().clone(new_subject_id)
+
+    def clone_subjects(self, new_subject_ids: List[str],
+                       subject_id: Optional[str] = None,
+                       target_dir: Optional[str] = None,
+                       workers: int = 1,
+                       seed: Optional[int] = None) -> List[str]:
+        """
+        Clones a subject (by default a random subject) as each of the new subjects, writing a bundle per clone
+
+        The plan for the clone is worked out once and shared with the worker processes; returns the file names
+        """
+        plan = self.clone_plan(subject_id)
+        print(f"Cloning subject {plan.subject_id} as {len(new_subject_ids)} subjects")
+        new_subject_ids = list(new_subject_ids)
+        if workers <= 1:
+            _init_clone_worker(plan)
+            return _clone_subjects(new_subject_ids, target_dir, seed)
+        # a few chunks per worker, to even out the load
+        size = max(1, len(new_subject_ids) // (workers * 4))
+        chunks = [new_subject_ids[idx:idx + size] for idx in range(0, len(new_subject_ids), size)]
+        filenames = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_clone_worker, initargs=(plan,)) as executor:
+            for names in executor.map(_clone_subjects, chunks, [target_dir] * len(chunks), [seed] * len(chunks)):
+                filenames.extend(names)
+        return filenames
 
     @classmethod
-    def from_bundle_file(cls, filename: str):
+    def from_bundle_file(cls, filename: str, lazy: bool = False):
         """
         Convert a FHIR Bundle to a SourcedBundle
+
+        With lazy the entries are kept as raw JSON; a resource is only parsed into a model when it is
+        got (`get_resource`, `subject`...) and the whole bundle when `bundle` is used (eg to add a resource).
         """
         if not os.path.exists(filename):
             raise ValueError("File does not exist")
+        if lazy:
+            with open(filename, encoding="utf-8") as fh:
+                raw = json.load(fh)
+            return cls.from_raw(raw, filename)
         bundle = Bundle.parse_file(filename)
         return cls(bundle, bundle.id, filename)
 
+    @classmethod
+    def from_raw(cls, raw: dict, filename: Optional[str] = None):
+        """
+        Create a (lazy) SourcedBundle from a Bundle as JSON
+        """
+        instance = cls(None, raw.get("id"), filename)
+        instance._raw = raw
+        return instance
+
     @classmethod
     def from_bundle(cls, bundle: Bundle):
         """
         Convert a FHIR Bundle to a SourcedBundle
         """
-        return cls(bundle, bundle.id)
+        return cls(bundle, bundle.id, None)
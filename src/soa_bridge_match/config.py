@@ -1,6 +1,9 @@
 
+import os
+import pickle
+from typing import Dict, List, Optional, Set, Tuple
+
 import pandas as pd
-from typing import List
 
 import yaml
 
@@ -9,7 +12,7 @@ class Configuration:
 
     def __init__(self, config) -> None:
         self._config = config
-    
+
     @classmethod
     def from_file(cls, filename: str) -> "Configuration":
         """
@@ -17,38 +20,217 @@ class Configuration:
         """
         with open(filename, "r") as f:
             config = yaml.safe_load(f)
-        return cls(**config)
-    
+        return cls(config)
+
     def columns(self):
         for column in self._config["columns"]:
             yield column
-    
+
+    def mappings(self):
+        """
+        The columns with the resource type -> element mapping for each
+        """
+        for column, targets in self._config["columns"].items():
+            yield column, targets
+
     def keys(self) -> List[str]:
-        return self._config["keys"]
+        keys = self._config["key"]
+        return [keys] if isinstance(keys, str) else keys
+
+    def defaults(self) -> Dict[str, dict]:
+        """
+        The fixed content for each resource type
+        """
+        return self._config.get("defaults") or {}
+
 
+# the LOINC to LB mapping document
+LOINC_MAPPING = os.path.join(os.path.dirname(__file__), "..", "..", "doc", "resources",
+                             "LOINC_to_LB_Mapping Document_FINAL.csv")
+
+# the LOINC systems (specimens) for each LBCAT, in order of preference
+LBCAT_SYSTEMS = {
+    "HEMATOLOGY": ('Ser/Plas', 'Plas', 'Bld'),
+    "URINALYSIS": ('Urine',),
+    "CHEMISTRY": ('Ser/Plas', 'Serum', 'Ser', 'Ser/Plas/Bld'),
+}
+
+MAPPER_VERSION = 2
 
-LBCAT = {'HEMATOLOGY'}
 
 class TestCodeMapper:
-    
-    def __init__(self, config: Configuration):
+    """
+    Maps LB tests to LOINC codes using the LOINC to LB mapping document
+
+    The document is compiled into a dict keyed by (LBTESTCD, LBCAT or LBSPEC, unit), along with a
+    (LBTESTCD, LBCAT or LBSPEC, None) key for the preferred code whatever the unit, and the LOINC
+    property (eg MCnc) of each code and of the example units; the compiled index can be saved and loaded
+    (and is when a cache_file is given and the document hasn't changed).
+    """
+
+    def __init__(self, config: Optional[Configuration] = None, source: str = LOINC_MAPPING,
+                 cache_file: Optional[str] = None):
         self._config = config
+        self._source = source
+        self._cache_file = cache_file
         self._dataset = None
-    
+        self._index = None  # type: Optional[Dict[Tuple[str, str, Optional[str]], str]]
+        self._names = {}  # type: Dict[str, str]
+        self._properties = {}  # type: Dict[str, str]
+        self._unit_properties = {}  # type: Dict[str, Set[str]]
+
     @property
-    def dataset(self):
-        if not self._dataset:
-            self._dataset = pd.load_csv("resources/LOINC_to_LB_Mapping Document_FINAL.csv")
+    def dataset(self) -> pd.DataFrame:
+        if self._dataset is None:
+            self._dataset = pd.read_csv(self._source, dtype=str)
         return self._dataset
 
-    def map(self, lbtestcd: str, lbcat: str) -> str:
+    @property
+    def signature(self) -> List[int]:
+        stat = os.stat(self._source)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    @property
+    def index(self) -> Dict[Tuple[str, str, Optional[str]], str]:
+        if self._index is None:
+            if self._cache_file and os.path.exists(self._cache_file):
+                self._restore(self._cache_file)
+            if self._index is None:
+                self.compile()
+                if self._cache_file:
+                    self.save(self._cache_file)
+        return self._index
+
+    def compile(self) -> None:
+        """
+        Compile the mapping document into the index
+        """
+        dataset = self.dataset.dropna(subset=["CDISC LBTESTCD", "LOINC Code"]).copy()
+        # prefer the plainest test (a point in time, not fasting, no timepoint or method), then the order
+        # of the document
+        dataset["qualified"] = ((dataset["Time Aspect"] != "Pt").astype(int) +
+                                dataset[["CDISC LBFAST", "CDISC LBTPT", "Method"]].notna().sum(axis=1))
+        dataset = dataset.sort_values("qualified", kind="stable")
+        index = {}
+        names = {}
+        properties = {}
+        unit_properties = {}
+        for row in dataset[["CDISC LBTESTCD", "System", "CDISC LBSPEC", "EXAMPLE CDISC LBORRESU",
+                            "LOINC Code", "LOINC Short Name", "Property"]].itertuples(index=False):
+            testcd, system, spec, unit, code, name, prop = row
+            unit = unit if isinstance(unit, str) and not unit.startswith("(") else None
+            names.setdefault(code, name if isinstance(name, str) else None)
+            if isinstance(prop, str):
+                properties.setdefault(code, prop)
+                if unit:
+                    unit_properties.setdefault(unit, set()).add(prop)
+            if isinstance(spec, str):
+                index.setdefault((testcd, spec, unit), code)
+                index.setdefault((testcd, spec, None), code)
+        for lbcat, systems in LBCAT_SYSTEMS.items():
+            # the systems in order of preference
+            candidates = dataset[dataset["System"].isin(systems)].copy()
+            candidates["preference"] = candidates["System"].map({x: idx for idx, x in enumerate(systems)})
+            candidates = candidates.sort_values(["preference", "qualified"], kind="stable")
+            for testcd, unit, code in candidates[["CDISC LBTESTCD", "EXAMPLE CDISC LBORRESU",
+                                                  "LOINC Code"]].itertuples(index=False):
+                if isinstance(unit, str) and not unit.startswith("("):
+                    index.setdefault((testcd, lbcat, unit), code)
+                index.setdefault((testcd, lbcat, None), code)
+        self._index = index
+        self._names = names
+        self._properties = properties
+        self._unit_properties = unit_properties
+
+    def save(self, filename: str) -> None:
+        """
+        Save the compiled index
+        """
+        with open(filename + ".tmp", "wb") as fh:
+            pickle.dump(dict(version=MAPPER_VERSION, signature=self.signature, index=self.index, names=self._names,
+                             properties=self._properties, unit_properties=self._unit_properties),
+                        fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(filename + ".tmp", filename)
+
+    def _restore(self, filename: str) -> None:
+        """
+        Load a compiled index, if it was compiled from the current mapping document
+        """
+        with open(filename, "rb") as fh:
+            stored = pickle.load(fh)
+        if stored.get("version") == MAPPER_VERSION and stored.get("signature") == self.signature:
+            self._index = stored["index"]
+            self._names = stored["names"]
+            self._properties = stored["properties"]
+            self._unit_properties = stored["unit_properties"]
+
+    @classmethod
+    def load(cls, filename: str, source: str = LOINC_MAPPING) -> "TestCodeMapper":
+        """
+        Load a saved mapper
+        """
+        mapper = cls(source=source)
+        with open(filename, "rb") as fh:
+            stored = pickle.load(fh)
+        mapper._index = stored["index"]
+        mapper._names = stored["names"]
+        mapper._properties = stored.get("properties", {})
+        mapper._unit_properties = stored.get("unit_properties", {})
+        return mapper
+
+    def map(self, lbtestcd: str, lbcat: str, unit: Optional[str] = None, lbspec: Optional[str] = None) -> Optional[str]:
         """
-        Map a code to a test
+        Map a test to a LOINC code, preferring a code for the unit (for the specimen, when given, then the category)
+
+        Without a code for the unit, the preferred code for the test is used only when it measures the same
+        property as the unit (or the property of the unit isn't known); otherwise there's no code.
+        """
+        index = self.index
+        categories = [x for x in (lbspec, lbcat) if x]
+        unit = unit or None
+        if unit is not None:
+            for category in categories:
+                code = index.get((lbtestcd, category, unit))
+                if code:
+                    return code
+        for category in categories:
+            code = index.get((lbtestcd, category, None))
+            # not a code for a different property (eg a mass concentration for a mmol/L result)
+            if code and (unit is None or self.measures(code, unit)):
+                return code
+        return None
+
+    def measures(self, code: str, unit: str) -> bool:
+        """
+        Whether a LOINC code could be reported in the unit, going by the LOINC properties of the unit
+        """
+        _ = self.index
+        properties = self._unit_properties.get(unit)
+        return not properties or self._properties.get(code) in properties
+
+    def name(self, code: str) -> Optional[str]:
+        """
+        The short name for a LOINC code
+        """
+        _ = self.index
+        return self._names.get(code)
+
+    def map_frame(self, df: pd.DataFrame, unit_column: str = "LBORRESU", column: str = "LBLOINC") -> pd.DataFrame:
+        """
+        Annotate an LB dataset with the LOINC codes (in `column`), keeping any codes already there
+
+        Each distinct (LBTESTCD, LBCAT, LBSPEC, unit) is mapped once and merged back onto the rows.
         """
-        if lbcat == "HEMATOLOGY":
-            system = ('Ser/Plas', 'Plas', 'Bld')
-        elif lbcat == "UNRINALYSIS":
-            system = ('Urine')
-        elif lbcat == "CHEMISTRY":
-            system = ('Ser/Plas', 'Serum', 'Ser', 'Ser/Plas/Bld')
-    
\ No newline at end of file
+        keys = [x for x in ("LBTESTCD", "LBCAT", "LBSPEC", unit_column) if x in df.columns]
+        distinct = df[keys].drop_duplicates().copy()
+        distinct["_loinc"] = [self.map(row.get("LBTESTCD"), row.get("LBCAT"), row.get(unit_column) or None,
+                                       row.get("LBSPEC") or None)
+                              for row in distinct.to_dict("records")]
+        mapped = df.merge(distinct, on=keys, how="left")
+        mapped.index = df.index
+        if column in df.columns:
+            existing = df[column].where(df[column].astype(str).str.strip() != "")
+            mapped[column] = existing.fillna(mapped["_loinc"])
+        else:
+            mapped[column] = mapped["_loinc"]
+        return mapped.drop(columns="_loinc")
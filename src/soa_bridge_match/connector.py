@@ -1,11 +1,29 @@
+import glob
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import Counter, OrderedDict
+from urllib.error import HTTPError, URLError
 from urllib.request import urlopen
+import numpy as np
 import pandas as pd
-from typing import Optional
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
 from pandas import DataFrame
+from dotenv import load_dotenv
+
+load_dotenv()
 
 # define a prefix for the CDISC Pilot Datasets
 PREFIX = "https://github.com/phuse-org/phuse-scripts/raw/master/data/sdtm/cdiscpilot01/"
 
+# default location for the local copy of the datasets (override with SOA_BRIDGE_CACHE_DIR)
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "soa-bridge-match")
+
+# default memory limit for the loaded datasets (override with SOA_BRIDGE_CACHE_MEMORY, in bytes)
+MAX_MEMORY = 2 * 1024 ** 3
+
 
 def check_link(url: str) -> bool:
     """
@@ -14,22 +32,305 @@ def check_link(url: str) -> bool:
     # this will attempt to open the URL, and extract the response status code
     # - status codes are a HTTP convention for responding to requests
     # 200 - OK
-    # 403 - Not authorized   
-    # 404 - Not found   
+    # 403 - Not authorized
+    # 404 - Not found
     status_code = urlopen(url).getcode()
     return status_code == 200
 
 
+def read_xpt(source: str) -> DataFrame:
+    """
+    Read a SAS Transport file and coerce the date columns
+    @param source: path or URL for the XPT file
+    """
+    # let pandas work it out
+    dataset = pd.read_sas(source, encoding="utf-8", format="xport")
+    # need to infer datatypes
+    for datecol in [x for x in dataset.columns if x.endswith("DTC")]:
+        dataset[datecol] = pd.to_datetime(dataset[datecol])
+    return dataset
+
+
 # List of datasets
 DATASETS = ["AE", "CM", "DM", "DS", "EX", "LB", "MH", "QS", "RELREC", "SC", "SE",
             "SUPPAE", "SUPPDM", "SUPPDS",
             "SUPPLB", "SV", "TA", "TV", "TI", "TS", "TV", "VS"]
 
 
+class DatasetStore:
+    """
+    Local mirror of the CDISC Pilot XPT files, along with a parsed copy of each dataset
+
+    The directory can be pre-seeded with the XPT files (eg `dm.xpt`) for offline use; the parsed
+    dataset is keyed by the domain and the SHA-256 of the XPT file so a changed file is reparsed.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, path: str, offline: bool = False) -> None:
+        self.path = path
+        self.offline = offline
+        self._manifest = None
+
+    def xpt_path(self, domain_prefix: str) -> str:
+        return os.path.join(self.path, f"{domain_prefix.lower()}.xpt")
+
+    def parsed_path(self, domain_prefix: str, digest: str) -> str:
+        return os.path.join(self.path, f"{domain_prefix.lower()}-{digest[:16]}.pkl")
+
+    @property
+    def manifest(self) -> dict:
+        """
+        Digests of the mirrored XPT files, keyed by domain
+        """
+        if self._manifest is None:
+            _fname = os.path.join(self.path, self.MANIFEST)
+            if os.path.exists(_fname):
+                with open(_fname, "r") as f:
+                    self._manifest = json.load(f)
+            else:
+                self._manifest = {}
+        return self._manifest
+
+    def _save_manifest(self) -> None:
+        _fname = os.path.join(self.path, self.MANIFEST)
+        with open(_fname + ".tmp", "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(_fname + ".tmp", _fname)
+
+    def has(self, domain_prefix: str) -> bool:
+        """
+        check if the XPT file is in the mirror
+        """
+        return os.path.exists(self.xpt_path(domain_prefix))
+
+    def fetch(self, domain_prefix: str) -> bool:
+        """
+        download the XPT file from the GitHub site into the mirror
+        """
+        if self.offline:
+            return False
+        target = f"{PREFIX}{domain_prefix.lower()}.xpt"
+        try:
+            response = urlopen(target)
+        except (HTTPError, URLError, OSError):
+            # not there, or no network (offline, DNS failure)
+            return False
+        if response.getcode() != 200:
+            return False
+        os.makedirs(self.path, exist_ok=True)
+        _fname = self.xpt_path(domain_prefix)
+        with open(_fname + ".tmp", "wb") as f:
+            f.write(response.read())
+        os.replace(_fname + ".tmp", _fname)
+        return True
+
+    def digest(self, domain_prefix: str) -> str:
+        """
+        SHA-256 of the mirrored XPT file, only rehashed when the file has changed
+        """
+        _fname = self.xpt_path(domain_prefix)
+        stat = os.stat(_fname)
+        record = self.manifest.get(domain_prefix.upper())
+        if record and record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns:
+            return record["sha256"]
+        sha = hashlib.sha256()
+        with open(_fname, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        self.manifest[domain_prefix.upper()] = dict(size=stat.st_size,
+                                                    mtime_ns=stat.st_mtime_ns,
+                                                    sha256=sha.hexdigest())
+        self._save_manifest()
+        return sha.hexdigest()
+
+    def load(self, domain_prefix: str) -> Optional[DataFrame]:
+        """
+        load a dataset from the mirror, downloading and parsing it if required
+        """
+        if not self.has(domain_prefix) and not self.fetch(domain_prefix):
+            return None
+        digest = self.digest(domain_prefix)
+        parsed = self.parsed_path(domain_prefix, digest)
+        if os.path.exists(parsed):
+            return pd.read_pickle(parsed)
+        dataset = read_xpt(self.xpt_path(domain_prefix))
+        # drop any copies parsed from a previous version of the file
+        for stale in glob.glob(os.path.join(self.path, f"{domain_prefix.lower()}-*.pkl")):
+            os.remove(stale)
+        dataset.to_pickle(parsed + ".tmp", compression=None)
+        os.replace(parsed + ".tmp", parsed)
+        return dataset
+
+
+class SubjectIndex:
+    """
+    Rows of a dataset grouped by subject, so the rows for a subject are a slice rather than a mask
+
+    The rows are stably sorted by subject (in order of first appearance) once, and the offsets of each
+    subject are recorded; the rows for a subject keep their original order.
+    """
+
+    def __init__(self, dataset: DataFrame, column: str = "USUBJID") -> None:
+        codes, uniques = pd.factorize(dataset[column])
+        keep = codes >= 0
+        order = np.argsort(codes[keep], kind="stable")
+        self._dataset = dataset[keep].iloc[order]
+        stops = np.cumsum(np.bincount(codes[keep], minlength=len(uniques)))
+        starts = stops - np.bincount(codes[keep], minlength=len(uniques))
+        self._offsets = dict(zip(uniques.tolist(), zip(starts.tolist(), stops.tolist())))
+        self._subjects = tuple(uniques.tolist())
+
+    @property
+    def subjects(self) -> Tuple[str, ...]:
+        """
+        subjects in order of first appearance in the dataset
+        """
+        return self._subjects
+
+    @property
+    def dataset(self) -> DataFrame:
+        return self._dataset
+
+    def __contains__(self, subject_id: str) -> bool:
+        return subject_id in self._offsets
+
+    def __len__(self) -> int:
+        return len(self._subjects)
+
+    def __sizeof__(self) -> int:
+        return _sizeof(self._dataset)
+
+    def get(self, subject_id: str) -> DataFrame:
+        """
+        rows for the subject (empty if the subject has none)
+        """
+        start, stop = self._offsets.get(subject_id, (0, 0))
+        return self._dataset.iloc[start:stop]
+
+
+def _sizeof(value: Any) -> int:
+    """
+    approximate memory footprint of a cached value
+    """
+    if value is None:
+        return 0
+    if isinstance(value, DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    return sys.getsizeof(value)
+
+
+class DatasetRegistry:
+    """
+    Thread-safe cache of the loaded datasets, shared across the Connector instances
+
+    Values are evicted least recently used first once the memory limit is exceeded; each key is
+    loaded at most once at a time, concurrent callers wait for the first load to complete.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None) -> None:
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self._items = OrderedDict()  # type: OrderedDict[Hashable, tuple]
+        self._loading = {}  # type: Dict[Hashable, threading.Lock]
+        self._size = 0
+        self._hits = Counter()
+        self._misses = Counter()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._items
+
+    def _lookup(self, key: Hashable):
+        # caller holds the lock
+        self._items.move_to_end(key)
+        self._hits[key] += 1
+        return self._items[key][0]
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """
+        get a value from the registry, calling the loader if it is not present
+        """
+        with self._lock:
+            if key in self._items:
+                return self._lookup(key)
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                if key in self._items:
+                    # loaded while we were waiting
+                    return self._lookup(key)
+            value = loader()
+            with self._lock:
+                self._misses[key] += 1
+                self.put(key, value)
+                self._loading.pop(key, None)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        add a value to the registry, evicting the least recently used values if over the limit
+        """
+        with self._lock:
+            if key in self._items:
+                self._size -= self._items.pop(key)[1]
+            size = _sizeof(value)
+            self._items[key] = (value, size)
+            self._size += size
+            while self.max_bytes is not None and self._size > self.max_bytes and len(self._items) > 1:
+                _, (_, _size) = self._items.popitem(last=False)
+                self._size -= _size
+
+    def items(self) -> dict:
+        """
+        snapshot of the cached values, eg to seed the registry in a worker process
+        """
+        with self._lock:
+            return {key: value for key, (value, _) in self._items.items()}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+            self._hits.clear()
+            self._misses.clear()
+
+    def stats(self) -> dict:
+        """
+        hit/miss counters, overall and per key; a miss is a load
+        """
+        with self._lock:
+            keys = sorted(set(self._hits) | set(self._misses), key=str)
+            return dict(hits=sum(self._hits.values()),
+                        misses=sum(self._misses.values()),
+                        size=self._size,
+                        entries=len(self._items),
+                        keys={key: dict(hits=self._hits[key], misses=self._misses[key]) for key in keys})
+
+
+# the registry shared by all the Connector instances in the process
+REGISTRY = DatasetRegistry(max_bytes=int(os.getenv("SOA_BRIDGE_CACHE_MEMORY", MAX_MEMORY)))
+
+
 class Connector:
-    def __init__(self) -> None:
-        self.__cache = {}
+    def __init__(self, cache_dir: Optional[str] = None, offline: bool = False,
+                 registry: Optional[DatasetRegistry] = None) -> None:
         self.__exists = {}
+        self._store = DatasetStore(cache_dir or os.getenv("SOA_BRIDGE_CACHE_DIR", CACHE_DIR),
+                                   offline=offline)
+        self._registry = registry if registry is not None else REGISTRY
+
+    @property
+    def store(self) -> DatasetStore:
+        return self._store
+
+    @property
+    def registry(self) -> DatasetRegistry:
+        return self._registry
 
     def exists(self, domain_prefix: str):
         """
@@ -37,29 +338,37 @@ class Connector:
         @param domain_prefix: the Domain Prefix for the Domain (eg DM, VS)
         """
         if domain_prefix not in self.__exists:
-            # define the target for our read_sas directive
-            target = f"{PREFIX}{domain_prefix.lower()}.xpt"
-            # make sure that the URL exists first
-            self.__exists[domain_prefix] = check_link(target)
+            if self._store.has(domain_prefix):
+                self.__exists[domain_prefix] = True
+            elif self._store.offline:
+                self.__exists[domain_prefix] = False
+            else:
+                # define the target for our read_sas directive
+                target = f"{PREFIX}{domain_prefix.lower()}.xpt"
+                # make sure that the URL exists first
+                self.__exists[domain_prefix] = check_link(target)
 
         return self.__exists[domain_prefix]
 
     def load_cdiscpilot_dataset(self, domain_prefix: str) -> Optional[DataFrame]:
         """
-        load a CDISC Pilot Dataset from the GitHub site
+        load a CDISC Pilot Dataset, using the local mirror where possible
         @param domain_prefix: the Domain Prefix for the Domain (eg DM, VS)
         """
-        if domain_prefix not in self.__cache:
-            # define the target for our read_sas directive
-            target = f"{PREFIX}{domain_prefix.lower()}.xpt"
-            # make sure that the URL exists first
-            if check_link(target):
-                # let pandas work it out
-                dataset = pd.read_sas(target, encoding="utf-8", format="xport")
-                # need to infer datatypes
-                for datecol in [x for x in dataset.columns if x.endswith("DTC")]:
-                    dataset[datecol] = pd.to_datetime(dataset[datecol])
-                self.__cache[domain_prefix] = dataset
-            else:
-                self.__cache[domain_prefix] = None
-        return self.__cache[domain_prefix]
+        return self._registry.get((self._store.path, domain_prefix.upper()),
+                                  lambda: self._store.load(domain_prefix))
+
+    def subject_index(self, domain_prefix: str) -> SubjectIndex:
+        """
+        load a CDISC Pilot Dataset grouped by USUBJID, raises a ValueError if the dataset can't be loaded
+        @param domain_prefix: the Domain Prefix for the Domain (eg DM, VS)
+        """
+
+        def _build():
+            dataset = self.load_cdiscpilot_dataset(domain_prefix)
+            if dataset is None:
+                raise ValueError(f"The {domain_prefix.upper()} dataset is not in {self._store.path} "
+                                 f"and could not be downloaded")
+            return SubjectIndex(dataset)
+
+        return self._registry.get((self._store.path, domain_prefix.upper(), "USUBJID"), _build)
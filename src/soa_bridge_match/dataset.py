@@ -1,8 +1,9 @@
 from __future__ import annotations
 
-import hashlib
 import os
-from typing import Optional
+from typing import List, Optional
+
+import pandas as pd
 
 from fhir.resources.bundle import Bundle
 from fhir.resources.careplan import CarePlan
@@ -12,30 +13,58 @@ from fhir.resources.identifier import Identifier
 from fhir.resources.patient import Patient
 from fhir.resources.period import Period
 from fhir.resources.reference import Reference
+from fhir.resources.resource import Resource
 from fhir.resources.servicerequest import ServiceRequest
 
 from .bundler import SourcedBundle
 from .connector import Connector
+from . import ids
+from .ids import MINTER
+from .transform import TransformEngine
 
 
-def hh(s: str) -> str:
-    return hashlib.md5(s.encode('utf-8')).hexdigest()
+# visit number (as a string) to the PlanDefinition for the visit, None for the unscheduled visits
+VISIT_PLAN_DEFINITIONS = {"1.0": "H2Q-MC-LZZT-Study-Visit-1",
+                          "2.0": "H2Q-MC-LZZT-Study-Visit-2",
+                          "3.0": "H2Q-MC-LZZT-Study-Visit-3",
+                          "3.5": None,
+                          "4.0": "H2Q-MC-LZZT-Study-Visit-4",
+                          "5.0": "H2Q-MC-LZZT-Study-Visit-5",
+                          "6.0": "H2Q-MC-LZZT-Study-Visit-6",
+                          "7.0": "H2Q-MC-LZZT-Study-Visit-7",
+                          "8.0": "H2Q-MC-LZZT-Study-Visit-8",
+                          "8.1": None,
+                          "9.0": "H2Q-MC-LZZT-Study-Visit-9",
+                          "9.1": None,
+                          "10.0": "H2Q-MC-LZZT-Study-Visit-10",
+                          "10.1": None,
+                          "11.0": "H2Q-MC-LZZT-Study-Visit-11",
+                          "11.1": None,
+                          "12.0": "H2Q-MC-LZZT-Study-Visit-12",
+                          "13.0": "H2Q-MC-LZZT-Study-Visit-13",
+                          "101.0": "H2Q-MC-LZZT-Study-ET-14",
+                          "201.0": "H2Q-MC-LZZT-Study-RT-15",
+                          "501.0": None}
 
 
 class Naptha:
 
     def __init__(self, templatefile: Optional[str],
-                 templatecontent: Optional[Bundle] = None) -> None:
-        self._connector = Connector()
+                 templatecontent: Optional[Bundle] = None,
+                 connector: Optional[Connector] = None,
+                 lazy: bool = False) -> None:
+        # the connector shares the loaded datasets across instances
+        self._connector = connector if connector else Connector()
         self._subjects = {}
         self._patients = {}
         self._subjects = {}
         self._synthea = None
+        self._engine = None
         # load the template
         if templatecontent:
             self._content = templatecontent
         else:
-            self._content = SourcedBundle.from_bundle_file(templatefile)
+            self._content = SourcedBundle.from_bundle_file(templatefile, lazy=lazy)
 
     @property
     def content(self):
@@ -49,18 +78,21 @@ class Naptha:
         """
         Get the list of subjects from the CDISC Pilot Dataset
         """
-        dataset = self._connector.load_cdiscpilot_dataset("DM")
-        return dataset.USUBJID.unique()
+        return self._connector.subject_index("DM").subjects
+
+    def has_subject(self, subject_id: str) -> bool:
+        """
+        Check if the subject is in the CDISC Pilot Dataset
+        """
+        return subject_id in self._connector.subject_index("DM")
 
     def get_subject_data(self, subject_id: str, domain: str):
         """
         Get the data for a subject for a given domain
         """
-        if subject_id not in self.get_subjects():
+        if not self.has_subject(subject_id):
             raise ValueError(f"Subject {subject_id} does not exist")
-        dataset = self._connector.load_cdiscpilot_dataset(domain)
-        dataset = dataset[dataset.USUBJID == subject_id]
-        return dataset
+        return self._connector.subject_index(domain).get(subject_id)
 
     def get_subject_cm(self, subject_id: str):
         """
@@ -80,24 +112,24 @@ class Naptha:
         """
         return self.get_subject_data(subject_id, "SV")
 
-    # def parse_dataset(self, dataset_name: str):
-    #     """
-    #     Parse a CDISC Pilot Dataset
-    #     """
-    #     if not os.path.exists(os.path.join("../../doc/config", f"{dataset_name}.yml")):
-    #         print("Unable to process configuration file")
-    #     config = Configuration.from_file(os.path.join("../../doc/config", f"{dataset_name}.yml"))
-    #     _columns = [x for x in config.columns()]
-    #     dataset = self._connector.load_cdiscpilot_dataset(dataset_name)
-    #     for offset, record in enumerate(dataset.iterrows()):
-    #         # generate a patient resource
-    #         patient = self._generate_patient(record.USUBJID)
-    #         # generate a bundle
-    #         bundle = Bundle()
-    #         # add the patient to the bundle
-    #         bundle.add_entry(patient)
-    #         # add the bundle to the content
-    #         self.content.add_entry(bundle)
+    @property
+    def engine(self) -> TransformEngine:
+        if self._engine is None:
+            self._engine = TransformEngine()
+        return self._engine
+
+    def parse_dataset(self, dataset_name: str, resource_type: str = "Observation",
+                      subject_id: Optional[str] = None) -> List[dict]:
+        """
+        Build the resources for a CDISC Pilot Dataset using the column mapping (doc/config), for a subject
+        or (by default) all the subjects in the bundle
+        """
+        subject_ids = [subject_id] if subject_id else self.content.subjects
+        index = self._connector.subject_index(dataset_name)
+        slices = [index.get(x) for x in subject_ids if x in index]
+        if not slices:
+            return []
+        return self.engine.transform(dataset_name, pd.concat(slices), resource_type)
 
     # def _generate_patient(self, subject_id: str) -> Patient:
     #     """
@@ -115,88 +147,150 @@ class Naptha:
 
     def merge_sv(self, subject_id: Optional[str] = None):
         """
-        Parse the SV dataset for a subject
+        Merge the SV dataset into the bundle, for a subject or (by default) all the subjects in the bundle
         """
-        if subject_id is None:
-            for _subject_id in self.get_subjects():
-                self.merge_sv(_subject_id)
-            else:
-                return
-        if subject_id not in self.get_subjects():
-            raise ValueError(f"Subject {subject_id} does not exist")
-        # the bundle will include the ResearchStudy, ResearchSubject, and Patient resources
-        patient_hash_id = hh(subject_id)
-        # slice the dataset
-        sv = self.get_subject_sv(subject_id)
-        pd_map = {"1.0": "H2Q-MC-LZZT-Study-Visit-1",
-                  "2.0": "H2Q-MC-LZZT-Study-Visit-2",
-                  "3.0": "H2Q-MC-LZZT-Study-Visit-3",
-                  "3.5": None,
-                  "4.0": "H2Q-MC-LZZT-Study-Visit-4",
-                  "5.0": "H2Q-MC-LZZT-Study-Visit-5",
-                  "6.0": "H2Q-MC-LZZT-Study-Visit-6",
-                  "7.0": "H2Q-MC-LZZT-Study-Visit-7",
-                  "8.0": "H2Q-MC-LZZT-Study-Visit-8",
-                  "8.1": None,
-                  "9.0": "H2Q-MC-LZZT-Study-Visit-9",
-                  "9.1": None,
-                  "10.0": "H2Q-MC-LZZT-Study-Visit-10",
-                  "10.1": None,
-                  "11.0": "H2Q-MC-LZZT-Study-Visit-11",
-                  "11.1": None,
-                  "12.0": "H2Q-MC-LZZT-Study-Visit-12",
-                  "13.0": "H2Q-MC-LZZT-Study-Visit-13",
-                  "101.0": "H2Q-MC-LZZT-Study-ET-14",
-                  "201.0": "H2Q-MC-LZZT-Study-RT-15",
-                  "501.0": None}
-        for record in sv.itertuples():
-            if record.USUBJID not in self.content.subjects:
-                continue
-            print("Processing patient {} -> {}".format(record.USUBJID, record.VISITNUM))
-            visit_num = record.VISITNUM
-            if str(visit_num) not in pd_map:
-                print("Skipping visit {}".format(visit_num))
-                continue
-            plan_def_id = pd_map[str(visit_num)]
-            if plan_def_id is None:
-                print("Ignoring visit", visit_num)
+        if subject_id is not None:
+            if not self.has_subject(subject_id):
+                raise ValueError(f"Subject {subject_id} does not exist")
+            subject_ids = [subject_id]
+        else:
+            subject_ids = self.get_subjects()
+        # filter to the subjects in the bundle before building anything
+        in_bundle = set(self.content.subjects)
+        index = self._connector.subject_index("SV")
+        slices = [index.get(x) for x in subject_ids if x in in_bundle]
+        if not slices:
+            return
+        self.content.add_resources(self._visit_resources(pd.concat(slices)))
+
+    def merge_lb(self, subject_id: Optional[str] = None, verbose: bool = False):
+        """
+        Merge the LB dataset into the bundle as Observations, for a subject or (by default) all those in the bundle
+
+        The Observations are added as JSON to a lazy bundle (`lazy=True`), and as models otherwise.
+        """
+        self._merge_observations("LB", subject_id, verbose)
+
+    def merge_vs(self, subject_id: Optional[str] = None, verbose: bool = False):
+        """
+        Merge the VS dataset into the bundle as Observations, for a subject or (by default) all those in the bundle
+
+        The Observations are added as JSON to a lazy bundle (`lazy=True`), and as models otherwise.
+        """
+        self._merge_observations("VS", subject_id, verbose)
+
+    def _merge_observations(self, domain: str, subject_id: Optional[str] = None, verbose: bool = False):
+        if subject_id is not None:
+            if not self.has_subject(subject_id):
+                raise ValueError(f"Subject {subject_id} does not exist")
+            subject_ids = [subject_id]
+        else:
+            subject_ids = self.content.subjects
+        in_bundle = set(self.content.subjects)
+        index = self._connector.subject_index(domain)
+        slices = [index.get(x) for x in subject_ids if x in in_bundle and x in index]
+        if not slices:
+            return
+        dataset = pd.concat(slices).reset_index(drop=True)
+        if verbose:
+            print("Processing {} {} records for {} subjects".format(len(dataset), domain, dataset.USUBJID.nunique()))
+        # the Observations as JSON, built column-wise
+        observations = self.engine.transform(domain, dataset, "Observation")
+        # link to the Encounters (from merge_sv) for the visits
+        encounters = set(self.content.encounters)
+        linked = 0
+        for observation, encounter_id in zip(observations, self._encounter_ids(dataset)):
+            if encounter_id in encounters:
+                observation["encounter"] = {"reference": f"Encounter/{encounter_id}"}
+                linked += 1
+        if verbose:
+            print("Linked {} of {} Observations to Encounters".format(linked, len(observations)))
+        self.content.add_raw_resources(observations)
+
+    @staticmethod
+    def _encounter_ids(dataset: pd.DataFrame) -> List[Optional[str]]:
+        """
+        The ids of the Encounters (as built by _visit_resources) for the visits in a dataset, None for the
+        unscheduled visits
+        """
+        scheduled = dataset.VISITNUM.astype(str).map(VISIT_PLAN_DEFINITIONS).notna().tolist()
+        subjects = dataset.USUBJID.unique().tolist()
+        patient_ids = dict(zip(subjects, MINTER.mint_many(subjects)))
+        encounter_ids = {}
+        linked = []
+        for subject_id, visit_num, known in zip(dataset.USUBJID.tolist(), dataset.VISITNUM.tolist(), scheduled):
+            if not known:
+                linked.append(None)
                 continue
-            care_plan_description = f"{patient_hash_id}-{visit_num}-CarePlan"
-            care_plan_id = hh(care_plan_description)
-            # create a care plan
+            key = (subject_id, visit_num)
+            if key not in encounter_ids:
+                encounter_ids[key] = ids.encounter_id(ids.care_plan_id(patient_ids[subject_id], visit_num), visit_num)
+            linked.append(encounter_ids[key])
+        return linked
+
+    def _visit_resources(self, sv: pd.DataFrame) -> List[Resource]:
+        """
+        Build the CarePlan, ServiceRequest and Encounter resources for each of the visits in a slice of SV
+        """
+        visit_key = sv.VISITNUM.astype(str)
+        plan_def_ids = visit_key.map(VISIT_PLAN_DEFINITIONS)
+        unknown = ~visit_key.isin(VISIT_PLAN_DEFINITIONS.keys())
+        if unknown.any():
+            print("Skipping visits {}".format(", ".join(sorted(visit_key[unknown].unique()))))
+        ignored = plan_def_ids.isna() & ~unknown
+        if ignored.any():
+            print("Ignoring visits {}".format(", ".join(sorted(visit_key[ignored].unique()))))
+        sv = sv[plan_def_ids.notna()]
+        if sv.empty:
+            return []
+        print("Processing {} visits for {} subjects".format(len(sv), sv.USUBJID.nunique()))
+        # compute the deterministic ids in bulk
+        subject_ids = sv.USUBJID.tolist()
+        unique = sorted(set(subject_ids))
+        patient_ids = dict(zip(unique, MINTER.mint_many(unique)))
+        patient_hash_ids = [patient_ids[x] for x in subject_ids]
+        visit_nums = sv.VISITNUM.tolist()
+        care_plan_descriptions = [f"{p}-{v}-CarePlan" for p, v in zip(patient_hash_ids, visit_nums)]
+        care_plan_ids = MINTER.mint_many(care_plan_descriptions)
+        service_request_descriptions = [f"{p}-{v}-ServiceRequest" for p, v in zip(patient_hash_ids, visit_nums)]
+        service_request_ids = MINTER.mint_many(service_request_descriptions)
+        encounter_ids = [ids.encounter_id(c, v) for c, v in zip(care_plan_ids, visit_nums)]
+        starts = [x.to_pydatetime() if pd.notna(x) else None for x in sv.SVSTDTC]
+        ends = [x.to_pydatetime() if pd.notna(x) else None for x in sv.SVENDTC]
+        resources = []
+        for offset, plan_def_id in enumerate(plan_def_ids[sv.index].tolist()):
+            patient_hash_id = patient_hash_ids[offset]
+            visit_num = visit_nums[offset]
+            care_plan_id = care_plan_ids[offset]
+            service_request_id = service_request_ids[offset]
             care_plan = CarePlan(id=care_plan_id,
                                  status="completed",
                                  intent="order",
                                  subject=Reference(reference=f"Patient/{patient_hash_id}"),
                                  instantiatesCanonical=[f"PlanDefinition/{plan_def_id}"],
-                                 title=f"Subject {record.USUBJID} {visit_num}")
-            care_plan.identifier = [Identifier(value=care_plan_description)]
-            # bind the care plan - todo!
-            # create the service request
-            service_request_description = f"{patient_hash_id}-{visit_num}-ServiceRequest"
-            service_request_id = hh(service_request_description)
+                                 title=f"Subject {subject_ids[offset]} {visit_num}",
+                                 identifier=[Identifier(value=care_plan_descriptions[offset])])
             service_request = ServiceRequest(id=service_request_id,
                                              status="completed",
                                              intent="order",
                                              subject=Reference(reference=f"Patient/{patient_hash_id}"),
-                                             basedOn=[Reference(reference=f"CarePlan/{care_plan_id}")])
-            service_request.identifier = [Identifier(value=f"{service_request_description}")]
-            encounter = Encounter(id=hh(f"{care_plan_id}-{record.VISITNUM}-Encounter"),
+                                             basedOn=[Reference(reference=f"CarePlan/{care_plan_id}")],
+                                             identifier=[Identifier(value=service_request_descriptions[offset])])
+            encounter = Encounter(id=encounter_ids[offset],
                                   status="finished",
                                   class_fhir=Coding(code="IMP",
-                                                    system="http://hl7.org/fhir/v3/ActCode"),
+                                                    system="http://terminology.hl7.org/CodeSystem/v3-ActCode"),
                                   subject=Reference(reference=f"Patient/{patient_hash_id}"),
-                                  basedOn=[Reference(reference=f"ServiceRequest/{service_request_id}")])
-            encounter.identifier = [Identifier(value=f"{care_plan_id}-Encounter")]
+                                  basedOn=[Reference(reference=f"ServiceRequest/{service_request_id}")],
+                                  identifier=[Identifier(value=f"{care_plan_id}-Encounter")])
             period = {}
-            if record.SVSTDTC:
-                period["start"] = record.SVSTDTC
-            if record.SVENDTC:
-                period["end"] = record.SVENDTC
+            if starts[offset]:
+                period["start"] = starts[offset]
+            if ends[offset]:
+                period["end"] = ends[offset]
             if period:
                 encounter.period = Period(**period)
             # later
             # encounter.serviceProvider = Reference(reference=f"Organization/{self.org_id}")
-            self.content.add_resource(care_plan)
-            self.content.add_resource(service_request)
-            self.content.add_resource(encounter)
+            resources.extend((care_plan, service_request, encounter))
+        return resources
@@ -0,0 +1,165 @@
+import atexit
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# the number of new ids held before they're written to the table
+FLUSH_SIZE = 10000
+# the number of ids remembered in memory
+CACHE_SIZE = 1 << 16
+
+
+class IdMinter:
+    """
+    Mints the deterministic ids (the md5 of a natural key, eg the USUBJID for a Patient), remembering them
+
+    The most recently used ids are kept in memory (both ways, so an id can be resolved back to its key) and,
+    with a path, all of them in a SQLite table so repeated runs and other processes can resolve them too.  The
+    schemes for the keys of the generated resources are the functions below (patient_id, care_plan_id, ...).
+    """
+
+    def __init__(self, path: Optional[str] = None, max_size: int = CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._ids = OrderedDict()  # type: OrderedDict[str, str]
+        self._keys = {}  # type: Dict[str, str]
+        self._pending = []
+        self._lock = threading.RLock()
+        self._db = None
+        self._pid = None
+
+    @property
+    def db(self) -> Optional[sqlite3.Connection]:
+        if self.path is None:
+            return None
+        if self._db is None or self._pid != os.getpid():
+            # a connection per process (the minter may be inherited by a worker)
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS ids (key TEXT PRIMARY KEY, id TEXT NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS ids_id ON ids (id)")
+            self._db.commit()
+            self._pid = os.getpid()
+        return self._db
+
+    def __len__(self) -> int:
+        with self._lock:
+            if self.db is None:
+                return len(self._ids)
+            self.flush()
+            return self.db.execute("SELECT COUNT(*) FROM ids").fetchone()[0]
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            if key in self._ids:
+                return True
+            if self.db is None:
+                return False
+            self.flush()
+            return self.db.execute("SELECT 1 FROM ids WHERE key = ?", (key,)).fetchone() is not None
+
+    def _remember(self, key: str, minted: str) -> None:
+        # caller holds the lock
+        self._ids[key] = minted
+        self._keys[minted] = key
+        while len(self._ids) > self.max_size:
+            _, evicted = self._ids.popitem(last=False)
+            self._keys.pop(evicted, None)
+
+    def _mint(self, key: str) -> str:
+        # caller holds the lock
+        minted = self._ids.get(key)
+        if minted is None:
+            # the id is the hash, there's no need to look it up; the table ignores the ones it has already
+            minted = hashlib.md5(key.encode('utf-8')).hexdigest()
+            self._remember(key, minted)
+            if self.path is not None:
+                self._pending.append((key, minted))
+        else:
+            self._ids.move_to_end(key)
+        return minted
+
+    def mint(self, key: str) -> str:
+        """
+        The id for a key
+        """
+        with self._lock:
+            minted = self._mint(key)
+            if len(self._pending) >= FLUSH_SIZE:
+                self.flush()
+            return minted
+
+    def mint_many(self, keys: Iterable[str]) -> List[str]:
+        """
+        The ids for the keys, the new ones are written to the table in one go
+        """
+        with self._lock:
+            minted = [self._mint(key) for key in keys]
+            self.flush()
+            return minted
+
+    def resolve(self, minted: str) -> Optional[str]:
+        """
+        The key an id was minted from, if it is remembered (or stored in the table)
+        """
+        with self._lock:
+            key = self._keys.get(minted)
+            if key is None and self.db is not None:
+                self.flush()
+                row = self.db.execute("SELECT key FROM ids WHERE id = ?", (minted,)).fetchone()
+                if row is not None:
+                    key = row[0]
+                    self._remember(key, minted)
+            return key
+
+    def flush(self) -> None:
+        """
+        Write the new ids to the table
+        """
+        with self._lock:
+            if self._pending and self.db is not None:
+                self.db.executemany("INSERT OR IGNORE INTO ids VALUES (?, ?)", self._pending)
+                self.db.commit()
+            self._pending = []
+
+    def close(self) -> None:
+        with self._lock:
+            self.flush()
+            if self._db is not None and self._pid == os.getpid():
+                self._db.close()
+            self._db = None
+
+
+# shared by the modules, set SOA_BRIDGE_ID_TABLE to keep the ids in a file
+MINTER = IdMinter(os.getenv("SOA_BRIDGE_ID_TABLE"))
+atexit.register(MINTER.flush)
+
+
+def hashed_id(*parts: str) -> str:
+    return MINTER.mint("-".join(parts))
+
+
+def patient_id(subject_id: str) -> str:
+    return MINTER.mint(subject_id)
+
+
+def organization_id(site_id: str) -> str:
+    return MINTER.mint(site_id)
+
+
+def care_plan_id(patient: str, visit_num) -> str:
+    return MINTER.mint(f"{patient}-{visit_num}-CarePlan")
+
+
+def encounter_id(care_plan: str, visit_num) -> str:
+    return MINTER.mint(f"{care_plan}-{visit_num}-Encounter")
+
+
+def observation_id(patient: str, domain: str, seq, resource_type: str = "Observation") -> str:
+    return MINTER.mint(f"{patient}-{domain}-{seq}-{resource_type}")
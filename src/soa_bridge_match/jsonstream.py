@@ -0,0 +1,167 @@
+import json
+import re
+from typing import IO, Any, Callable, Iterator, Optional
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class BundleReader:
+    """
+    Reads a Bundle incrementally, yielding the items of `entry` one at a time
+
+    The other members of the Bundle are collected into `header`; members that follow `entry`
+    in the file are only available once the entries have been consumed.
+    """
+
+    def __init__(self, fp: IO[str], chunk_size: int = 1 << 16) -> None:
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        # bytes (utf-8) in the file before the start of the buffer, when tracking offsets
+        self._consumed = 0
+        self._offsets = False
+        self.header = {}
+
+    def _fill(self) -> bool:
+        """
+        read more of the file into the buffer, returning False at the end of the file
+        """
+        if self._eof:
+            return False
+        chunk = self._fp.read(max(self._chunk_size, len(self._buffer) - self._pos))
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer += chunk
+        return True
+
+    def _trim(self) -> None:
+        """
+        drop the consumed part of the buffer
+        """
+        if self._offsets:
+            self._consumed += len(self._buffer[:self._pos].encode("utf-8"))
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+
+    def _offset(self, pos: int) -> int:
+        """
+        byte offset in the file for a position in the buffer
+        """
+        return self._consumed + len(self._buffer[:pos].encode("utf-8"))
+
+    def _peek(self) -> Optional[str]:
+        """
+        the next non-whitespace character, None at the end of the file
+        """
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            self._trim()
+            if not self._fill():
+                return None
+
+    def _expect(self, char: str) -> None:
+        if self._peek() != char:
+            raise ValueError(f"Expected '{char}' at offset {self._offset(self._pos)}")
+        self._pos += 1
+
+    def _decode(self) -> Any:
+        """
+        decode the next value, reading more of the file until the value is complete
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def entries(self, offsets: bool = False) -> Iterator[Any]:
+        """
+        iterate over the entries; with offsets, yields (entry, start, end) with the byte offsets of the entry
+        """
+        self._offsets = offsets
+        self._expect("{")
+        while True:
+            char = self._peek()
+            if char == "}" or char is None:
+                break
+            if char == ",":
+                self._pos += 1
+                continue
+            key = self._decode()
+            self._expect(":")
+            if key != "entry":
+                self.header[key] = self._decode()
+                continue
+            self._expect("[")
+            while True:
+                char = self._peek()
+                if char == "]":
+                    self._pos += 1
+                    break
+                if char == ",":
+                    self._pos += 1
+                    continue
+                if offsets:
+                    start = self._offset(self._pos)
+                    entry = self._decode()
+                    yield entry, start, self._offset(self._pos)
+                else:
+                    yield self._decode()
+                self._trim()
+
+
+def iter_entries(filename: str, offsets: bool = False) -> Iterator[Any]:
+    """
+    iterate over the entries of a Bundle file
+    """
+    with open(filename, "r", encoding="utf-8") as f:
+        yield from BundleReader(f).entries(offsets=offsets)
+
+
+def read_entry(filename: str, start: int, end: int) -> dict:
+    """
+    read a single entry from a Bundle file using the offsets from `entries(offsets=True)`
+    """
+    with open(filename, "rb") as f:
+        f.seek(start)
+        return json.loads(f.read(end - start))
+
+
+def dumps(value: Any, indent: Optional[int] = 2, backend: str = "json", default: Optional[Callable] = None) -> str:
+    """
+    serialise a value with the json or orjson backend; orjson only indents by 2, no indent is compact
+    """
+    if backend == "orjson":
+        import orjson
+        if indent not in (None, 2):
+            raise ValueError("orjson can only indent by 2")
+        return orjson.dumps(value, default=default, option=orjson.OPT_INDENT_2 if indent else 0).decode("utf-8")
+    if backend != "json":
+        raise ValueError(f"Unknown JSON backend {backend}")
+    if indent is None:
+        return json.dumps(value, default=default, separators=(",", ":"))
+    return json.dumps(value, default=default, indent=indent)
+
+
+def dump_entry(entry: dict, indent: Optional[int] = 2, level: int = 2, backend: str = "json",
+               default: Optional[Callable] = None) -> str:
+    """
+    serialise an entry so it nests in a Bundle serialised with the same indent
+    """
+    if indent is None:
+        return dumps(entry, None, backend, default)
+    prefix = " " * (indent * level)
+    return prefix + dumps(entry, indent, backend, default).replace("\n", "\n" + prefix)
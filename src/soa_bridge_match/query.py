@@ -0,0 +1,497 @@
+from __future__ import annotations
+
+import bisect
+import datetime
+import json
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from .jsonstream import iter_entries
+
+# the elements holding the date of a resource (for the `date` search), first present wins
+DATE_ELEMENTS = {
+    "Encounter": ("period",),
+    "Observation": ("effectiveDateTime", "effectivePeriod", "effectiveInstant", "issued"),
+    "Procedure": ("performedDateTime", "performedPeriod"),
+    "AdverseEvent": ("date",),
+    "MedicationStatement": ("effectiveDateTime", "effectivePeriod", "dateAsserted"),
+    "Condition": ("onsetDateTime", "onsetPeriod", "recordedDate"),
+    "CarePlan": ("period",),
+    "ServiceRequest": ("occurrenceDateTime", "occurrencePeriod", "authoredOn"),
+    "ResearchSubject": ("period",),
+}
+
+# the elements holding the patient of a resource (for the `patient` and `subject` searches, and for cloning)
+PATIENT_ELEMENTS = ("subject", "patient", "individual")
+
+# the design resources shared by all the subjects (along with the *Definition resources)
+COMMON_TYPES = ("ResearchStudy", "Group", "Organization", "Practitioner", "Medication")
+
+# search parameter -> element, for the reference searches
+REFERENCE_PARAMETERS = {
+    "based-on": "basedOn",
+    "study": "study",
+    "encounter": "encounter",
+}
+
+DATE_PREFIXES = ("eq", "ne", "ge", "gt", "le", "lt", "sa", "eb")
+
+Interval = Tuple[datetime.datetime, datetime.datetime]
+
+
+def parse_date(value: str) -> Optional[Interval]:
+    """
+    The range covered by a FHIR date/dateTime/instant, as (first, last) naive datetimes
+    """
+    if not value:
+        return None
+    if len(value) == 4:
+        start = datetime.datetime(int(value), 1, 1)
+        return start, start.replace(year=start.year + 1) - datetime.timedelta(microseconds=1)
+    if len(value) == 7:
+        start = datetime.datetime(int(value[:4]), int(value[5:7]), 1)
+        following = datetime.datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+        return start, following - datetime.timedelta(microseconds=1)
+    if len(value) == 10:
+        start = datetime.datetime.fromisoformat(value)
+        return start, start + datetime.timedelta(days=1, microseconds=-1)
+    instant = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if instant.tzinfo is not None:
+        instant = instant.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return instant, instant
+
+
+def resource_interval(resource: dict) -> Optional[Interval]:
+    """
+    The range of dates covered by a resource, None if it has no date
+    """
+    for element in DATE_ELEMENTS.get(resource["resourceType"], ()):
+        value = resource.get(element)
+        if not value:
+            continue
+        if isinstance(value, dict):
+            start = parse_date(value.get("start"))
+            end = parse_date(value.get("end"))
+            if start is None and end is None:
+                continue
+            # an open period runs from/to the end of time
+            return (start[0] if start else datetime.datetime.min), (end[1] if end else datetime.datetime.max)
+        return parse_date(value)
+    return None
+
+
+def matches_date(interval: Interval, prefix: str, search: Interval) -> bool:
+    """
+    Compare the range of a resource with the range of a date search
+    """
+    start, end = interval
+    low, high = search
+    if prefix == "eq":
+        return low <= start and end <= high
+    if prefix == "ne":
+        return not (low <= start and end <= high)
+    if prefix == "ge":
+        return end >= low
+    if prefix in ("gt", "sa"):
+        return end > high
+    if prefix == "le":
+        return start <= high
+    if prefix in ("lt", "eb"):
+        return start < low
+    raise ValueError(f"Unsupported date prefix {prefix}")
+
+
+def split_date(value: str) -> Tuple[str, Interval]:
+    """
+    Split a date search value into the prefix and range
+    """
+    prefix = value[:2] if value[:2] in DATE_PREFIXES else "eq"
+    search = parse_date(value[2:] if value[:2] in DATE_PREFIXES else value)
+    if search is None:
+        raise ValueError(f"Invalid date {value}")
+    return prefix, search
+
+
+def is_common_type(resource_type: Optional[str]) -> bool:
+    """
+    Whether a resource type is shared by all the subjects rather than belonging to a patient
+    """
+    return resource_type in COMMON_TYPES or (resource_type or "").endswith("Definition")
+
+
+def normalise_reference(value: str, resource_type: str) -> str:
+    """
+    A search value for a reference as `Type/id`
+    """
+    return value if "/" in value else f"{resource_type}/{value}"
+
+
+class DateIndex:
+    """
+    Counts the resources whose date range falls in a window, using the sorted starts and ends
+
+    A resource overlaps the window [low, high] unless it starts after `high` or ends before `low`
+    (and can't do both), so the count is two bisections; the resources contained by a window are
+    found by bisecting the starts and checking the ends of that slice.
+    """
+
+    def __init__(self, intervals: List[Interval]):
+        intervals = sorted(intervals)
+        self._starts = [x[0] for x in intervals]
+        self._ends_by_start = [x[1] for x in intervals]
+        self._ends = sorted(self._ends_by_start)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def count_overlapping(self, low: datetime.datetime = datetime.datetime.min,
+                          high: datetime.datetime = datetime.datetime.max) -> int:
+        """
+        Number of ranges with end >= low and start <= high
+        """
+        if low > high:
+            # a resource could both start after high and end before low
+            return sum(1 for start, end in zip(self._starts, self._ends_by_start) if end >= low and start <= high)
+        after = len(self._starts) - bisect.bisect_right(self._starts, high)
+        before = bisect.bisect_left(self._ends, low)
+        return len(self._starts) - after - before
+
+    def count_within(self, low: datetime.datetime, high: datetime.datetime) -> int:
+        """
+        Number of ranges with start >= low and end <= high
+        """
+        first = bisect.bisect_left(self._starts, low)
+        last = bisect.bisect_right(self._starts, high)
+        return sum(1 for end in self._ends_by_start[first:last] if end <= high)
+
+    def count(self, dates: List[Tuple[str, Interval]]) -> Optional[int]:
+        """
+        Number of ranges matching all the (prefix, range) date searches, None if the prefixes aren't supported
+        """
+        low, high = datetime.datetime.min, datetime.datetime.max
+        within = None
+        for prefix, (first, last) in dates:
+            if prefix == "ge":
+                low = max(low, first)
+            elif prefix == "le":
+                high = min(high, last)
+            elif prefix == "eq" and within is None:
+                within = (first, last)
+            else:
+                return None
+        if within is None:
+            return self.count_overlapping(low, high)
+        if low != datetime.datetime.min or high != datetime.datetime.max:
+            return None
+        return self.count_within(*within)
+
+
+class QueryEngine:
+    """
+    In-memory FHIR search over the resources of one or more Bundles
+
+    Resources are kept as raw dicts and indexed by type, patient, basedOn, instantiatesCanonical
+    and other references, identifier and date; the searches issued by the window matching
+    (`StudyWindow`) are answered from the indexes without a server.
+    """
+
+    def __init__(self, baseurl: str = "http://localhost/fhir/"):
+        self.baseurl = baseurl if baseurl.endswith("/") else baseurl + "/"
+        self._resources = {}  # type: Dict[Tuple[str, str], dict]
+        self._by_type = defaultdict(list)  # type: Dict[str, List[dict]]
+        # (type, patient reference) -> resources
+        self._by_patient = defaultdict(list)
+        # (type, element, reference) -> resources, for the basedOn, study... references
+        self._by_reference = defaultdict(list)
+        # (type, canonical) -> resources
+        self._by_canonical = defaultdict(list)
+        # (type, identifier value) -> resources
+        self._by_identifier = defaultdict(list)
+        # (type, id) -> range of dates
+        self._dates = {}  # type: Dict[Tuple[str, str], Interval]
+        # (type, patient reference) -> DateIndex, built on demand
+        self._date_indexes = {}  # type: Dict[Tuple[str, str], DateIndex]
+
+    def __len__(self):
+        return len(self._resources)
+
+    def add_resource(self, resource: dict) -> bool:
+        """
+        Index a resource, the first copy of a resource wins
+        """
+        rtype, rid = resource["resourceType"], resource["id"]
+        if (rtype, rid) in self._resources:
+            return False
+        self._resources[(rtype, rid)] = resource
+        self._by_type[rtype].append(resource)
+        for element in PATIENT_ELEMENTS:
+            value = resource.get(element)
+            reference = value.get("reference") if isinstance(value, dict) else None
+            if reference and reference.startswith("Patient/"):
+                self._by_patient[(rtype, reference)].append(resource)
+                self._date_indexes.pop((rtype, reference), None)
+                break
+        for element in REFERENCE_PARAMETERS.values():
+            value = resource.get(element)
+            for reference in value if isinstance(value, list) else [value] if value else []:
+                if reference.get("reference"):
+                    self._by_reference[(rtype, element, reference["reference"])].append(resource)
+        for canonical in resource.get("instantiatesCanonical") or []:
+            self._by_canonical[(rtype, canonical)].append(resource)
+            # match on the id of the canonical too
+            self._by_canonical[(rtype, canonical.split("/")[-1])].append(resource)
+        identifiers = resource.get("identifier") or []
+        for identifier in identifiers if isinstance(identifiers, list) else [identifiers]:
+            if identifier.get("value"):
+                self._by_identifier[(rtype, identifier["value"])].append(resource)
+                if identifier.get("system"):
+                    self._by_identifier[(rtype, f"{identifier['system']}|{identifier['value']}")].append(resource)
+        interval = resource_interval(resource)
+        if interval is not None:
+            self._dates[(rtype, rid)] = interval
+        return True
+
+    def add_resources(self, resources: Iterable[dict]) -> int:
+        return sum(self.add_resource(resource) for resource in resources)
+
+    def add_bundle(self, bundle) -> int:
+        """
+        Index the resources of a SourcedBundle (or a Bundle)
+        """
+        bundle = getattr(bundle, "bundle", bundle)
+        return self.add_resources(json.loads(entry.resource.json()) for entry in bundle.entry or [])
+
+    def add_file(self, filename: str) -> int:
+        """
+        Index the resources of a Bundle file
+        """
+        return self.add_resources(entry["resource"] for entry in iter_entries(filename) if "resource" in entry)
+
+    @classmethod
+    def from_files(cls, filenames: Iterable[str], **kwargs) -> QueryEngine:
+        engine = cls(**kwargs)
+        for filename in filenames:
+            engine.add_file(filename)
+        return engine
+
+    def read(self, resource_type: str, resource_id: str) -> Optional[dict]:
+        return self._resources.get((resource_type, resource_id))
+
+    def interval(self, resource: dict) -> Optional[Interval]:
+        return self._dates.get((resource["resourceType"], resource["id"]))
+
+    def date_index(self, resource_type: str, patient: str) -> DateIndex:
+        """
+        The index over the dates of the resources of a type for a patient
+        """
+        key = (resource_type, normalise_reference(patient, "Patient"))
+        if key not in self._date_indexes:
+            intervals = [self._dates[(x["resourceType"], x["id"])] for x in self._by_patient.get(key, [])
+                         if (x["resourceType"], x["id"]) in self._dates]
+            self._date_indexes[key] = DateIndex(intervals)
+        return self._date_indexes[key]
+
+    def count_windows(self, patient: str, resource_types: Iterable[str],
+                      windows: List[List[str]]) -> List[Dict[str, int]]:
+        """
+        Count the resources of each type for a patient in each window, the windows are lists of date search values
+
+        eg `count_windows("Patient/x", ["Observation"], [["ge2014-01-02", "le2014-01-10"], ["eq2014-02-01"]])`
+        """
+        indexes = {rtype: self.date_index(rtype, patient) for rtype in resource_types}
+        counts = []
+        for window in windows:
+            dates = [split_date(value) for value in window]
+            counts.append({rtype: self._count(index, rtype, patient, dates) for rtype, index in indexes.items()})
+        return counts
+
+    def _count(self, index: DateIndex, resource_type: str, patient: str, dates: List[Tuple[str, Interval]]) -> int:
+        """
+        Count the resources of a patient matching the date searches, from the index when it can
+        """
+        resources = self._by_patient.get((resource_type, normalise_reference(patient, "Patient")), [])
+        if not dates:
+            return len(resources)
+        count = index.count(dates)
+        if count is None:
+            count = sum(1 for x in resources if self.interval(x) is not None
+                        and all(matches_date(self.interval(x), prefix, search) for prefix, search in dates))
+        return count
+
+    def _candidates(self, resource_type: str, name: str, value: str) -> Optional[List[dict]]:
+        """
+        The resources matching a search parameter from the indexes, None if the parameter isn't indexed
+        """
+        if name == "_id":
+            resource = self.read(resource_type, value)
+            return [resource] if resource else []
+        if name in ("patient", "subject"):
+            return self._by_patient.get((resource_type, normalise_reference(value, "Patient")), [])
+        if name in REFERENCE_PARAMETERS:
+            element = REFERENCE_PARAMETERS[name]
+            if "/" not in value:
+                return [resource for (rtype, _element, reference), resources in self._by_reference.items()
+                        if rtype == resource_type and _element == element and reference.endswith(f"/{value}")
+                        for resource in resources]
+            return self._by_reference.get((resource_type, element, value), [])
+        if name == "instantiates-canonical":
+            return self._by_canonical.get((resource_type, value), [])
+        if name == "identifier":
+            return self._by_identifier.get((resource_type, value), [])
+        return None
+
+    def search(self, resource_type: str, params: List[Tuple[str, str]]) -> List[dict]:
+        """
+        Resources of a type matching all the search parameters (the result parameters are ignored)
+        """
+        dates = []
+        selected = None
+        for name, value in params:
+            if name.startswith("_") and name != "_id":
+                continue
+            if name == "date":
+                dates.append(split_date(value))
+                continue
+            # a comma separates alternative values
+            candidates = {}
+            for alternative in value.split(","):
+                found = self._candidates(resource_type, name, alternative)
+                if found is None:
+                    raise ValueError(f"Unsupported search parameter {resource_type}:{name}")
+                candidates.update((id(x), x) for x in found)
+            if selected is None:
+                selected = candidates
+            else:
+                selected = {key: x for key, x in selected.items() if key in candidates}
+        resources = list(selected.values()) if selected is not None else list(self._by_type.get(resource_type, []))
+        if dates:
+            matched = []
+            for resource in resources:
+                interval = self.interval(resource)
+                if interval is not None and all(matches_date(interval, prefix, search) for prefix, search in dates):
+                    matched.append(resource)
+            resources = matched
+        return resources
+
+    def _revinclude(self, resources: List[dict], spec: str) -> List[dict]:
+        """
+        The resources referring to the given resources through `Type:parameter`
+        """
+        rtype, name = spec.split(":")[:2]
+        if name not in REFERENCE_PARAMETERS:
+            raise ValueError(f"Unsupported _revinclude {spec}")
+        element = REFERENCE_PARAMETERS[name]
+        found = {}
+        for resource in resources:
+            reference = f"{resource['resourceType']}/{resource['id']}"
+            for included in self._by_reference.get((rtype, element, reference), []):
+                found.setdefault(id(included), included)
+        return list(found.values())
+
+    def search_bundle(self, path: str) -> dict:
+        """
+        Answer a search (`Type?params`) as a searchset Bundle
+        """
+        resource_type, _, query = path.partition("?")
+        params = parse_qsl(query, keep_blank_values=True)
+        options = defaultdict(list)
+        for name, value in params:
+            options[name].append(value)
+        if options.get("_summary") == ["count"] and set(options) <= {"patient", "date", "_summary"} \
+                and len(options.get("patient", [])) == 1 and "," not in options["patient"][0]:
+            # counting the resources of a patient in a window, from the date index
+            dates = [split_date(value) for value in options.get("date", [])]
+            index = self.date_index(resource_type, options["patient"][0])
+            return dict(resourceType="Bundle", type="searchset",
+                        total=self._count(index, resource_type, options["patient"][0], dates))
+        matched = self.search(resource_type, params)
+        bundle = dict(resourceType="Bundle", type="searchset", total=len(matched))
+        if options.get("_summary") == ["count"]:
+            return bundle
+        included = []
+        seen = {id(x) for x in matched}
+        for spec in options.get("_revinclude", []):
+            for resource in self._revinclude(matched, spec):
+                if id(resource) not in seen:
+                    seen.add(id(resource))
+                    included.append(resource)
+        iterate = [x for name, values in options.items() if name.startswith("_revinclude:iterate") for x in values]
+        frontier = matched + included
+        while iterate and frontier:
+            found = []
+            for spec in iterate:
+                for resource in self._revinclude(frontier, spec):
+                    if id(resource) not in seen:
+                        seen.add(id(resource))
+                        found.append(resource)
+            included.extend(found)
+            frontier = found
+        offset = int(options.get("_offset", ["0"])[0])
+        count = int(options["_count"][0]) if "_count" in options else None
+        page = matched[offset:offset + count] if count is not None else matched[offset:]
+        entries = [dict(fullUrl=f"{self.baseurl}{x['resourceType']}/{x['id']}", resource=x, search=dict(mode="match"))
+                   for x in page]
+        if offset == 0:
+            entries.extend(dict(fullUrl=f"{self.baseurl}{x['resourceType']}/{x['id']}", resource=x,
+                                search=dict(mode="include"))
+                           for x in included)
+        bundle["link"] = [dict(relation="self", url=f"{self.baseurl}{path}")]
+        if count is not None and offset + count < len(matched):
+            following = [(name, value) for name, value in params if name != "_offset"]
+            following.append(("_offset", str(offset + count)))
+            bundle["link"].append(dict(relation="next", url=f"{self.baseurl}{resource_type}?{urlencode(following)}"))
+        bundle["entry"] = entries
+        return bundle
+
+    def get(self, url: str) -> Tuple[int, Optional[dict]]:
+        """
+        Answer a read (`Type/id`) or a search (`Type?params`), returns the status and body
+        """
+        if url.startswith(self.baseurl):
+            path = url[len(self.baseurl):]
+        else:
+            # whatever the base, the type (and id) are the last segments
+            parts = urlsplit(url)
+            segments = parts.path.rstrip("/").split("/")
+            path = f"{segments[-1]}?{parts.query}" if parts.query else "/".join(segments[-2:])
+        try:
+            if "?" in path or "/" not in path:
+                return 200, self.search_bundle(path)
+            resource_type, resource_id = path.split("/")[:2]
+        except ValueError as exc:
+            return 400, dict(resourceType="OperationOutcome",
+                             issue=[dict(severity="error", code="not-supported", diagnostics=str(exc))])
+        resource = self.read(resource_type, resource_id)
+        if resource is None:
+            return 404, dict(resourceType="OperationOutcome",
+                             issue=[dict(severity="error", code="not-found",
+                                         diagnostics=f"{resource_type}/{resource_id} not found")])
+        return 200, resource
+
+
+class LocalResponse:
+    """
+    Enough of a requests Response for the StudyWindow
+    """
+
+    def __init__(self, status_code: int, body: Optional[dict]):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.headers = {"Content-Type": "application/fhir+json"}
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class LocalSession:
+    """
+    Stands in for a requests Session, answering the GETs from a QueryEngine
+    """
+
+    def __init__(self, engine: QueryEngine):
+        self.engine = engine
+        self.headers = {}
+
+    def get(self, url: str, headers: Optional[dict] = None, **kwargs) -> LocalResponse:
+        return LocalResponse(*self.engine.get(url))
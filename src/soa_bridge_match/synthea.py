@@ -1,14 +1,40 @@
+import json
 import os
 import random
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
 from fhir.resources.bundle import Bundle
-from fhir.resources.codeableconcept import CodeableConcept
 from fhir.resources.observation import Observation
 from dotenv import load_dotenv
 
+from .jsonstream import iter_entries
+
 load_dotenv()
 
+# the categories of Observation that get indexed
+CATEGORIES = ("laboratory", "vital-signs")
+
+# the index of the Observations, kept alongside the Synthea files
+INDEX_FILE = ".synthea_index.json"
+INDEX_VERSION = 1
+
+
+def scan_file(filename: str) -> Dict[str, List[Tuple[int, int]]]:
+    """
+    Find the Observations of each category in a Synthea Bundle, returns category -> [(start, end)] byte offsets
+    """
+    found = {category: [] for category in CATEGORIES}
+    for entry, start, end in iter_entries(filename, offsets=True):
+        resource = entry.get("resource", {})
+        if resource.get("resourceType") != "Observation":
+            continue
+        codes = {coding.get("code") for category in resource.get("category", [])
+                 for coding in category.get("coding", [])}
+        for category in CATEGORIES:
+            if category in codes:
+                found[category].append((start, end))
+    return found
+
 
 class SyntheaPicker:
 
@@ -16,11 +42,13 @@ class SyntheaPicker:
         self.path = path if path else os.getenv('SYNTHEA_DATA_DIR')
         self._candidates = []
         self._cache = {}
+        self._index = None
 
     @property
     def candidates(self):
         if not self._candidates:
-            self._candidates = [f for f in os.listdir(self.path) if
+            # skipping hidden files, like the index
+            self._candidates = [f for f in os.listdir(self.path) if not f.startswith('.') and
                                 os.path.isfile(os.path.join(self.path, f)) and
                                 os.path.splitext(os.path.join(self.path, f))[1] == '.json']
         return self._candidates
@@ -28,26 +56,85 @@ class SyntheaPicker:
     def pick_file(self, file_name):
         return os.path.join(self.path, file_name)
 
+    @property
+    def index(self) -> Dict[str, Dict[str, List[Tuple[int, int]]]]:
+        """
+        category -> file name -> Observation offsets, for the files with Observations of the category
+
+        The offsets are kept in a sidecar file in the directory; only files that are new or changed
+        (by size and mtime) since the sidecar was written are scanned.
+        """
+        if self._index is None:
+            sidecar = os.path.join(self.path, INDEX_FILE)
+            files = {}
+            if os.path.exists(sidecar):
+                with open(sidecar) as fh:
+                    stored = json.load(fh)
+                if stored.get("version") == INDEX_VERSION:
+                    files = stored["files"]
+            changed = False
+            current = {}
+            for file_name in self.candidates:
+                stat = os.stat(self.pick_file(file_name))
+                signature = [stat.st_size, stat.st_mtime_ns]
+                if file_name in files and files[file_name]["signature"] == signature:
+                    current[file_name] = files[file_name]
+                    continue
+                print(f"Indexing {file_name}")
+                current[file_name] = dict(signature=signature, observations=scan_file(self.pick_file(file_name)))
+                changed = True
+            if changed or set(current) != set(files):
+                tmp = sidecar + ".tmp"
+                with open(tmp, "w") as fh:
+                    json.dump(dict(version=INDEX_VERSION, files=current), fh)
+                os.replace(tmp, sidecar)
+            self._index = {category: {} for category in CATEGORIES}
+            for file_name, details in current.items():
+                for category, offsets in details["observations"].items():
+                    if offsets and category in self._index:
+                        self._index[category][file_name] = [tuple(x) for x in offsets]
+            # keep a list of the files per category for picking
+            self._cache = {category: sorted(files) for category, files in self._index.items()}
+        return self._index
+
     def get_pick(self):
         target = random.choice(self.candidates)
         print("Using {} for sample".format(target))
         bundle = Bundle.parse_file(self.pick_file(target))
         return bundle
 
-    def _pick_observation_by_category(self, category: str) -> Observation:
-        bundle = self.get_pick()
-        _obs = []
-        for entry in bundle.entry:
-            if entry.resource.resource_type == 'Observation':
-                resource = entry.resource  # type: Observation
-                for code in resource.category:  # type: CodeableConcept
-                    for coding in code.coding:
-                        if coding.code == category:
-                            _obs.append(resource)
-        return random.choice(_obs)
-
-    def get_lab_observation(self) -> Observation:
-        return self._pick_observation_by_category('laboratory')
-
-    def get_vital_observation(self) -> Observation:
-        return self._pick_observation_by_category('vital-signs')
+    def _pick_observation_by_category(self, category: str, rng: Optional[random.Random] = None) -> Observation:
+        """
+        Pick a random file with Observations of the category, and a random Observation from it
+        """
+        return self.get_observations(category, 1, rng)[0]
+
+    def get_observations(self, category: str, count: int, rng: Optional[random.Random] = None) -> List[Observation]:
+        """
+        Pick `count` random Observations of the category (with replacement), each file is opened once
+        """
+        rng = rng if rng else random
+        index = self.index
+        if not self._cache.get(category):
+            raise ValueError(f"No {category} Observations in {self.path}")
+        picks = []
+        for _ in range(count):
+            target = rng.choice(self._cache[category])
+            picks.append((target, rng.choice(index[category][target])))
+        # read the picks in file order, but return them in the order picked
+        by_file = {}
+        for target, offsets in picks:
+            by_file.setdefault(target, set()).add(offsets)
+        entries = {}
+        for target in sorted(by_file):
+            with open(self.pick_file(target), "rb") as fh:
+                for start, end in sorted(by_file[target]):
+                    fh.seek(start)
+                    entries[(target, (start, end))] = fh.read(end - start)
+        return [Observation.parse_obj(json.loads(entries[pick])["resource"]) for pick in picks]
+
+    def get_lab_observation(self, rng: Optional[random.Random] = None) -> Observation:
+        return self._pick_observation_by_category('laboratory', rng)
+
+    def get_vital_observation(self, rng: Optional[random.Random] = None) -> Observation:
+        return self._pick_observation_by_category('vital-signs', rng)
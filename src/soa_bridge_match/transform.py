@@ -0,0 +1,361 @@
+import os
+from decimal import Decimal
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import pandas as pd
+
+from fhir.resources import get_fhir_model_class
+from fhir.resources import fhirtypes
+
+from .config import Configuration, TestCodeMapper
+from .ids import MINTER, observation_id
+
+# the column mappings for each of the domains
+CONFIG_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "doc", "config")
+
+LOINC_SYSTEM = "http://loinc.org"
+UCUM_SYSTEM = "http://unitsofmeasure.org"
+SNOMED_SYSTEM = "http://snomed.info/sct"
+
+BODY_POSITION_EXTENSION = "http://hl7.org/fhir/StructureDefinition/observation-bodyPosition"
+
+# VSTESTCD to LOINC
+VS_LOINC_CODES = {"SYSBP": ("8480-6", "Systolic blood pressure"),
+                  "DIASBP": ("8462-4", "Diastolic blood pressure"),
+                  "PULSE": ("8867-4", "Heart rate"),
+                  "RESP": ("9279-1", "Respiratory rate"),
+                  "TEMP": ("8310-5", "Body temperature"),
+                  "WEIGHT": ("29463-7", "Body weight"),
+                  "HEIGHT": ("8302-2", "Body height")}
+
+# the SDTM units to UCUM
+UCUM_UNITS = {"mmHg": "mm[Hg]",
+              "BEATS/MIN": "/min",
+              "BREATHS/MIN": "/min",
+              "C": "Cel",
+              "F": "[degF]",
+              "kg": "kg",
+              "LB": "[lb_av]",
+              "cm": "cm",
+              "in": "[in_i]",
+              "g/L": "g/L",
+              "g/dL": "g/dL",
+              "U/L": "U/L",
+              "mmol/L": "mmol/L",
+              "umol/L": "umol/L",
+              "mg/dL": "mg/dL",
+              "GI/L": "10*9/L",
+              "TI/L": "10*12/L",
+              "%": "%"}
+
+# VSPOS to SNOMED
+BODY_POSITIONS = {"SUPINE": ("40199007", "Supine body position"),
+                  "STANDING": ("10904000", "Orthostatic body position"),
+                  "SITTING": ("33586001", "Sitting position")}
+
+# VSLOC to SNOMED
+BODY_SITES = {"ARM": ("53120007", "Upper limb structure"),
+              "LEFT ARM": ("368208006", "Left upper arm structure"),
+              "RIGHT ARM": ("368209003", "Right upper arm structure"),
+              "ORAL CAVITY": ("74262004", "Oral cavity structure"),
+              "EAR": ("117590005", "Ear structure")}
+
+
+class Assignment(NamedTuple):
+    """
+    The values of a column (after a lookup or value map) go to the path in the resource
+    """
+    column: str
+    resource_type: str
+    # (element, is a list) for each step on the path
+    path: Tuple[Tuple[str, bool], ...]
+    # number, date, datetime, boolean or string for a primitive, None for the value of a lookup or reference
+    kind: Optional[str] = None
+    lookup: Optional[str] = None
+    reference: Optional[str] = None
+    maps: Optional[dict] = None
+
+
+class TransformPlan:
+    """
+    The compiled mapping for a domain; the assignments for each resource type, checked against the FHIR models
+    """
+
+    def __init__(self, domain: str, keys: List[str], assignments: List[Assignment], defaults: Dict[str, dict]):
+        self.domain = domain
+        self.keys = keys
+        self.assignments = assignments
+        self.defaults = defaults
+
+    @property
+    def resource_types(self) -> List[str]:
+        return sorted({x.resource_type for x in self.assignments})
+
+    def for_resource(self, resource_type: str) -> List[Assignment]:
+        return [x for x in self.assignments if x.resource_type == resource_type]
+
+
+def _primitive_kind(type_) -> str:
+    if issubclass(type_, fhirtypes.Boolean):
+        return "boolean"
+    if issubclass(type_, (Decimal, int)):
+        return "number"
+    if issubclass(type_, fhirtypes.Date):
+        return "date"
+    if issubclass(type_, (fhirtypes.DateTime, fhirtypes.Instant)):
+        return "datetime"
+    return "string"
+
+
+def _element(model, name: str):
+    """
+    Get the field for the element (by the JSON name) of a model
+    """
+    for field in model.__fields__.values():
+        if field.alias == name:
+            return field
+    raise ValueError(f"{model.get_resource_type()} has no element {name}")
+
+
+def compile_config(config: Configuration, domain: str) -> TransformPlan:
+    """
+    Compile a column mapping into a plan
+    """
+    assignments = []
+    for column, targets in config.mappings():
+        for resource_type, node in (targets or {}).items():
+            model = get_fhir_model_class(resource_type)
+            try:
+                assignments.extend(_compile_node(column, resource_type, node, model, ()))
+            except ValueError as exc:
+                raise ValueError(f"{domain} {column}: {exc}") from exc
+    return TransformPlan(domain, config.keys(), assignments, config.defaults())
+
+
+def _compile_node(column: str, resource_type: str, node: Any, model, path: tuple) -> List[Assignment]:
+    if node is None:
+        return []
+    if isinstance(node, str):
+        if node.startswith("_lookup_"):
+            if not hasattr(TransformEngine, node):
+                raise ValueError(f"unknown lookup {node}")
+            return [Assignment(column, resource_type, path, lookup=node)]
+        if node[0].isupper():
+            # a reference to the resource with the hashed value as the id
+            if model.get_resource_type() != "Reference":
+                raise ValueError(f"{'.'.join(x for x, _ in path)} is not a Reference")
+            return [Assignment(column, resource_type, path, reference=node)]
+        node = {node: None}
+    assignments = []
+    for name, child in node.items():
+        field = _element(model, name)
+        step = path + ((name, field.shape != 1),)
+        resource = getattr(field.type_, "__resource_type__", None)
+        if child is None or (isinstance(child, dict) and set(child) == {"maps"}):
+            if resource is not None:
+                raise ValueError(f"{'.'.join(x for x, _ in step)} is not a primitive")
+            assignments.append(Assignment(column, resource_type, step, kind=_primitive_kind(field.type_),
+                                          maps=child["maps"] if child else None))
+        else:
+            if resource is None:
+                raise ValueError(f"{'.'.join(x for x, _ in step)} is a primitive")
+            assignments.extend(_compile_node(column, resource_type, child, get_fhir_model_class(resource), step))
+    return assignments
+
+
+def _coerce(values: pd.Series, kind: Optional[str]) -> pd.Series:
+    """
+    Convert a column to the JSON values for a primitive, with None for the missing values
+    """
+    if kind == "number":
+        values = pd.to_numeric(values, errors="coerce")
+        whole = values.notna() & (values % 1 == 0)
+        converted = values.astype(object)
+        converted[whole] = values[whole].astype("int64")
+    elif kind in ("date", "datetime"):
+        values = pd.to_datetime(values, errors="coerce")
+        if kind == "date":
+            converted = values.dt.strftime("%Y-%m-%d")
+        else:
+            # the date alone when there's no time
+            converted = values.dt.strftime("%Y-%m-%dT%H:%M:%S").where(values.dt.normalize() != values,
+                                                                     values.dt.strftime("%Y-%m-%d"))
+    elif kind == "boolean":
+        converted = values.map({"Y": True, "N": False, True: True, False: False})
+    else:
+        converted = values.astype(str).str.strip().where(values.notna())
+        converted = converted.str.replace(r"\.0$", "", regex=True) if values.dtype.kind == "f" else converted
+        converted = converted.where(converted != "")
+    return converted.astype(object).where(converted.notna(), None)
+
+
+def _copy(value: Any) -> Any:
+    # the values are plain JSON, much quicker than a deepcopy
+    if isinstance(value, dict):
+        return {name: _copy(item) for name, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+
+def _merge(target: dict, value: dict) -> None:
+    for name, item in value.items():
+        if isinstance(item, dict) and isinstance(target.get(name), dict):
+            _merge(target[name], item)
+        else:
+            target[name] = _copy(item)
+
+
+class TransformEngine:
+    """
+    Builds FHIR resources (as JSON dicts) from SDTM datasets using the compiled column mappings
+
+    Each column of the dataset is extracted and converted (or looked up) once, and the resources are then
+    built from the converted columns; the YAML is never looked at per row.
+    """
+
+    def __init__(self, config_dir: str = CONFIG_DIR, mapper: Optional[TestCodeMapper] = None):
+        self._config_dir = config_dir
+        self._mapper = mapper
+        self._plans = {}  # type: Dict[str, TransformPlan]
+
+    @property
+    def mapper(self) -> TestCodeMapper:
+        if self._mapper is None:
+            self._mapper = TestCodeMapper()
+        return self._mapper
+
+    def plan(self, domain: str) -> TransformPlan:
+        """
+        The compiled plan for a domain
+        """
+        domain = domain.upper()
+        if domain not in self._plans:
+            config = Configuration.from_file(os.path.join(self._config_dir, f"{domain.lower()}.yml"))
+            self._plans[domain] = compile_config(config, domain)
+        return self._plans[domain]
+
+    def resource_ids(self, plan: TransformPlan, frame: pd.DataFrame, resource_type: str) -> List[str]:
+        """
+        The deterministic ids for the resources; from the subject, domain and sequence number (or the keys)
+        """
+        subjects = MINTER.mint_many(frame.USUBJID.tolist())
+        if resource_type == "Patient":
+            return subjects
+        seq_column = f"{plan.domain}SEQ"
+        if seq_column in frame.columns:
+            seqs = _coerce(frame[seq_column], "string").tolist()
+        else:
+            others = [x for x in plan.keys if x != "USUBJID"]
+            seqs = ["-".join(x) for x in zip(*[_coerce(frame[x], "string").astype(str) for x in others])] if others \
+                else [str(x) for x in range(len(frame))]
+        return [observation_id(p, plan.domain, s, resource_type) for p, s in zip(subjects, seqs)]
+
+    def _values(self, plan: TransformPlan, assignment: Assignment, frame: pd.DataFrame) -> List[Any]:
+        values = frame[assignment.column]
+        if assignment.lookup:
+            return getattr(self, assignment.lookup)(plan, values, frame)
+        if assignment.reference:
+            keys = _coerce(values, "string").tolist()
+            ids = dict(zip(set(keys) - {None}, MINTER.mint_many(set(keys) - {None})))
+            return [{"reference": f"{assignment.reference}/{ids[x]}"} if x is not None else None for x in keys]
+        if assignment.maps:
+            values = values.map(assignment.maps)
+        return _coerce(values, assignment.kind).tolist()
+
+    def transform(self, domain: str, frame: pd.DataFrame, resource_type: str = "Observation") -> List[dict]:
+        """
+        Build a resource of the type for each row in the dataset
+        """
+        plan = self.plan(domain)
+        assignments = [x for x in plan.for_resource(resource_type) if x.column in frame.columns]
+        frame = frame.reset_index(drop=True)
+        columns = [(x.path, self._values(plan, x, frame)) for x in assignments]
+        ids = self.resource_ids(plan, frame, resource_type)
+        defaults = dict(plan.defaults.get(resource_type, {}))
+        resources = []
+        for offset, resource_id in enumerate(ids):
+            resource = dict(resourceType=resource_type, id=resource_id, **_copy(defaults))
+            for path, values in columns:
+                value = values[offset]
+                if value is None:
+                    continue
+                node = resource
+                for name, is_list in path[:-1]:
+                    child = node.get(name)
+                    if child is None:
+                        child = {}
+                        node[name] = [child] if is_list else child
+                    elif is_list:
+                        child = child[0]
+                    node = child
+                name, is_list = path[-1] if path else (None, False)
+                if name is None:
+                    _merge(node, value)
+                elif isinstance(value, dict):
+                    existing = node.get(name)
+                    if existing is None:
+                        existing = {}
+                        node[name] = [existing] if is_list else existing
+                    elif is_list:
+                        existing = existing[0]
+                    _merge(existing, value)
+                else:
+                    node[name] = [value] if is_list else value
+            resources.append(resource)
+        return resources
+
+    def _lookup_loinc_code(self, plan: TransformPlan, values: pd.Series, frame: pd.DataFrame) -> List[Optional[dict]]:
+        """
+        The LOINC coding for a test; from the LOINC to LB mapping document for LB, the vital signs panel for VS
+        """
+        if plan.domain == "LB":
+            codes = self.mapper.map_frame(frame).LBLOINC
+            names = {x: self.mapper.name(x) for x in codes.dropna().unique()}
+        else:
+            codes = values.map(lambda x: VS_LOINC_CODES.get(x, (None,))[0])
+            names = {code: name for code, name in VS_LOINC_CODES.values()}
+        return [{"coding": [dict(system=LOINC_SYSTEM, code=x, display=names.get(x))]} if isinstance(x, str) else None
+                for x in codes.tolist()]
+
+    def _lookup_loinc_name(self, plan: TransformPlan, values: pd.Series, frame: pd.DataFrame) -> List[Optional[dict]]:
+        """
+        The test name as the text of the code
+        """
+        return [{"text": x} if x is not None else None for x in _coerce(values, "string").tolist()]
+
+    _lookup_loinc_test = _lookup_loinc_name
+
+    def _lookup_unit_ucum(self, plan: TransformPlan, values: pd.Series, frame: pd.DataFrame) -> List[Optional[dict]]:
+        """
+        The unit for a quantity, with the UCUM code when there is one
+        """
+        looked_up = {}
+        for unit in values.dropna().unique():
+            unit = str(unit).strip()
+            if unit:
+                looked_up[unit] = dict(unit=unit, system=UCUM_SYSTEM, code=UCUM_UNITS[unit]) \
+                    if unit in UCUM_UNITS else dict(unit=unit)
+        return [looked_up.get(x) for x in _coerce(values, "string").tolist()]
+
+    def _lookup_body_position(self, plan: TransformPlan, values: pd.Series,
+                              frame: pd.DataFrame) -> List[Optional[dict]]:
+        """
+        The body position extension for a vital sign
+        """
+        return [dict(url=BODY_POSITION_EXTENSION,
+                     valueCodeableConcept=_snomed_concept(x, BODY_POSITIONS)) if x is not None else None
+                for x in _coerce(values, "string").tolist()]
+
+    def _lookup_snomed_code(self, plan: TransformPlan, values: pd.Series, frame: pd.DataFrame) -> List[Optional[dict]]:
+        """
+        The SNOMED coding for a location
+        """
+        return [_snomed_concept(x, BODY_SITES) if x is not None else None for x in _coerce(values, "string").tolist()]
+
+
+def _snomed_concept(value: str, codes: Dict[str, Tuple[str, str]]) -> dict:
+    if value.upper() in codes:
+        code, display = codes[value.upper()]
+        return dict(coding=[dict(system=SNOMED_SYSTEM, code=code, display=display)], text=value)
+    return dict(text=value)
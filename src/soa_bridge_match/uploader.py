@@ -0,0 +1,313 @@
+import hashlib
+import http.client
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+from .jsonstream import iter_entries
+
+# statuses worth another try
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+MAX_ENTRIES = 500
+MAX_BYTES = 4 * 1024 ** 2
+
+
+class Chunk(NamedTuple):
+    """
+    A part of a subject bundle, posted as one transaction (or batch)
+    """
+    filename: str
+    number: int
+    # chunks of a file in the same wave don't reference each other, each wave references the earlier ones
+    wave: int
+    # the serialised entries
+    entries: List[bytes]
+    size: int
+
+    @property
+    def name(self) -> str:
+        return f"{os.path.basename(self.filename)}#{self.number}"
+
+    @property
+    def digest(self) -> str:
+        return hashlib.sha1(b",".join(self.entries)).hexdigest()
+
+
+def references(value: Any, found: Optional[Set[str]] = None) -> Set[str]:
+    """
+    The (relative) references in a resource, as Type/id
+    """
+    found = set() if found is None else found
+    if isinstance(value, dict):
+        for name, item in value.items():
+            if name == "reference" and isinstance(item, str):
+                if not item.startswith("#") and "://" not in item:
+                    found.add("/".join(item.split("/")[:2]))
+            else:
+                references(item, found)
+    elif isinstance(value, list):
+        for item in value:
+            references(item, found)
+    return found
+
+
+def _levels(keys: List[str], dependencies: Dict[str, Set[str]]) -> Dict[str, int]:
+    """
+    The depth of each resource in the reference graph, the resources referencing nothing come first
+    """
+    remaining = {key: set(dependencies[key]) for key in keys}
+    levels = {}
+    level = 0
+    while remaining:
+        ready = [key for key, deps in remaining.items() if not deps - levels.keys()]
+        if not ready:
+            # a cycle; these go in together
+            ready = list(remaining)
+        for key in ready:
+            levels[key] = level
+            del remaining[key]
+        level += 1
+    return levels
+
+
+def chunk_bundle(filename: str, max_entries: int = MAX_ENTRIES, max_bytes: int = MAX_BYTES) -> List[Chunk]:
+    """
+    Split a Bundle file into chunks of at most max_entries entries (and about max_bytes)
+
+    Resources that reference each other (directly or not) are kept in the same chunk where they fit; a
+    larger group is split in reference order, so the resources a chunk references are in the chunk or
+    in a chunk of an earlier wave.
+    """
+    keys = []
+    serialised = {}
+    dependencies = {}
+    for entry in iter_entries(filename):
+        resource = entry.get("resource") or {}
+        key = f"{resource.get('resourceType')}/{resource.get('id')}"
+        if key in serialised:
+            continue
+        if "request" not in entry:
+            entry["request"] = dict(method="PUT", url=key)
+        keys.append(key)
+        serialised[key] = json.dumps(entry, separators=(",", ":")).encode("utf-8")
+        dependencies[key] = references(resource)
+    for key in keys:
+        dependencies[key] = {x for x in dependencies[key] if x in serialised and x != key}
+    # group the resources that reference each other
+    parent = {key: key for key in keys}
+
+    def find(key):
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    for key in keys:
+        for dependency in dependencies[key]:
+            parent[find(key)] = find(dependency)
+    groups = {}
+    for key in keys:
+        groups.setdefault(find(key), []).append(key)
+    chunks = []
+    current = []
+    size = 0
+    waves = {}
+    chunk_of = {}
+
+    def close():
+        nonlocal current, size
+        if current:
+            number = len(chunks)
+            waves[number] = max([waves[chunk_of[dep]] + 1 for key in current for dep in dependencies[key]
+                                 if chunk_of.get(dep, number) != number] or [0])
+            chunks.append(Chunk(filename, number, waves[number], [serialised[x] for x in current], size))
+        current, size = [], 0
+
+    for group in groups.values():
+        group_size = sum(len(serialised[x]) for x in group)
+        if len(current) + len(group) <= max_entries and size + group_size <= max_bytes:
+            # the whole group fits
+            ordered = group
+        else:
+            close()
+            levels = _levels(group, dependencies)
+            ordered = sorted(group, key=lambda x: levels[x])
+        for key in ordered:
+            entry_size = len(serialised[key])
+            if current and (len(current) >= max_entries or size + entry_size > max_bytes):
+                close()
+            current.append(key)
+            chunk_of[key] = len(chunks)
+            size += entry_size
+    close()
+    return chunks
+
+
+class Uploader:
+    """
+    Posts subject bundles to a FHIR server in chunks
+
+    The chunks are posted on a pool of worker threads, each keeping its own connection alive; a chunk is
+    retried (with exponential backoff) on connection errors and on the statuses in RETRY_STATUSES.  With a
+    checkpoint file the chunks that were posted are recorded, and skipped when the upload is run again.
+    """
+
+    def __init__(self, baseurl: str, workers: int = 4, max_entries: int = MAX_ENTRIES,
+                 max_bytes: int = MAX_BYTES, bundle_type: str = "transaction", retries: int = 5,
+                 backoff: float = 0.5, timeout: float = 120, checkpoint: Optional[str] = None):
+        if bundle_type not in ("transaction", "batch"):
+            raise ValueError(f"Unsupported bundle type {bundle_type}")
+        url = urlsplit(baseurl)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.path = url.path.rstrip("/") or "/"
+        self.workers = workers
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bundle_type = bundle_type
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.checkpoint = checkpoint
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._done = self._read_checkpoint()
+
+    def _read_checkpoint(self) -> Set[Tuple[str, str]]:
+        done = set()
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a partly written line
+                        continue
+                    if 200 <= record.get("status", 0) < 300:
+                        done.add((record["chunk"], record["digest"]))
+        return done
+
+    def _record(self, chunk: Chunk, status: int, elapsed: float) -> None:
+        if not self.checkpoint:
+            return
+        line = json.dumps(dict(chunk=chunk.name, digest=chunk.digest, status=status, entries=len(chunk.entries),
+                               elapsed=round(elapsed, 3)))
+        with self._lock:
+            with open(self.checkpoint, "a") as fh:
+                fh.write(line + "\n")
+
+    @property
+    def connection(self) -> http.client.HTTPConnection:
+        """
+        The connection for the current thread
+        """
+        if getattr(self._local, "connection", None) is None:
+            cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            self._local.connection = cls(self.netloc, timeout=self.timeout)
+        return self._local.connection
+
+    def _reset(self) -> None:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+        self._local.connection = None
+
+    def body(self, chunk: Chunk) -> bytes:
+        return (b'{"resourceType":"Bundle","type":"' + self.bundle_type.encode("ascii") + b'","entry":[' +
+                b",".join(chunk.entries) + b"]}")
+
+    def _post(self, body: bytes) -> Tuple[int, bytes, Optional[str]]:
+        connection = self.connection
+        connection.request("POST", self.path, body=body,
+                           headers={"Content-Type": "application/fhir+json", "Accept": "application/fhir+json"})
+        response = connection.getresponse()
+        # read it all to keep the connection usable
+        content = response.read()
+        return response.status, content, response.getheader("Retry-After")
+
+    def post(self, chunk: Chunk) -> Tuple[int, int]:
+        """
+        Post a chunk, with retries; returns the status and the number of entries that failed
+        """
+        body = self.body(chunk)
+        started = time.time()
+        status = 0
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            try:
+                status, content, retry_after = self._post(body)
+            except (OSError, http.client.HTTPException) as exc:
+                self._reset()
+                status, content = 0, str(exc).encode("utf-8")
+            if status and status not in RETRY_STATUSES:
+                break
+            if attempt < self.retries:
+                delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                print(f"Retrying {chunk.name} ({status or content.decode('utf-8', 'replace')}) in {delay:.1f}s")
+                time.sleep(delay)
+        failed = len(chunk.entries) if not 200 <= status < 300 else 0
+        if not failed and self.bundle_type == "batch":
+            # the entries of a batch succeed (or fail) on their own
+            try:
+                entries = json.loads(content).get("entry") or []
+                failed = sum(1 for x in entries if not str((x.get("response") or {}).get("status", "")).startswith("2"))
+            except ValueError:
+                pass
+        if failed:
+            print(f"Failed to post {chunk.name}: {status} {content[:200].decode('utf-8', 'replace')}")
+        self._record(chunk, status, time.time() - started)
+        return status, failed
+
+    def upload_file(self, filename: str, executor: ThreadPoolExecutor) -> Dict[str, int]:
+        """
+        Upload a bundle, wave by wave, posting the chunks of a wave on the executor; returns the counts
+        """
+        chunks = chunk_bundle(filename, self.max_entries, self.max_bytes)
+        pending = [x for x in chunks if (x.name, x.digest) not in self._done]
+        stats = dict(chunks=len(chunks), resumed=len(chunks) - len(pending), posted=0, resources=0, failed=0,
+                     skipped=0)
+        failed_wave = False
+        for wave in sorted({x.wave for x in pending}):
+            batch = [x for x in pending if x.wave == wave]
+            if failed_wave:
+                # the later chunks reference the earlier ones
+                stats["skipped"] += sum(len(x.entries) for x in batch)
+                continue
+            for chunk, (status, failed) in zip(batch, executor.map(self.post, batch)):
+                stats["posted"] += 1
+                stats["resources"] += len(chunk.entries) - failed
+                stats["failed"] += failed
+                if failed and self.bundle_type == "transaction":
+                    failed_wave = True
+        return stats
+
+    def upload(self, filenames: Iterable[str]) -> Dict[str, Any]:
+        """
+        Upload the bundles; returns the counts and rate
+
+        The files are chunked as they're uploaded, a few at a time (so only those are held in memory), and the
+        waves of one file don't hold up the others.
+        """
+        started = time.time()
+        filenames = list(filenames)
+        stats = dict(files=len(filenames), chunks=0, resumed=0, posted=0, resources=0, failed=0, skipped=0)
+        print(f"Uploading {len(filenames)} files")
+        with ThreadPoolExecutor(max_workers=self.workers) as executor, \
+                ThreadPoolExecutor(max_workers=self.workers) as files:
+            for counts in files.map(lambda x: self.upload_file(x, executor), filenames):
+                for name, value in counts.items():
+                    stats[name] += value
+        elapsed = time.time() - started
+        stats["elapsed"] = elapsed
+        stats["rate"] = stats["resources"] / elapsed if elapsed else 0.0
+        print("Posted {posted} chunks, {resources} resources ({failed} failed, {skipped} skipped, {resumed} chunks "
+              "done already) in {elapsed:.2f}s, {rate:.1f} resources/s".format(**stats))
+        return stats
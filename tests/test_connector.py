@@ -0,0 +1,74 @@
+import os
+import shutil
+
+import pytest
+
+from soa_bridge_match import connector
+from soa_bridge_match.connector import Connector, DatasetRegistry
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+class Response:
+    """
+    Stands in for the response to the download of an XPT file
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as fh:
+            self.content = fh.read()
+
+    def getcode(self):
+        return 200
+
+    def read(self):
+        return self.content
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """
+    Count the downloads (answered from the fixtures) and the XPT parses
+    """
+    counts = dict(fetch=0, parse=0)
+    read_xpt = connector.read_xpt
+
+    def urlopen(url):
+        counts["fetch"] += 1
+        return Response(os.path.join(FIXTURES, url.rsplit("/", 1)[-1]))
+
+    def parse(source):
+        counts["parse"] += 1
+        return read_xpt(source)
+
+    monkeypatch.setattr(connector, "urlopen", urlopen)
+    monkeypatch.setattr(connector, "read_xpt", parse)
+    return counts
+
+
+def test_warm_load(tmp_path, calls):
+    cache_dir = str(tmp_path / "cache")
+    cold = Connector(cache_dir, registry=DatasetRegistry()).load_cdiscpilot_dataset("DM")
+    assert calls == dict(fetch=1, parse=1)
+    # a new process (no datasets in memory) loads the parsed copy from the store
+    warm = Connector(cache_dir, registry=DatasetRegistry()).load_cdiscpilot_dataset("DM")
+    assert calls == dict(fetch=1, parse=1)
+    assert warm.equals(cold)
+    assert warm.USUBJID.tolist() == ["01-701-1015", "01-701-1023", "01-701-1028", "01-701-1033"]
+
+
+def test_seeded_store(tmp_path, calls):
+    # a store pre-seeded with the XPT file needs no download
+    shutil.copy(os.path.join(FIXTURES, "dm.xpt"), tmp_path / "dm.xpt")
+    index = Connector(str(tmp_path), offline=True, registry=DatasetRegistry()).subject_index("DM")
+    assert "01-701-1015" in index
+    assert calls == dict(fetch=0, parse=1)
+
+
+def test_offline_missing(tmp_path, calls):
+    offline = Connector(str(tmp_path), offline=True, registry=DatasetRegistry())
+    assert offline.load_cdiscpilot_dataset("LB") is None
+    with pytest.raises(ValueError):
+        offline.subject_index("LB")
+    assert not offline.exists("LB")
+    assert calls == dict(fetch=0, parse=0)
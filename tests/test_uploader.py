@@ -0,0 +1,102 @@
+import itertools
+import json
+import threading
+import types
+
+import pytest
+
+import stub_server
+from soa_bridge_match.uploader import Uploader, chunk_bundle, references
+
+
+def write_bundle(path, encounters=5, observations=10):
+    """
+    A subject bundle where the Observations reference the Encounters, which reference the Patient
+    """
+    resources = [dict(resourceType="Patient", id="p1")]
+    for number in range(encounters):
+        resources.append(dict(resourceType="Encounter", id=f"e{number}", status="finished",
+                              subject=dict(reference="Patient/p1")))
+    for number in range(observations):
+        resources.append(dict(resourceType="Observation", id=f"o{number}", status="final",
+                              code=dict(text="Test"), subject=dict(reference="Patient/p1"),
+                              encounter=dict(reference=f"Encounter/e{number % encounters}")))
+    # the referencing resources first, so the order has to come from the chunking
+    resources.reverse()
+    path.write_text(json.dumps(dict(resourceType="Bundle", type="transaction",
+                                    entry=[dict(resource=x) for x in resources])))
+    return str(path)
+
+
+@pytest.fixture
+def server(tmp_path):
+    empty = tmp_path / "empty"
+    empty.mkdir()
+    server = stub_server.make_server(str(empty), port=0, writable=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def baseurl(server):
+    return f"http://localhost:{server.server_address[1]}/"
+
+
+def test_chunk_waves(tmp_path):
+    filename = write_bundle(tmp_path / "subject.json")
+    chunks = chunk_bundle(filename, max_entries=4)
+    assert sum(len(x.entries) for x in chunks) == 16
+    assert len({x.wave for x in chunks}) > 1
+    wave_of = {}
+    for chunk in chunks:
+        for entry in chunk.entries:
+            resource = json.loads(entry)["resource"]
+            wave_of[f"{resource['resourceType']}/{resource['id']}"] = (chunk.wave, chunk.number)
+    for chunk in chunks:
+        for entry in chunk.entries:
+            for reference in references(json.loads(entry)["resource"]):
+                # referenced resources are in the same chunk or an earlier wave
+                wave, number = wave_of[reference]
+                assert number == chunk.number or wave < chunk.wave
+
+
+def test_upload_in_wave_order(tmp_path, server):
+    filename = write_bundle(tmp_path / "subject.json")
+    stats = Uploader(baseurl(server), workers=4, max_entries=4).upload([filename])
+    # the stub rejects a transaction referencing a resource it doesn't have yet
+    assert stats["failed"] == 0
+    assert stats["resources"] == 16
+    assert len(server.engine) == 16
+
+
+def test_out_of_order_rejected(tmp_path, server):
+    filename = write_bundle(tmp_path / "subject.json")
+    chunks = chunk_bundle(filename, max_entries=4)
+    uploader = Uploader(baseurl(server), retries=0)
+    status, failed = uploader.post(max(chunks, key=lambda x: x.wave))
+    assert status == 400
+    assert failed > 0
+
+
+def test_retries(tmp_path, server, monkeypatch, capsys):
+    filename = write_bundle(tmp_path / "subject.json")
+    # every other post fails with a 503
+    server.fail_rate = 0.5
+    draws = itertools.cycle([0.0, 0.9])
+    monkeypatch.setattr(stub_server, "random", types.SimpleNamespace(random=lambda: next(draws)))
+    stats = Uploader(baseurl(server), workers=1, max_entries=4, retries=3, backoff=0.01).upload([filename])
+    assert "Retrying" in capsys.readouterr().out
+    assert stats["failed"] == 0
+    assert len(server.engine) == 16
+
+
+def test_checkpoint_resume(tmp_path, server):
+    filename = write_bundle(tmp_path / "subject.json")
+    checkpoint = str(tmp_path / "upload.jsonl")
+    first = Uploader(baseurl(server), max_entries=4, checkpoint=checkpoint).upload([filename])
+    assert first["posted"] == first["chunks"]
+    second = Uploader(baseurl(server), max_entries=4, checkpoint=checkpoint).upload([filename])
+    assert second["posted"] == 0
+    assert second["resumed"] == first["chunks"]
@@ -0,0 +1,82 @@
+import glob
+import os
+import threading
+
+import pytest
+
+import stub_server
+from cache import ResponseCache
+from soa_bridge_match.query import LocalSession, QueryEngine
+from windows import StudyWindow
+
+SUBJECTS_DIR = os.path.join(os.path.dirname(__file__), "..", "upstream", "subjects")
+STUDY_ID = "H2Q-MC-LZZT"
+
+
+@pytest.fixture(scope="module")
+def baseurl():
+    server = stub_server.make_server(SUBJECTS_DIR, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://localhost:{server.server_address[1]}/"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="module")
+def engine():
+    return QueryEngine.from_files(sorted(glob.glob(os.path.join(SUBJECTS_DIR, "*.json"))))
+
+
+def evaluate(window, subject_ids=None):
+    protocol = window.process_protocol(window.get_protocol())
+    if subject_ids is None:
+        return window.get_cohort_scheme(protocol)
+    return [row for subject_id in subject_ids for row in window.get_subject_scheme(subject_id, protocol, False)]
+
+
+@pytest.fixture(scope="module")
+def sequential(baseurl):
+    # one request at a time over HTTP
+    window = StudyWindow(baseurl, STUDY_ID, max_workers=1, cache=ResponseCache())
+    protocol = window.process_protocol(window.get_protocol())
+    rows = {}
+    for research_subject in window._get_research_subjects():
+        try:
+            rows[research_subject.id] = window.get_subject_scheme(research_subject.id, protocol, False)
+        except Exception:
+            # (a subject missing a visit Encounter in the bundles)
+            rows[research_subject.id] = None
+    return rows
+
+
+def test_subject_scheme_concurrent(baseurl, sequential):
+    subject_id = "01-701-1015"
+    window = StudyWindow(baseurl, STUDY_ID, max_workers=8, cache=ResponseCache())
+    rows = evaluate(window, [subject_id])
+    assert rows
+    assert rows == sequential[subject_id]
+
+
+def test_subject_scheme_local(engine, sequential):
+    subject_id = "01-701-1015"
+    window = StudyWindow("http://localhost/fhir/", STUDY_ID, session=LocalSession(engine))
+    assert evaluate(window, [subject_id]) == sequential[subject_id]
+
+
+def test_cohort_scheme_concurrent(baseurl, sequential):
+    window = StudyWindow(baseurl, STUDY_ID, max_workers=8, cache=ResponseCache())
+    rows, failures = evaluate(window)
+    assert rows
+    assert rows == [row for subject_rows in sequential.values() if subject_rows for row in subject_rows]
+    # the subjects that fail are reported, not counted
+    assert set(failures) == {x for x, subject_rows in sequential.items() if subject_rows is None}
+
+
+def test_cohort_scheme_local(engine, sequential):
+    window = StudyWindow("http://localhost/fhir/", STUDY_ID, session=LocalSession(engine))
+    rows, failures = evaluate(window)
+    assert rows
+    assert rows == [row for subject_rows in sequential.values() if subject_rows for row in subject_rows]
+    # the subjects that fail are reported, not counted
+    assert set(failures) == {x for x, subject_rows in sequential.items() if subject_rows is None}
@@ -1,21 +1,82 @@
+import argparse
+import functools
 import os
-import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
 
+from soa_bridge_match.connector import REGISTRY, Connector
 from soa_bridge_match.dataset import Naptha
+from soa_bridge_match.ids import MINTER
 
-def process_file(filename):
-    # getting the bundle
+# domains used for the merge, loaded once and shared with the workers
+DOMAINS = ("DM", "SV")
+OBSERVATION_DOMAINS = ("LB", "VS")
+
+
+def process_file(filename, observations: bool = False):
+    # getting the bundle, kept as JSON when adding the Observations
     print("Processing file: {}".format(filename))
-    ds = Naptha(filename)
+    ds = Naptha(filename, lazy=observations)
     ds.merge_sv()
+    if observations:
+        ds.merge_lb(verbose=True)
+        ds.merge_vs(verbose=True)
     ds.content.dump()
 
 
-def process_dir(dirname):
-    for fname in os.listdir(dirname):
-        if fname.endswith('.json'):
-            process_file(os.path.join(dirname, fname))
+def _process_file(filename, observations: bool = False) -> Tuple[str, Optional[str]]:
+    """
+    Process a file, returning the error rather than raising it so the batch carries on
+    """
+    try:
+        process_file(filename, observations)
+    except Exception as exc:
+        return filename, "{}: {}".format(type(exc).__name__, exc)
+    finally:
+        # a pool worker exits without the atexit handlers, write the minted ids as we go
+        MINTER.flush()
+    return filename, None
+
+
+def _init_worker(datasets: dict):
+    # seed the worker with the datasets loaded in the parent
+    for key, value in datasets.items():
+        REGISTRY.put(key, value)
+
+
+def process_dir(dirname, jobs: int = 1, observations: bool = False):
+    filenames = sorted(os.path.join(dirname, fname) for fname in os.listdir(dirname) if fname.endswith('.json'))
+    started = time.time()
+    if jobs > 1:
+        # load the datasets (and the subject indexes) once in the parent
+        connector = Connector()
+        for domain in DOMAINS + (OBSERVATION_DOMAINS if observations else ()):
+            connector.subject_index(domain)
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(REGISTRY.items(),)) as executor:
+            results = list(executor.map(functools.partial(_process_file, observations=observations), filenames))
+    else:
+        results = [_process_file(filename, observations) for filename in filenames]
+    elapsed = time.time() - started
+    failed = [(filename, error) for filename, error in results if error]
+    for filename, error in failed:
+        print("Failed to process {}: {}".format(filename, error))
+    print("Processed {} files ({} failed) in {:.2f}s, {:.2f} files/s using {} job(s)".format(
+        len(results), len(failed), elapsed, len(results) / elapsed if elapsed else 0.0, jobs))
+    if jobs == 1:
+        stats = REGISTRY.stats()
+        print("Dataset cache: {} hits, {} misses".format(stats["hits"], stats["misses"]))
+        for key, counts in stats["keys"].items():
+            print("  {}: loaded {} time(s), {} hits".format("/".join(key[1:]), counts["misses"], counts["hits"]))
 
 
 if __name__ == "__main__":
-    process_dir(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Merge the visits from the SV domain into the subject bundles")
+    parser.add_argument("dirname", help="The directory containing the subject bundles")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1,
+                        help="The number of files to process in parallel")
+    parser.add_argument("--observations", action="store_true",
+                        help="Also merge the LB and VS domains as Observations")
+    opts = parser.parse_args()
+    process_dir(opts.dirname, opts.jobs, opts.observations)
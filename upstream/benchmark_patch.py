@@ -0,0 +1,55 @@
+"""
+Times the patching and splitting of synthetic bundles of increasing size.
+
+The time per entry should stay flat as the bundle grows; a growing time per entry
+means something in the duplicate detection (or the split) has gone quadratic.
+"""
+import argparse
+import contextlib
+import io
+import time
+
+from patch_json import PatchState, patch_entry, split_bundle
+
+
+def make_bundle(size: int, subjects: int = 100, duplicates: float = 0.01) -> dict:
+    """
+    Build a bundle of Observations spread across the subjects, with a fraction of duplicated ids
+    """
+    entries = []
+    for idx in range(subjects):
+        entries.append(dict(resource=dict(resourceType="Patient", id=f"01-701-{idx:04d}")))
+    for idx in range(size - subjects):
+        _id = f"obs-{idx - 1}" if idx and idx % int(1 / duplicates) == 0 else f"obs-{idx}"
+        entries.append(dict(resource=dict(resourceType="Observation",
+                                          id=_id,
+                                          status="final",
+                                          code=dict(text="Glucose"),
+                                          subject=dict(reference=f"Patient/01-701-{idx % subjects:04d}"))))
+    return dict(resourceType="Bundle", entry=entries)
+
+
+def run(sizes):
+    print(f"{'entries':>10} {'patch (s)':>10} {'split (s)':>10} {'us/entry':>10} {'duplicates':>10}")
+    for size in sizes:
+        bundle = make_bundle(size)
+        state = PatchState()
+        started = time.perf_counter()
+        # patch_entry reports each duplicate
+        with contextlib.redirect_stdout(io.StringIO()):
+            for idx, entry in enumerate(bundle["entry"]):
+                patch_entry(idx, entry, state)
+            patched = time.perf_counter()
+            split_bundle(bundle, state.patient_ids.keys())
+        split = time.perf_counter()
+        print(f"{size:>10} {patched - started:>10.3f} {split - patched:>10.3f} "
+              f"{(split - started) / size * 1e6:>10.1f} {len(state.dupes):>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the patching of bundles of increasing size")
+    parser.add_argument("sizes", nargs="*", type=int,
+                        default=[1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000],
+                        help="The bundle sizes (number of entries)")
+    opts = parser.parse_args()
+    run(opts.sizes)
@@ -18,32 +18,37 @@ def process_file(filename):
     ds.content.dump()
 
 
-def clone_subject(old_subject_bundle: str, new_subject_id: str):
-    # getting the bundle
-    bundle = bundler.SourcedBundle.from_bundle_file(old_subject_bundle)
+def clone_subject(old_subject_bundle: str, new_subject_ids, workers: int = 1, seed=None):
+    # getting the bundle, the entries are only needed as JSON
+    bundle = bundler.SourcedBundle.from_bundle_file(old_subject_bundle, lazy=True)
     assert len(bundle.subjects) == 1, "Only one subject is allowed"
     old_subject_id = bundle.subjects[0]
     print("Cloning subject: {}".format(old_subject_id))
-    clone = bundle.clone_subject(new_subject_id)
-    fname = os.path.splitext(os.path.basename(old_subject_bundle))[0]
-    ofname = fname.replace(old_subject_id, new_subject_id)
     dirname = os.path.dirname(old_subject_bundle)
-    clone.dump(target_dir=dirname, name=ofname)
+    filenames = bundle.clone_subjects(new_subject_ids, subject_id=old_subject_id, target_dir=dirname,
+                                      workers=workers, seed=seed)
+    print("Wrote {} bundles".format(len(filenames)))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Clones an existing subject.")
     parser.add_argument("old_subject_bundle", help="The subject to clone.")
-    parser.add_argument("--subject-id", dest="new_subject_id", help="The new subject ID.")
+    parser.add_argument("--subject-id", dest="new_subject_ids", action="append", default=[],
+                        help="The new subject ID (can be repeated).")
+    parser.add_argument("-n", "--count", type=int, default=0,
+                        help="Also generate this many subject IDs (the old subject ID with a suffix).")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="Number of worker processes.")
+    parser.add_argument("--seed", type=int, help="Seed for the randomised patient details.")
     opts = parser.parse_args()
-    if not opts.new_subject_id:
-        parser.print_help()
-        sys.exit(1)
-    if not opts.old_subject_bundle:
+    if not opts.old_subject_bundle or not os.path.exists(opts.old_subject_bundle):
         parser.print_help()
         sys.exit(1)
-    if not os.path.exists(opts.old_subject_bundle):
+    new_subject_ids = list(opts.new_subject_ids)
+    if opts.count:
+        template = bundler.SourcedBundle.from_bundle_file(opts.old_subject_bundle, lazy=True).subjects[0]
+        new_subject_ids.extend(f"{template}-{idx:05d}" for idx in range(1, opts.count + 1))
+    if not new_subject_ids:
         parser.print_help()
         sys.exit(1)
 
-    clone_subject(opts.old_subject_bundle, opts.new_subject_id)
\ No newline at end of file
+    clone_subject(opts.old_subject_bundle, new_subject_ids, opts.workers, opts.seed)
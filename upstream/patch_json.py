@@ -1,9 +1,14 @@
-import hashlib
+import argparse
 import json
 import os.path
-import sys
 import uuid
+from collections import OrderedDict
 from datetime import datetime
+from typing import Iterable, Optional
+
+from soa_bridge_match.ids import MINTER, organization_id
+from soa_bridge_match.jsonstream import BundleReader, dump_entry
+from soa_bridge_match.query import is_common_type
 
 """
 This script does some elementary patching of the JSON files from the upstream
@@ -26,36 +31,77 @@ STATUS = dict(Observation=dict(status="final"),
 SUBJECT_MAP = {}
 
 
+# elements (besides COMMON_REFERENCE_ELEMENTS) of the resources in the LZZT bundle that can hold a
+# Reference, resources of other types are walked in full
+REFERENCE_ELEMENTS = dict(
+    AdverseEvent=("subject", "encounter", "recorder", "contributor", "resultingCondition", "location",
+                  "subjectMedicalHistory", "referenceDocument", "study", "suspectEntity"),
+    CarePlan=("basedOn", "replaces", "partOf", "subject", "encounter", "author", "contributor", "careTeam",
+              "addresses", "supportingInfo", "goal", "activity"),
+    Condition=("subject", "encounter", "recorder", "asserter", "stage", "evidence"),
+    Encounter=("subject", "episodeOfCare", "basedOn", "participant", "appointment", "reasonReference",
+               "diagnosis", "account", "hospitalization", "location", "serviceProvider", "partOf"),
+    MedicationStatement=("basedOn", "partOf", "medicationReference", "subject", "context", "informationSource",
+                         "derivedFrom", "reasonReference"),
+    Observation=("basedOn", "partOf", "subject", "focus", "encounter", "performer", "specimen", "device",
+                 "hasMember", "derivedFrom"),
+    Patient=("contact", "generalPractitioner", "managingOrganization", "link"),
+    ServiceRequest=("basedOn", "replaces", "subject", "encounter", "requester", "performer", "locationReference",
+                    "reasonReference", "insurance", "supportingInfo", "specimen", "relevantHistory"),
+)
+
+# elements that can hold a Reference on any resource
+COMMON_REFERENCE_ELEMENTS = ("contained", "extension", "modifierExtension", "identifier", "note")
+
+
+def hashed_id(identifier: str) -> str:
+    """
+    Hash an identifier (minted once, the same patient and organization ids recur on every resource)
+    """
+    return MINTER.mint(identifier)
+
+
+def rewrite_reference(parent: dict):
+    """
+    Update a Reference to use the hashed Patient and Organization ids and the Study id
+    """
+    if parent['reference'].startswith('Patient/'):
+        # already hashed
+        if '-' in parent['reference']:
+            patient_id = parent['reference'].split('/')[-1]
+            parent['reference'] = f"Patient/{hashed_id(patient_id)}"
+    elif parent['reference'].startswith('Organization/'):
+        org_id = parent['reference'].split('/')[-1]
+        if str(org_id).isdigit():
+            parent['reference'] = f"Organization/{hashed_id(org_id)}"
+    elif parent['reference'].startswith('ResearchStudy/'):
+        parent['reference'] = f"ResearchStudy/H2Q-MC-LZZT-ResearchStudy"
+
+
 def update_references(parent: dict):
     """
     Update the Patient to use a Hash rather than the Subject ID
+
+    For the resource types in REFERENCE_ELEMENTS only the elements that can hold a Reference are visited.
     """
     if not isinstance(parent, (dict, list)):
         return
-    if 'resourceType' in parent and parent['resourceType'] == 'ResearchSubject':
-        return
-    if 'reference' in parent:
-        if parent['reference'].startswith('Patient/'):
-            # already hashed
-            if '-' in parent['reference']:
-                patient_id = parent['reference'].split('/')[-1]
-                hashed = hashlib.md5(patient_id.encode('utf-8')).hexdigest()
-                parent['reference'] = f"Patient/{hashed}"
-        elif parent['reference'].startswith('Organization/'):
-            org_id = parent['reference'].split('/')[-1]
-            if str(org_id).isdigit():
-                hashed = hashlib.md5(org_id.encode('utf-8')).hexdigest()
-                parent['reference'] = f"Organization/{hashed}"
-        elif parent['reference'].startswith('ResearchStudy/'):
-            parent['reference'] = f"ResearchStudy/H2Q-MC-LZZT-ResearchStudy"
+    if isinstance(parent, dict) and parent.get('resourceType') in REFERENCE_ELEMENTS:
+        elements = REFERENCE_ELEMENTS[parent['resourceType']] + COMMON_REFERENCE_ELEMENTS
+        stack = [parent[element] for element in elements if element in parent]
     else:
-        if isinstance(parent, list):
-            for child in parent:
-                update_references(child)
-        elif isinstance(parent, dict):
-            # these have been manually patched
-            for child in parent.values():
-                update_references(child)
+        stack = [parent]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if node.get('resourceType') == 'ResearchSubject':
+                continue
+            if 'reference' in node:
+                rewrite_reference(node)
+            else:
+                stack.extend(x for x in node.values() if isinstance(x, (dict, list)))
+        elif isinstance(node, list):
+            stack.extend(x for x in node if isinstance(x, (dict, list)))
 
 
 def patch_research_subject(research_subject: dict) -> str:
@@ -65,7 +111,7 @@ def patch_research_subject(research_subject: dict) -> str:
     * update the identifier to use the subject id
     """
     subject_id = research_subject["individual"]["reference"].split("/")[-1]
-    hashed = hashlib.md5(subject_id.encode('utf-8')).hexdigest()
+    hashed = hashed_id(subject_id)
     research_subject["individual"]["reference"] = f"Patient/{hashed}"
     research_subject["id"] = subject_id
     return subject_id
@@ -78,7 +124,7 @@ def patch_patient(patient: dict) -> str:
     * update the identifier to use the patient id
     """
     patient_id = patient["id"]
-    hashed = hashlib.md5(patient_id.encode('utf-8')).hexdigest()
+    hashed = hashed_id(patient_id)
     patient["id"] = hashed
     return hashed
 
@@ -117,135 +163,202 @@ def patch_observation(observation: dict):
         observation['status'] = 'final'
 
 
-def split_bundle(bundle: dict, expected: list[str]) -> dict:
+def entry_patient(entry: dict) -> Optional[str]:
+    """
+    Get the Patient id for an entry, None for the design elements
+    """
+    rtype = entry['resource']['resourceType']
+    # maybe this should check for 'subject' or 'individual'
+    if is_common_type(rtype):
+        return None
+    if rtype == "Patient":
+        return entry['resource']['id']
+    elif rtype == "ResearchSubject":
+        return entry['resource']['individual']['reference'].split("/")[-1]
+    try:
+        subject = entry['resource']['subject']
+    except KeyError as exc:
+        print("Subject missing on {} {}".format(rtype, entry['resource']['id']))
+        raise exc
+    return subject['reference'].split("/")[-1]
+
+
+def split_bundle(bundle: dict, expected: Iterable[str]) -> dict:
     """
     Split a bundle into a list of entries
     """
+    expected = set(expected)
     cache = {}
     common = []
     patients = []
     for entry in bundle['entry']:
-        rtype = entry['resource']['resourceType']
-        # maybe this should check for 'subject' or 'individual'
-        if rtype in ("ResearchStudy", "Group", "Organization", "Practitioner", "Medication") or rtype.endswith(
-                "Definition"):
+        _id = entry_patient(entry)
+        if _id is None:
             # design elements
             common.append(entry)
-        else:
-            if rtype == "Patient":
-                _id = entry['resource']['id']
-                patients.append(_id)
-            elif rtype == "ResearchSubject":
-                _id = entry['resource']['individual']['reference'].split("/")[-1]
-            else:
-                try:
-                    subject = entry['resource']['subject']
-                except KeyError as exc:
-                    print("Subject missing on {} {}".format(rtype, entry['resource']['id']))
-                    raise exc
-                _id = subject['reference'].split("/")[-1]
-            if _id not in cache:
-                if _id not in expected:
-                    # this might not be a problem
-                    # print("Unknown patient {} on {} {}".format(_id, rtype, entry['resource']['id']))
-                    continue
-            cache.setdefault(_id, []).append(entry)
+            continue
+        if entry['resource']['resourceType'] == "Patient":
+            patients.append(_id)
+        if _id not in cache:
+            if _id not in expected:
+                # this might not be a problem
+                # print("Unknown patient {} on {} {}".format(_id, rtype, entry['resource']['id']))
+                continue
+        cache.setdefault(_id, []).append(entry)
     for _id, entries in cache.items():
         cache[_id] = entries + common
-    if cache.keys() != patients:
-        print("Extra patients: {}".format(set(cache.keys()) - set(patients)))
+    if cache.keys() != set(patients):
+        print("Extra patients: {}".format(cache.keys() - set(patients)))
     return cache
 
 
+class DuplicateReport:
+    """
+    Records the resources given a new identifier because the identifier was already in use
+    """
+
+    def __init__(self):
+        self._dupes = {}
+
+    def add(self, resource_type: str, identifier: str, new_id: str, idx: int):
+        self._dupes.setdefault(resource_type, []).append(dict(id=identifier, new_id=new_id, idx=idx))
+
+    def __len__(self) -> int:
+        return sum(len(x) for x in self._dupes.values())
+
+    def counts(self) -> dict:
+        """
+        Number of duplicates by resource type
+        """
+        return {resource_type: len(dupes) for resource_type, dupes in self._dupes.items()}
+
+    def as_dict(self) -> dict:
+        """
+        Duplicates by resource type, as written to the _dupes file
+        """
+        return self._dupes
+
+
+class PatchState:
+    """
+    Tracks the identifiers seen while patching the entries of a bundle
+    """
+
+    def __init__(self):
+        # resource type -> set of identifiers
+        self.id_cache = {}
+        self.dupes = DuplicateReport()
+        self.subjects = []
+        self.patients = []
+        # hashed patient id -> original patient id
+        self.patient_ids = {}
+
+
+def patch_entry(idx: int, entry: dict, state: PatchState):
+    """
+    Apply the patches to an entry
+    """
+    resource = entry['resource']
+    resource_type = resource['resourceType']
+    _identifier = resource['id']
+    seen = state.id_cache.setdefault(resource_type, set())
+    if _identifier in seen:
+        print(f"{idx}: Updating duplicate identifier", _identifier, "for resource", resource_type)
+        _id = str(uuid.uuid4())
+        # add a reference to the duplicate
+        state.dupes.add(resource_type, _identifier, _id, idx)
+        resource['id'] = _id
+    else:
+        seen.add(_identifier)
+    if resource['resourceType'] == 'AdverseEvent':
+        patch_adverse_event(resource)
+    elif resource['resourceType'] == 'ResearchSubject':
+        state.subjects.append(resource)
+        # update the identifier
+        _identifier = patch_research_subject(resource)
+    elif resource['resourceType'] == 'Patient':
+        original_id = resource['id']
+        state.patients.append(resource)
+        # update the identifier
+        _identifier = patch_patient(resource)
+        # track the patient ids
+        state.patient_ids[_identifier] = original_id
+    elif resource['resourceType'] == 'Observation':
+        patch_observation(resource)
+    elif resource['resourceType'] in STATUS:
+        _sets = STATUS[resource['resourceType']]
+        for key, value in _sets.items():
+            if isinstance(value, dict):
+                element = resource[key]
+                if isinstance(element, list):
+                    for item in element:
+                        for k, v in value.items():
+                            item[k] = v
+                else:
+                    for k, v in value.items():
+                        element[k] = v
+            elif key not in entry['resource']:
+                entry['resource'][key] = value
+    update_references(resource)
+    # if 'fullUrl' not in entry:
+    #     # ADD THE FULL URL
+    #     entry['fullUrl'] = _identifier
+    if 'request' not in entry:
+        # ADD THE REQUEST (to create the resource)
+        entry['request'] = dict(method='PUT',
+                                url=f"{resource_type}/{_identifier}",
+                                ifNoneExist=f"identifier={_identifier}")
+
+
+def extra_entries() -> list[dict]:
+    """
+    Entries added to the bundle; the site and the study medication
+    """
+    # add the site
+    _site_id = organization_id("701")
+    site_entry = dict(resource=dict(
+        resourceType='Organization',
+        id=_site_id,
+        name="H2Q-MC-LZZT Site 701"),
+        request=dict(method='PUT',
+                     url=f'Organization/{_site_id}',
+                     ifNoneExist=f"id={_site_id}")
+    )
+    # add a record for the medication
+    medication_entry = dict(resource=dict(
+        resourceType='Medication',
+        id="LY246708"),
+        request=dict(method='PUT',
+                     url=f'Medication/LY246708',
+                     ifNoneExist=f"id=LY246708")
+    )
+    return [site_entry, medication_entry]
+
+
+def subject_filename(prefix: str, ext: str, original_id: str) -> str:
+    return f"subjects/{prefix.replace('10_Patients', original_id)}{ext}"
+
+
 def patch_file(filename):
     if os.path.exists(filename):
-        id_cache = {}
-        dupes = {}
+        state = PatchState()
         prefix, ext = os.path.splitext(filename)
         with open(filename, 'r') as f:
             data = json.load(f)
         if "type" not in data:
             data["type"] = "transaction"
-        subjects = []
-        patients = []
-        patient_ids = {}
         for idx, entry in enumerate(data['entry']):
-            resource = entry['resource']
-            resource_type = resource['resourceType']
-            _identifier = resource['id']
-            if _identifier in id_cache.get(resource_type, []):
-                print(f"{idx}: Updating duplicate identifier", _identifier, "for resource", resource_type)
-                _id = str(uuid.uuid4())
-                # add a reference to the duplicate
-                dupes.setdefault(resource_type, []).append(dict(id=_identifier, new_id=_id, idx=idx))
-                resource['id'] = _id
-            else:
-                id_cache.setdefault(resource_type, []).append(_identifier)
-            if resource['resourceType'] == 'AdverseEvent':
-                patch_adverse_event(resource)
-            elif resource['resourceType'] == 'ResearchSubject':
-                subjects.append(resource)
-                # update the identifier
-                _identifier = patch_research_subject(resource)
-            elif resource['resourceType'] == 'Patient':
-                original_id = resource['id']
-                patients.append(resource)
-                # update the identifier
-                _identifier = patch_patient(resource)
-                # track the patient ids
-                patient_ids[_identifier] = original_id
-            elif resource['resourceType'] == 'Observation':
-                patch_observation(resource)
-            elif resource['resourceType'] in STATUS:
-                _sets = STATUS[resource['resourceType']]
-                for key, value in _sets.items():
-                    if isinstance(value, dict):
-                        element = resource[key]
-                        if isinstance(element, list):
-                            for item in element:
-                                for k, v in value.items():
-                                    item[k] = v
-                        else:
-                            for k, v in value.items():
-                                element[k] = v
-                    elif key not in entry['resource']:
-                        entry['resource'][key] = value
-            update_references(resource)
-            # if 'fullUrl' not in entry:
-            #     # ADD THE FULL URL
-            #     entry['fullUrl'] = _identifier
-            if 'request' not in entry:
-                # ADD THE REQUEST (to create the resource)
-                entry['request'] = dict(method='PUT',
-                                        url=f"{resource_type}/{_identifier}",
-                                        ifNoneExist=f"identifier={_identifier}")
-        # add the site
-        _site_id = hashlib.md5("701".encode('utf-8')).hexdigest()
-        site_entry = dict(resource=dict(
-            resourceType='Organization',
-            id=_site_id,
-            name="H2Q-MC-LZZT Site 701"),
-            request=dict(method='PUT',
-                         url=f'Organization/{_site_id}',
-                         ifNoneExist=f"id={_site_id}")
-        )
-        data['entry'].append(site_entry)
-        # add a record for the medication
-        medication_entry = dict(resource=dict(
-            resourceType='Medication',
-            id="LY246708"),
-            request=dict(method='PUT',
-                         url=f'Medication/LY246708',
-                         ifNoneExist=f"id=LY246708")
-        )
-        data['entry'].append(medication_entry)
+            patch_entry(idx, entry, state)
+        data['entry'].extend(extra_entries())
         # check we haven't made a new subject or two
-        assert len(patients) == len(subjects)
+        assert len(state.patients) == len(state.subjects)
         with open(f"{prefix}_patched{ext}", 'w') as f:
             json.dump(data, f, indent=2)
         with open(f"{prefix}_dupes{ext}", 'w') as f:
-            json.dump(dupes, f, indent=2)
-        split_entries = split_bundle(data, patient_ids.keys())
+            json.dump(state.dupes.as_dict(), f, indent=2)
+        if state.dupes:
+            print("Updated {} duplicate identifiers: {}".format(len(state.dupes), state.dupes.counts()))
+        split_entries = split_bundle(data, state.patient_ids.keys())
         for patient_id, entries in split_entries.items():
             content = dict(resourceType="Bundle",
                            id=str(uuid.uuid4()),
@@ -253,12 +366,147 @@ def patch_file(filename):
                            meta=dict(lastUpdated=datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')),
                            entry=entries)
 
-            with open(f"subjects/{prefix.replace('10_Patients', patient_ids.get(patient_id))}{ext}", 'w') as f:
+            with open(subject_filename(prefix, ext, state.patient_ids.get(patient_id)), 'w') as f:
                 json.dump(content, f, indent=2)
 
     else:
         raise FileNotFoundError(filename)
 
 
+class SubjectWriters:
+    """
+    Writes the entries for each subject to a bundle file as they arrive
+
+    At most `max_open` files are kept open, the least recently used file is closed (and reopened for
+    append when the subject next has an entry).  The files are written with a `.part` suffix until
+    the common entries have been added.
+    """
+
+    def __init__(self, dirname: str, max_open: int = 64):
+        self.dirname = dirname
+        self.max_open = max_open
+        self._handles = OrderedDict()
+        self._counts = {}
+
+    @property
+    def patient_ids(self) -> set:
+        return set(self._counts)
+
+    def path(self, patient_id: str) -> str:
+        return os.path.join(self.dirname, f"{patient_id}.json.part")
+
+    def _handle(self, patient_id: str):
+        if patient_id in self._handles:
+            self._handles.move_to_end(patient_id)
+            return self._handles[patient_id]
+        if len(self._handles) >= self.max_open:
+            _, handle = self._handles.popitem(last=False)
+            handle.close()
+        if patient_id in self._counts:
+            handle = open(self.path(patient_id), 'a')
+        else:
+            handle = open(self.path(patient_id), 'w')
+            header = json.dumps(dict(resourceType="Bundle",
+                                     id=str(uuid.uuid4()),
+                                     type="transaction",
+                                     meta=dict(lastUpdated=datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ'))),
+                                indent=2)
+            handle.write(header[:-2] + ',\n  "entry": [\n')
+            self._counts[patient_id] = 0
+        self._handles[patient_id] = handle
+        return handle
+
+    def write(self, patient_id: str, entry: dict):
+        handle = self._handle(patient_id)
+        if self._counts[patient_id]:
+            handle.write(",\n")
+        handle.write(dump_entry(entry))
+        self._counts[patient_id] += 1
+
+    def finish(self, common: list[dict], names: dict) -> None:
+        """
+        Add the common entries and move the files into place, files for patients not in names are dropped
+        """
+        for handle in self._handles.values():
+            handle.close()
+        self._handles.clear()
+        for patient_id in self._counts:
+            if patient_id not in names:
+                os.remove(self.path(patient_id))
+                continue
+            with open(self.path(patient_id), 'a') as f:
+                for entry in common:
+                    f.write(",\n")
+                    f.write(dump_entry(entry))
+                f.write("\n  ]\n}")
+            os.replace(self.path(patient_id), names[patient_id])
+
+
+def stream_patch_file(filename, max_open: int = 64):
+    """
+    Patch and split the file one entry at a time, the only entries held in memory are the design elements
+    """
+    if not os.path.exists(filename):
+        raise FileNotFoundError(filename)
+    state = PatchState()
+    prefix, ext = os.path.splitext(filename)
+    common = []
+    writers = SubjectWriters(os.path.dirname(subject_filename(prefix, ext, "")) or ".", max_open=max_open)
+    with open(filename, 'r') as source, open(f"{prefix}_patched{ext}", 'w') as patched:
+        reader = BundleReader(source)
+        written = None
+        for idx, entry in enumerate(reader.entries()):
+            if written is None:
+                # the members before the entries
+                written = set(reader.header)
+                patched.write("{")
+                for key, value in reader.header.items():
+                    patched.write(f"\n  {json.dumps(key)}: {json.dumps(value)},")
+                patched.write('\n  "entry": [\n')
+            else:
+                patched.write(",\n")
+            patch_entry(idx, entry, state)
+            patched.write(dump_entry(entry))
+            _id = entry_patient(entry)
+            if _id is None:
+                common.append(entry)
+            else:
+                writers.write(_id, entry)
+        for entry in extra_entries():
+            if written is None:
+                written = set()
+                patched.write('{\n  "entry": [\n')
+            else:
+                patched.write(",\n")
+            patched.write(dump_entry(entry))
+            common.append(entry)
+        patched.write("\n  ]")
+        # the members after the entries
+        trailing = {key: value for key, value in reader.header.items() if key not in written}
+        if "type" not in reader.header:
+            trailing["type"] = "transaction"
+        for key, value in trailing.items():
+            patched.write(f",\n  {json.dumps(key)}: {json.dumps(value)}")
+        patched.write("\n}")
+    assert len(state.patients) == len(state.subjects)
+    with open(f"{prefix}_dupes{ext}", 'w') as f:
+        json.dump(state.dupes.as_dict(), f, indent=2)
+    if state.dupes:
+        print("Updated {} duplicate identifiers: {}".format(len(state.dupes), state.dupes.counts()))
+    extra = writers.patient_ids - set(state.patient_ids)
+    if extra:
+        print("Extra patients: {}".format(extra))
+    writers.finish(common, {patient_id: subject_filename(prefix, ext, original_id)
+                            for patient_id, original_id in state.patient_ids.items()})
+
+
 if __name__ == "__main__":
-    patch_file(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Patch the upstream bundle and split it by subject")
+    parser.add_argument("filename", help="The bundle to patch")
+    parser.add_argument("--stream", action="store_true",
+                        help="Process the bundle an entry at a time (for bundles too large to load)")
+    opts = parser.parse_args()
+    if opts.stream:
+        stream_patch_file(opts.filename)
+    else:
+        patch_file(opts.filename)
@@ -0,0 +1,32 @@
+import argparse
+import glob
+import os
+
+from soa_bridge_match.uploader import MAX_BYTES, MAX_ENTRIES, Uploader
+
+
+def find_bundles(paths):
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(sorted(glob.glob(os.path.join(path, "*.json"))))
+        else:
+            filenames.append(path)
+    return filenames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upload the subject bundles to a FHIR server in chunks")
+    parser.add_argument("paths", nargs="+", help="The bundle files, or directories of them")
+    parser.add_argument("--url", default="http://localhost:8080/", help="The base URL of the FHIR server")
+    parser.add_argument("-j", "--workers", type=int, default=4, help="The number of chunks to post at once")
+    parser.add_argument("--max-entries", type=int, default=MAX_ENTRIES, help="The most entries in a chunk")
+    parser.add_argument("--max-bytes", type=int, default=MAX_BYTES, help="The (approximate) largest chunk")
+    parser.add_argument("--batch", action="store_true", help="Post the chunks as batches, not transactions")
+    parser.add_argument("--retries", type=int, default=5, help="The number of times to retry a chunk")
+    parser.add_argument("--checkpoint", help="Record the posted chunks in this file, and skip them when rerun")
+    opts = parser.parse_args()
+    uploader = Uploader(opts.url, workers=opts.workers, max_entries=opts.max_entries, max_bytes=opts.max_bytes,
+                        bundle_type="batch" if opts.batch else "transaction", retries=opts.retries,
+                        checkpoint=opts.checkpoint)
+    uploader.upload(find_bundles(opts.paths))